@@ -1,9 +1,19 @@
 import logging
 import re
+import struct
+from abc import ABC, abstractmethod
+from base64 import b64decode, b64encode
+from collections import deque
+from contextlib import contextmanager
 from datetime import datetime
-from json import dumps
-from random import randint, uniform
-from time import sleep
+from json import dumps, loads
+from os import getpid, kill, sysconf
+from random import uniform
+from signal import SIGKILL
+from socket import gethostname
+from threading import Event, Thread
+from time import monotonic, sleep
+from uuid import uuid4
 from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
 from environs import Env
@@ -17,23 +27,83 @@ env.read_env()
 
 # variables requireds
 mqtt_broker = env.str('mqtt-broker')
-mvf_username = env.str('username')
-mvf_password = env.str('password')
+# many accounts: a json list of {"username", "password", "name", "topic", "device_name"}
+accounts_file = env.str('accounts-file', None)
+if accounts_file:
+    mvf_username = env.str('username', None)
+    mvf_password = env.str('password', None)
+else:
+    mvf_username = env.str('username')
+    mvf_password = env.str('password')
 
 
 # optional variables
 mqtt_port = env.int('mqtt-port', 1883)
 mqtt_topic = env.str('mqtt-topic', 'minvandforsyningdk/total')
 mqtt_status_topic = env.str('mqtt-status-topic', 'minvandforsyningdk/status')
+usage_sensors = env.bool('usage-sensors', False)  # water used in the last hour, day and month
+mqtt_usage_topic = env.str('mqtt-usage-topic', 'minvandforsyningdk/usage')
+leak_detection = env.bool('leak-detection', False)  # look for leaks in the reading history
+mqtt_leak_topic = env.str('mqtt-leak-topic', 'minvandforsyningdk/leak')
+leak_min_flow = env.float('leak-min-flow', 1.0)  # L/h that never stops at night is a leak
+leak_nights = env.int('leak-nights', 3)  # nights in a row before it counts
+leak_spike_factor = env.float('leak-spike-factor', 5.0)  # times the usual use for that hour
+# more places a reading goes besides mqtt, e.g. 'influx=http://influx:8086/api/v2/write?...'
+output_sinks = env.list('output-sinks', [])
+influx_token = env.str('influx-token', None)
+sink_batch_size = env.int('sink-batch-size', 50)  # readings per write
+sink_flush_interval = env.int('sink-flush-interval', 5)  # seconds a reading may wait for more
+sink_queue_size = env.int('sink-queue-size', 1000)  # readings kept while a sink is down
+sink_retries = env.int('sink-retries', 3)  # write attempts before a batch waits for the next
+# 'scrape' on the command topic reads the meter now, instead of at the next run
+mqtt_commands = env.bool('mqtt-commands', False)
+mqtt_command_topic = env.str('mqtt-command-topic', 'minvandforsyningdk/command')
+command_min_interval = env.int('command-min-interval', 5 * 60)  # seconds between two runs
+command_cache_ttl = env.int('command-cache-ttl', 60)  # seconds a reading is answered again
+# replicas: only the node holding the lease on this topic scrapes
+leader_lease_topic = env.str('leader-lease-topic', None)
+leader_lease_ttl = env.int('leader-lease-ttl', 90)  # seconds without a heartbeat before a takeover
+node_id = env.str('node-id', None)  # defaults to the hostname
+# several nodes share the accounts, each scraping its part of them
+cluster_topic = env.str('cluster-topic', None)
+cluster_keepalive = env.int('cluster-keepalive', 30)  # a dead node is noticed after 1.5 times this
 mqtt_username = env.str('mqtt-username', None)
 mqtt_password = env.str('mqtt-password', None)
 datetime_format = env.str('datetime-format', 'kl. %H.%M, d. %d.%m.%Y')
 login_url = env.str('login-url', 'https://www.minvandforsyning.dk/login/picker')
+site_profile = env.str('site-profile', 'auto')  # see PROFILES, 'auto' picks one itself
+site_profiles_file = env.str('site-profiles-file', None)  # json with more profiles
+# seconds to go straight to the login form the picker led to last time, 0 is never
+login_entry_ttl = env.int('login-entry-ttl', 0)
+# stay logged in on the dashboard and publish when the reading changes, instead of runs
+watch_mode = env.bool('watch-mode', False)
+watch_reload_interval = env.int('watch-reload-interval', 30 * 60)  # seconds between soft reloads
+scrape_engine = env.str('scrape-engine', 'browser')  # 'http' tries without a browser first
+http_login_url = env.str('http-login-url', None)  # where the identity provider login starts
 
 # browser settings
-browser_cdp_url = env.str('browser-cdp-url', None)  # use a remote chrome instead
+# use remote chromes instead, a comma separated list is a pool
+browser_cdp_url = env.str('browser-cdp-url', None)
+browser_cdp_fallback = env.bool('browser-cdp-fallback', True)  # launch our own when all are down
 browser_executable = env.str('browser-executable', None)  # use another chromium build
 headless = env.bool('headless', True)
+browser_profile = env.str('browser-profile', 'default')  # 'low-memory' for 1 GB hosts
+browser_js_heap = env.int('browser-js-heap', 128)  # MB, javascript heap cap of low-memory
+browser_memory_budget = env.int('browser-memory-budget', 0)  # MB, 0 is no limit
+# every attempt runs in a child process that is killed, browser and all, when it overruns
+run_isolation = env.bool('run-isolation', True)
+run_timeout = env.int('run-timeout', 10 * 60)  # seconds per attempt, 0 is no limit
+run_memory_limit = env.int('run-memory-limit', 0)  # MB of address space, 0 is no limit
+run_cpu_limit = env.int('run-cpu-limit', 0)  # cpu seconds per process, 0 is no limit
+run_deadline = env.int('run-deadline', 0)  # seconds for a whole run, retries included
+# start a second attempt next to one that is slower than usual, the first reading wins
+hedge_attempts = env.bool('hedge-attempts', False)
+
+# politeness towards the site and the login provider
+rate_limit = env.float('rate-limit', 0)  # logins and page loads a minute, 0 is no limit
+rate_burst = env.int('rate-burst', 2)  # that many can go right after each other
+rate_limit_file = env.str('rate-limit-file', None)  # share the limit with other processes
+schedule_spread = env.bool('schedule-spread', False)  # stagger the runs over the interval
 
 # resilience settings
 _run_timer = env.int('scrape-interval', 60 * 60)  # 1 hour between successful runs
@@ -45,17 +115,32 @@ page_load_timeout = env.int('page-load-timeout', 60)  # seconds before goto() gi
 form_settle_delay = env.int('form-settle-delay', 2)  # let the login form settle
 mqtt_retries = env.int('mqtt-retries', 3)
 debug_dir = env.str('debug-dir', None)  # dump html/screenshot/trace here when a run fails
+debug_max_size = env.int('debug-max-size', 200)  # MB, the oldest diagnostics go first
+debug_max_age = env.int('debug-max-age', 14)  # days
+# off, always, sampled (1 run in trace-sample-rate), retry (from attempt 2) or ring
+trace_mode = env.str('trace-mode', 'always')
+trace_sample_rate = env.int('trace-sample-rate', 10)
+trace_ring_size = env.int('trace-ring-size', 5)  # steps the ring mode keeps the DOM of
 log_level = env.str('log-level', 'INFO')
+# keep a successful run on disk, or serve a kept run to the browser instead of the site
+record_dir = env.str('record-dir', None)
+replay_dir = env.str('replay-dir', None)
+state_dir = env.str('state-dir', None)  # remembers what was announced across restarts
+# name=value lines that override the variables, re-read between runs when it changes
+config_file = env.str('config-file', None)
 
 # home assistant mqtt discovery
 mqtt_discovery = env.bool('mqtt-discovery', True)
 discovery_prefix = env.str('mqtt-discovery-prefix', 'homeassistant')
+mqtt_discovery_verify = env.bool('mqtt-discovery-verify', False)  # ask the broker first
+# 'entity' is one retained config per entity, 'device' one per meter (home assistant 2024.11+)
+discovery_format = env.str('mqtt-discovery-format', 'entity')
 mqtt_retain = env.bool('mqtt-retain', True)
 device_name = env.str('device-name', 'Minvandforsyning')
 # the site reports danish wall clock time without a timezone
 timezone_name = env.str('timezone', 'Europe/Copenhagen')
 
-mqtt_client_id = f'python-mqtt-{randint(0, 1000)}'
+mqtt_client_id = f'python-mqtt-{node_id or gethostname()}'
 
 mqtt_auth = None
 if mqtt_username is not None:
@@ -79,13 +164,132 @@ except (ZoneInfoNotFoundError, ValueError):
                 timezone_name)
     reading_timezone = None
 
-_announced_meters = set()
+_announced_meters = {}  # meter id -> digest of the discovery config announced
+_run_count = 0
 
 
 class ElementNotFoundError(Exception):
     """Raised when none of the candidate selectors for a target matched."""
 
 
+class DeadlineExceededError(Exception):
+    """Raised when the time budget of a run ('run-deadline') is spent."""
+
+
+class Deadline:
+    """The time budget of one run, shared by every call made during it.
+
+    Every timeout is cut down to what is left of the budget, so a run takes at
+    most 'run-deadline' seconds however many calls wait their full timeout.
+    Without seconds it never expires.
+    """
+
+    def __init__(self, seconds=0):
+        self.seconds = seconds
+        self.expires = monotonic() + seconds if seconds else None
+
+    def remaining(self):
+        """Seconds left, None when there is no budget."""
+        if self.expires is None:
+            return None
+        return max(0.0, self.expires - monotonic())
+
+    def limit(self, seconds):
+        """`seconds` (None is no limit), but no more than what is left.
+
+        Raises DeadlineExceededError when nothing is left.
+        """
+        remaining = self.remaining()
+        if remaining is None:
+            return seconds
+        if remaining <= 0:
+            raise DeadlineExceededError(f"The run used up its {self.seconds} seconds")
+        return remaining if seconds is None else min(seconds, remaining)
+
+
+_no_deadline = Deadline()
+
+
+class TokenBucket:
+    """Rate limit: 'rate' tokens a minute, up to 'burst' of them saved up.
+
+    Threads share the bucket through a lock. With a path, the bucket lives in
+    that file under an flock, so the run processes and other scrapers on the
+    same host (with the file on a shared volume) share it as well.
+    """
+
+    def __init__(self, rate, burst, path=None):
+        from threading import Lock
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.path = path
+        self._lock = Lock()
+        self._state = (float(self.burst), None)  # tokens, and when they were counted
+
+    @contextmanager
+    def _locked(self):
+        from fcntl import LOCK_EX, flock
+        with self._lock:
+            if not self.path:
+                yield
+                return
+            with open(self.path, 'a+', encoding='ascii') as handle:
+                flock(handle, LOCK_EX)  # released when the file is closed
+                handle.seek(0)
+                try:
+                    tokens, stamp = handle.read().split()
+                    self._state = (float(tokens), float(stamp))
+                except ValueError:  # a new file
+                    self._state = (float(self.burst), None)
+                yield
+                handle.seek(0)
+                handle.truncate()
+                handle.write('%f %f' % self._state)
+
+    def take(self):
+        """Take a token. Returns 0, or the seconds until there is one."""
+        from time import time
+        with self._locked():
+            tokens, stamp = self._state
+            now = time()
+            if stamp is not None:
+                tokens = min(self.burst, tokens + max(0.0, now - stamp) * self.rate / 60)
+            wait = 0 if tokens >= 1 else (1 - tokens) * 60 / self.rate
+            self._state = (tokens - 1 if not wait else tokens, now)
+        return wait
+
+    def acquire(self, what, deadline=None):
+        """Wait for a token, no longer than the deadline allows."""
+        deadline = deadline or _no_deadline
+        while True:
+            wait = self.take()
+            if not wait:
+                return
+            log.info("Waiting %.0f seconds before the %s, at most %s a minute",
+                     wait, what, rate_limit)
+            sleep(deadline.limit(wait))
+
+
+_bucket = None
+_main_pid = getpid()  # the attempts are forked from this process
+
+
+def polite(what, deadline=None):
+    """Wait for the rate limit before a login or a page load."""
+    global _bucket
+    if not rate_limit:
+        return
+    if _bucket is None:
+        path = rate_limit_file
+        if not path and run_isolation:
+            # every attempt is a process of its own, so they have to share a file
+            from os.path import join
+            from tempfile import gettempdir
+            path = join(gettempdir(), f'minvandforsyning-rate-{_main_pid}')
+        _bucket = TokenBucket(rate_limit, rate_burst, path)
+    _bucket.acquire(what, deadline)
+
+
 def _parse_selectors(spec):
     """Split a selector spec into a list of playwright selectors.
 
@@ -149,31 +353,161 @@ total_pattern = env.str('pattern-total', r'([\d.]+,\d+)\s*m(?:³|3)')
 meter_id_pattern = env.str('pattern-meter-id', r'(?:m[åa]ler|meter)[^\d]{0,20}(\d{4,})')
 
 
-def _format_to_regex(fmt):
-    """Turn a strftime format into a regex that matches the same text."""
-    tokens = {
-        '%H': r'\d{1,2}', '%M': r'\d{2}', '%S': r'\d{2}',
-        '%d': r'\d{1,2}', '%m': r'\d{1,2}', '%Y': r'\d{4}', '%y': r'\d{2}',
-    }
+_FORMAT_TOKENS = {
+    '%H': r'\d{1,2}', '%M': r'\d{2}', '%S': r'\d{2}',
+    '%d': r'\d{1,2}', '%m': r'\d{1,2}', '%Y': r'\d{4}', '%y': r'\d{2}',
+}
+
+
+def _format_to_regex(fmt, named=False):
+    """Turn a strftime format into a regex that matches the same text.
+
+    With `named`, every field is a named group ('H', 'M', 'd', ...), which is
+    what the fast timestamp parser reads the fields from.
+    """
     parts = re.split(r'(%[a-zA-Z%])', fmt)
-    return ''.join(tokens.get(part, re.escape(part)) for part in parts)
+    regex = []
+    for part in parts:
+        if part in _FORMAT_TOKENS:
+            token = _FORMAT_TOKENS[part]
+            regex.append(f'(?P<{part[1]}>{token})' if named else token)
+        else:
+            regex.append(re.escape(part))
+    return ''.join(regex)
+
+
+class SiteProfile:
+    """Selectors, patterns and date format of one variant of the portal.
+
+    The waterworks on the platform do not all render the dashboard the same
+    way. A profile holds what differs, with every regex compiled once instead
+    of on each fallback. A target the profile has no selectors for uses the
+    global ones, and so does a target with a 'selector-*' override.
+    """
+
+    def __init__(self, name, total_pattern, meter_id_pattern, datetime_format,
+                 domains=(), selectors=None, detect=None):
+        self.name = name
+        self.domains = tuple(domains)
+        self.selectors = {
+            target: _parse_selectors(spec) for target, spec in (selectors or {}).items()
+        }
+        self.total_re = re.compile(total_pattern, re.IGNORECASE)
+        self.meter_id_re = re.compile(meter_id_pattern, re.IGNORECASE)
+        self.datetime_format = datetime_format
+        self.timestamp_re = re.compile(_format_to_regex(self.datetime_format), re.IGNORECASE)
+        try:
+            self._fields_re = re.compile(_format_to_regex(self.datetime_format, named=True))
+        except re.error:  # a field used twice, strptime has to do it
+            self._fields_re = None
+        if re.search(r'%[^HMSdmYy]', self.datetime_format):
+            self._fields_re = None
+        self.detect = re.compile(detect, re.IGNORECASE) if detect else None
+
+    def candidates(self, target):
+        if target in self.selectors and target not in _overridden_selectors:
+            return self.selectors[target]
+        return SELECTORS[target]
+
+    def matches_domain(self, host):
+        return any(host == domain or host.endswith(f'.{domain}') for domain in self.domains)
+
+    def parse_timestamp(self, text):
+        """strptime(text, datetime_format), without strptime's overhead."""
+        match = self._fields_re.fullmatch(text.strip()) if self._fields_re else None
+        if match is None:
+            return datetime.strptime(text.strip(), self.datetime_format)
+        fields = match.groupdict()
+        if 'y' in fields:  # strptime's pivot: 69-99 is the 1900s
+            year = int(fields['y'])
+            fields['Y'] = year + (1900 if year >= 69 else 2000)
+        return datetime(int(fields.get('Y', 1900)), int(fields.get('m', 1)),
+                        int(fields.get('d', 1)), int(fields.get('H', 0)),
+                        int(fields.get('M', 0)), int(fields.get('S', 0)))
+
+
+_overridden_selectors = {name for name in _DEFAULT_SELECTORS if env.str(f'selector-{name}', None)}
 
 
-def find(page, target, timeout=None):
+_PROFILE_KEYS = ('domains', 'selectors', 'detect', 'total_pattern', 'meter_id_pattern',
+                 'datetime_format')
+
+
+def _load_profiles(**defaults):
+    """The built-in profile, plus the ones from 'site-profiles-file'.
+
+    `defaults` replaces the global patterns and date format, for a reload.
+    """
+    # what a profile leaves out is taken from the global settings
+    defaults = {
+        'total_pattern': total_pattern,
+        'meter_id_pattern': meter_id_pattern,
+        'datetime_format': datetime_format,
+        **defaults,
+    }
+    profiles = {'minvandforsyning': SiteProfile('minvandforsyning',
+                                                domains=['minvandforsyning.dk'], **defaults)}
+    if site_profiles_file:
+        with open(site_profiles_file, encoding='utf-8') as handle:
+            for name, spec in loads(handle.read()).items():
+                unknown = sorted(set(spec) - set(_PROFILE_KEYS))
+                if unknown:
+                    raise ValueError(f"Unknown key '{unknown[0]}' in profile '{name}' of "
+                                     f"{site_profiles_file}, use any of {', '.join(_PROFILE_KEYS)}")
+                profiles[name] = SiteProfile(name, **{**defaults, **spec})
+    return profiles
+
+
+PROFILES = _load_profiles()
+if site_profile != 'auto' and site_profile not in PROFILES:
+    log.warning("Unknown site-profile '%s', picking one automatically. Choose one of %s",
+                site_profile, ', '.join(PROFILES))
+    site_profile = 'auto'
+_detected_profile = None
+
+
+def current_profile(page=None):
+    """The profile of this portal: configured, picked by domain, or detected.
+
+    Detection looks for the 'detect' regex of each profile in the page text,
+    so it needs the dashboard. The answer is cached for the next runs.
+    """
+    global _detected_profile
+    if site_profile != 'auto':
+        return PROFILES[site_profile]
+    if _detected_profile is not None:
+        return _detected_profile
+    from urllib.parse import urlparse
+    host = urlparse(login_url).hostname or ''
+    by_domain = [profile for profile in PROFILES.values() if profile.matches_domain(host)]
+    if len(by_domain) == 1:
+        return by_domain[0]
+    if page is not None:
+        text = _body_text(page)
+        for profile in by_domain or PROFILES.values():
+            if profile.detect and profile.detect.search(text):
+                log.info("Detected the '%s' site profile", profile.name)
+                _detected_profile = profile
+                return profile
+    return (by_domain or list(PROFILES.values()))[0]
+
+
+def find(page, target, timeout=None, profile=None, deadline=None):
     """Return the first candidate selector for `target` that is on the page.
 
     Playwright locators resolve on every use, so the returned locator does not
     go stale when blazor re-renders the element underneath it.
     """
-    timeout = element_timeout if timeout is None else timeout
-    selectors = SELECTORS[target]
+    deadline = deadline or _no_deadline
+    timeout = deadline.limit(element_timeout if timeout is None else timeout)
+    selectors = (profile or current_profile()).candidates(target)
     # Split the budget so one dead selector cannot eat the whole timeout
-    per_selector = max(2, timeout // max(1, len(selectors))) * 1000
+    per_selector = max(2, timeout // max(1, len(selectors)))
 
     for index, selector in enumerate(selectors):
         locator = page.locator(selector).first
         try:
-            locator.wait_for(state='visible', timeout=per_selector)
+            locator.wait_for(state='visible', timeout=deadline.limit(per_selector) * 1000)
         except (PlaywrightTimeoutError, PlaywrightError):
             continue
         if index > 0:
@@ -190,13 +524,16 @@ def find(page, target, timeout=None):
     )
 
 
-def click(page, target, timeout=None):
+def click(page, target, timeout=None, profile=None, deadline=None):
     """Click `target`. Playwright waits for it to be actionable by itself."""
-    find(page, target, timeout=timeout).click(timeout=element_timeout * 1000)
+    deadline = deadline or _no_deadline
+    locator = find(page, target, timeout=timeout, profile=profile, deadline=deadline)
+    locator.click(timeout=deadline.limit(element_timeout) * 1000)
 
 
-def get_text(page, target, timeout=None):
-    return find(page, target, timeout=timeout).inner_text().strip()
+def get_text(page, target, timeout=None, profile=None, deadline=None):
+    return find(page, target, timeout=timeout, profile=profile,
+                deadline=deadline).inner_text().strip()
 
 
 def _parse_decimal(value):
@@ -224,41 +561,60 @@ def _body_text(page):
 
 
 def _text_fallback(body_text, pattern, target):
-    match = re.search(pattern, body_text, re.IGNORECASE)
+    match = pattern.search(body_text)
     if not match:
         return None
     log.warning("Read '%s' from the page text instead of an element", target)
     return match.group(1) if match.groups() else match.group(0)
 
 
-def read_values(page, timeout=None):
+def read_values(page, timeout=None, deadline=None):
     """Read total, meter id and timestamp, falling back to page text."""
     timeout = dashboard_timeout if timeout is None else timeout
+    profile = None
+    body = []
+
+    def body_text():
+        # fetched once, however many values need it
+        if not body:
+            body.append(_body_text(page))
+        return body[0]
 
     try:
-        total = _parse_decimal(get_text(page, 'total', timeout=timeout))
+        total = _parse_decimal(get_text(page, 'total', timeout=timeout,
+                                        profile=current_profile(), deadline=deadline))
+        # the dashboard is there now, so an unknown portal can be detected
+        profile = current_profile(page)
     except (ElementNotFoundError, ValueError):
-        raw = _text_fallback(_body_text(page), total_pattern, 'total')
+        profile = current_profile(page)
+        raw = _text_fallback(body_text(), profile.total_re, 'total')
         if raw is None:
             raise
         total = _parse_decimal(raw)
 
     try:
-        meter_id = int(re.sub(r'\D', '', get_text(page, 'meter-id')))
+        meter_id = int(re.sub(r'\D', '', get_text(page, 'meter-id', profile=profile,
+                                                      deadline=deadline)))
     except (ElementNotFoundError, ValueError):
-        raw = _text_fallback(_body_text(page), meter_id_pattern, 'meter-id')
+        raw = _text_fallback(body_text(), profile.meter_id_re, 'meter-id')
         if raw is None:
             raise
         meter_id = int(raw)
 
     try:
-        timestamp = datetime.strptime(get_text(page, 'timestamp'), datetime_format)
+        timestamp = profile.parse_timestamp(get_text(page, 'timestamp', profile=profile,
+                                                             deadline=deadline))
     except (ElementNotFoundError, ValueError):
-        raw = _text_fallback(_body_text(page), _format_to_regex(datetime_format), 'timestamp')
+        raw = _text_fallback(body_text(), profile.timestamp_re, 'timestamp')
         if raw is None:
             raise
-        timestamp = datetime.strptime(raw, datetime_format)
+        timestamp = profile.parse_timestamp(raw)
+
+    return _reading(total, meter_id, timestamp)
+
 
+def _reading(total, meter_id, timestamp):
+    """The message we publish, whichever way the values were read."""
     return {
         "total": total,
         "meter_id": meter_id,
@@ -269,39 +625,535 @@ def read_values(page, timeout=None):
     }
 
 
+class DiagnosticsWriter:
+    """Write diagnostics on a background thread, so a failed attempt can retry at once.
+
+    Html is gzipped, and a page that looks exactly like one already on disk is
+    not written again: a layout change fails every run the same way. After every
+    write the oldest files go until the directory is within 'debug-max-size'
+    and 'debug-max-age'. Only files the scraper wrote are ever deleted. A run
+    process writes nothing itself, it sends what it captured to the writer of
+    the parent, so the attempt is over as soon as it failed.
+    """
+
+    _OURS = re.compile(r'^\d{8}-\d{6}-')
+
+    def __init__(self):
+        self._queue = None
+        self._snapshots = {}
+
+    def _start(self):
+        from queue import Queue
+        self._queue = Queue()
+        Thread(target=self._run, name='diagnostics-writer', daemon=True).start()
+
+    def submit(self, task, *args):
+        if _progress is not None:  # in a run process
+            _progress.send(('diagnostics', task.__name__, args))
+            return
+        if self._queue is None:
+            self._start()
+        self._queue.put((task, args))
+
+    def flush(self):
+        """Wait until everything submitted is on disk."""
+        if self._queue is not None:
+            self._queue.join()
+
+    def _run(self):
+        while True:
+            task, args = self._queue.get()
+            try:
+                self._prune(task(*args))
+            except Exception as error:  # diagnostics must never break the run
+                log.warning("Could not write diagnostics: %s", error)
+            finally:
+                self._queue.task_done()
+
+    def write_page(self, base, html, png):
+        from gzip import open as gzip_open
+        from hashlib import sha256
+        from os import makedirs
+        from os.path import dirname, exists
+        makedirs(dirname(base), exist_ok=True)
+        digest = (dirname(base), sha256(html.encode('utf-8')).hexdigest())
+        same = self._snapshots.get(digest)
+        if same and exists(same):
+            log.info("The page is the same as in %s, not writing it again", same)
+            return dirname(base)
+        with gzip_open(f'{base}.html.gz', 'wt', encoding='utf-8') as handle:
+            handle.write(html)
+        if png is not None:
+            with open(f'{base}.png', 'wb') as handle:
+                handle.write(png)
+        self._snapshots[digest] = f'{base}.html.gz'
+        log.info("Wrote diagnostics to %s.html.gz / %s.png", base, base)
+        return dirname(base)
+
+    def move_trace(self, source, target):
+        from os import makedirs
+        from os.path import dirname
+        from shutil import move
+        makedirs(dirname(target), exist_ok=True)
+        move(source, target)
+        log.info("Wrote a playwright trace to %s, open it on https://trace.playwright.dev",
+                 target)
+        return dirname(target)
+
+    def _prune(self, directory):
+        from os import listdir, remove, stat
+        from os.path import join
+        from time import time
+        files = []
+        for name in listdir(directory):
+            if self._OURS.match(name):
+                path = join(directory, name)
+                info = stat(path)
+                files.append((info.st_mtime, info.st_size, path))
+        files.sort()
+        too_old = time() - debug_max_age * 24 * 60 * 60
+        total = sum(size for _, size, _ in files)
+        for modified, size, path in files:
+            if modified >= too_old and total <= debug_max_size * 1024 * 1024:
+                break
+            remove(path)
+            total -= size
+            log.debug("Removed old diagnostics %s", path)
+
+
+_diagnostics = DiagnosticsWriter()
+
+
 def dump_diagnostics(page, name):
-    """Save the page so a layout change can be inspected afterwards."""
+    """Save the page so a layout change can be inspected afterwards.
+
+    Only the capture happens here, the writing is left to the background writer.
+    """
     if not debug_dir or page is None:
         return
-    from os import makedirs
     from os.path import join
     try:
-        makedirs(debug_dir, exist_ok=True)
         stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
-        base = join(debug_dir, f'{stamp}-{name}')
-        with open(f'{base}.html', 'w', encoding='utf-8') as handle:
-            handle.write(page.content())
-        page.screenshot(path=f'{base}.png', full_page=True)
-        log.info("Wrote diagnostics to %s.html / %s.png", base, base)
+        html = page.content()
+        png = page.screenshot(full_page=True)
+        _diagnostics.submit(_diagnostics.write_page, join(debug_dir, f'{stamp}-{name}'),
+                            html, png)
     except Exception as error:  # diagnostics must never break the run
         log.warning("Could not write diagnostics: %s", error)
 
 
+def _browser_profiles():
+    """Chromium flags and context options per 'browser-profile'."""
+    return {
+        'default': {
+            # /dev/shm is small in most containers, and chromium crashes without this
+            'args': ['--disable-dev-shm-usage'],
+            'context': {},
+        },
+        # A raspberry pi with 1 GB has no memory to spare for what a desktop
+        # browser does in the background. The site is one tab, so one renderer
+        # process and no site isolation is all it needs.
+        'low-memory': {
+            'args': [
+                '--disable-dev-shm-usage',
+                '--renderer-process-limit=1',
+                '--disable-site-isolation-trials',
+                '--disable-features=site-per-process,Translate,BackForwardCache,MediaRouter',
+                '--disable-gpu',
+                '--disable-extensions',
+                '--disable-background-networking',
+                '--disable-component-update',
+                '--disable-default-apps',
+                '--disable-sync',
+                '--mute-audio',
+                '--disk-cache-size=1048576',
+                '--media-cache-size=1048576',
+                f'--js-flags=--max-old-space-size={browser_js_heap}',
+            ],
+            # a small window means small bitmaps to render and keep around
+            'context': {'viewport': {'width': 800, 'height': 600}, 'device_scale_factor': 1},
+        },
+    }
+
+
+def _selected_profile():
+    profiles = _browser_profiles()
+    if browser_profile not in profiles:
+        log.warning("Unknown browser-profile '%s', using the default one. Choose "
+                    "one of %s", browser_profile, ', '.join(profiles))
+        return profiles['default']
+    return profiles[browser_profile]
+
+
+class CdpPool:
+    """Remote chromes to run the browser on, the least busy healthy one first.
+
+    Before a run every endpoint is asked for '/json/version' (is it up, and how
+    fast) and '/json/list' (how many pages it has open). The healthy ones are
+    tried least loaded and fastest first; one that fails to connect is skipped
+    for a minute. Connect times are kept per endpoint and logged.
+    """
+
+    COOLDOWN = 60
+
+    def __init__(self, urls, probe_timeout=2):
+        self.urls = list(urls)
+        self.probe_timeout = probe_timeout
+        self.stats = {url: {'connects': 0, 'failures': 0, 'latency_ms': None,
+                            'down_until': float('-inf')} for url in self.urls}
+        self.connected = None
+
+    def _get(self, url, path):
+        from urllib.request import urlopen
+        with urlopen(f"{url.rstrip('/')}{path}", timeout=self.probe_timeout) as response:
+            return loads(response.read().decode('utf-8'))
+
+    def probe(self, url):
+        """(open pages, milliseconds to answer), or None when it is down."""
+        started = monotonic()
+        try:
+            self._get(url, '/json/version')
+            elapsed = (monotonic() - started) * 1000
+            pages = sum(1 for target in self._get(url, '/json/list')
+                        if target.get('type') == 'page')
+        except (OSError, ValueError, AttributeError) as error:
+            log.debug("Remote browser %s is down: %s", url, error)
+            return None
+        return pages, elapsed
+
+    def candidates(self):
+        """The healthy endpoints, least loaded and then fastest first."""
+        now = monotonic()
+        healthy = []
+        for index, url in enumerate(self.urls):
+            if self.stats[url]['down_until'] > now:
+                continue
+            probe = self.probe(url)
+            if probe is not None:
+                healthy.append((probe[0], probe[1], index, url))
+        return [url for *_, url in sorted(healthy)]
+
+    def _record(self, url, elapsed=None):
+        stats = self.stats[url]
+        if elapsed is None:
+            stats['failures'] += 1
+            stats['down_until'] = monotonic() + self.COOLDOWN
+            return
+        stats['connects'] += 1
+        previous = stats['latency_ms']
+        # a moving average, so one slow connect does not count for long
+        stats['latency_ms'] = elapsed if previous is None else 0.7 * previous + 0.3 * elapsed
+
+    def merge(self, stats):
+        """Take over the numbers a run process came back with."""
+        for url, theirs in stats.items():
+            ours = self.stats.get(url)
+            if ours is None:
+                continue
+            # a run starts from our numbers, so the larger ones are the newer ones
+            if theirs['connects'] > ours['connects']:
+                ours['latency_ms'] = theirs['latency_ms']
+            for key in ('connects', 'failures', 'down_until'):
+                ours[key] = max(ours[key], theirs[key])
+
+    def connect(self, playwright):
+        """A browser on the best endpoint, our own chromium when none is left."""
+        self.connected = None
+        for url in self.candidates():
+            started = monotonic()
+            try:
+                browser = playwright.chromium.connect_over_cdp(url)
+            except PlaywrightError as error:
+                log.warning("Could not connect to the remote browser %s, trying the next: %s",
+                            url, error)
+                self._record(url)
+                continue
+            self._record(url, (monotonic() - started) * 1000)
+            stats = self.stats[url]
+            log.info("Using the remote browser %s (connect %.0f ms, %s connects, %s failures)",
+                     url, stats['latency_ms'], stats['connects'], stats['failures'])
+            self.connected = url
+            return browser
+        if not browser_cdp_fallback:
+            raise PlaywrightError(f"None of the remote browsers is up: {', '.join(self.urls)}")
+        log.warning("None of the remote browsers is up, launching our own")
+        return None
+
+
+_cdp_pools = {}
+
+
+def cdp_pool():
+    """The pool for the configured remote browsers, None when there are none."""
+    if not browser_cdp_url:
+        return None
+    if browser_cdp_url not in _cdp_pools:  # built once, so its numbers last
+        _cdp_pools[browser_cdp_url] = CdpPool(
+            url.strip() for url in browser_cdp_url.split(',') if url.strip())
+    return _cdp_pools[browser_cdp_url]
+
+
 def open_browser(playwright):
     """Launch our own chromium, or attach to a remote one when configured."""
-    if browser_cdp_url:
-        return playwright.chromium.connect_over_cdp(browser_cdp_url)
+    pool = cdp_pool()
+    if pool is not None:
+        browser = pool.connect(playwright)
+        if browser is not None:
+            return browser
     return playwright.chromium.launch(
         headless=headless,
         executable_path=browser_executable,
-        # /dev/shm is small in most containers, and chromium crashes without this
-        args=['--disable-dev-shm-usage'],
+        args=_selected_profile()['args'],
     )
 
 
-def publish_message(topic, message, retries=None, retain=False):
+def _context_options(recorder=None):
+    options = dict(_selected_profile()['context'])
+    if recorder:
+        options.update(recorder.context_options())
+    return options
+
+
+class BrowserMemoryError(Exception):
+    """Raised when the browser went over 'browser-memory-budget' and was killed."""
+
+
+try:
+    _PAGE_SIZE = sysconf('SC_PAGE_SIZE')  # arm64 kernels do not all use 4k pages
+except (AttributeError, OSError, ValueError):
+    _PAGE_SIZE = 4096
+
+
+def _process_table():
+    """pid -> (parent pid, command name) for every process we can see."""
+    from os import listdir
+    table = {}
+    try:
+        entries = listdir('/proc')
+    except OSError:  # not linux, nothing to measure
+        return table
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat', encoding='utf-8', errors='replace') as handle:
+                stat = handle.read()
+        except OSError:  # the process is already gone
+            continue
+        # the command name is in parentheses and can contain spaces itself
+        name = stat[stat.index('(') + 1:stat.rindex(')')]
+        parent = int(stat[stat.rindex(')') + 2:].split()[1])
+        table[int(entry)] = (parent, name)
+    return table
+
+
+def _rss(pid):
+    """Resident memory of a process in bytes, 0 when it is gone."""
+    try:
+        with open(f'/proc/{pid}/statm', encoding='ascii') as handle:
+            return int(handle.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+def browser_processes(root=None):
+    """Every process started below this one: the playwright driver and chromium."""
+    table = _process_table()
+    children = {}
+    for pid, (parent, name) in table.items():
+        children.setdefault(parent, []).append(pid)
+    found, pending = {}, [root or getpid()]
+    while pending:
+        for child in children.get(pending.pop(), []):
+            found[child] = table[child][1]
+            pending.append(child)
+    return found
+
+
+def _is_chromium(name):
+    return 'chrom' in name.lower() or 'headless_shell' in name.lower()
+
+
+class MemoryMonitor:
+    """Follow the memory of the browser process tree while a run is going.
+
+    The peak is logged when the run is over. With a budget, a browser that
+    goes over it is killed: the playwright call waiting on it fails, and
+    scrape retries the run with a fresh browser.
+    """
+
+    def __init__(self, budget_mb=0, interval=0.5):
+        self.budget = budget_mb * 1024 * 1024
+        self.interval = interval
+        self.peak = 0
+        self.exceeded = False
+        self._stop = Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = Thread(target=self._run, name='memory-monitor', daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        processes = browser_processes()
+        rss = sum(_rss(pid) for pid in processes)
+        self.peak = max(self.peak, rss)
+        if self.budget and rss > self.budget and not self.exceeded:
+            self.exceeded = True
+            log.warning("The browser uses %.0f MB, more than the budget of %.0f MB. "
+                        "Killing it", rss / 2 ** 20, self.budget / 2 ** 20)
+            for pid, name in processes.items():
+                if _is_chromium(name):
+                    try:
+                        kill(pid, SIGKILL)
+                    except OSError:
+                        pass
+        return rss
+
+    def stop(self):
+        """Stop sampling and return the peak in bytes."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.sample()
+        if self.peak:
+            log.info("Browser peak memory: %.0f MB", self.peak / 2 ** 20)
+        return self.peak
+
+
+# The site is a Blazor Server app: the page itself is plain http, but everything
+# after the first render travels over the '_blazor' websocket. A recording needs
+# both, playwright's HAR only holds the http part.
+_BLAZOR_SOCKET = re.compile(r'/_blazor')
+_RECORDED_HAR = 'session.har'
+_RECORDED_FRAMES = 'websocket.jsonl'
+
+
+class SessionRecorder:
+    """Record the http exchanges and the blazor frames of one run.
+
+    The HAR is written by playwright when the context closes, the frames are
+    collected here. Both only replace the previous recording when the run
+    succeeded, so a replay always has a complete session to work with.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.frames = []
+        self.sockets = 0
+        self.succeeded = False
+
+    @property
+    def har_path(self):
+        from os.path import join
+        return join(self.directory, f'recording-{_RECORDED_HAR}')
+
+    def context_options(self):
+        from os import makedirs
+        makedirs(self.directory, exist_ok=True)
+        return {'record_har_path': self.har_path, 'record_har_content': 'embed'}
+
+    def attach(self, websocket):
+        """page.on('websocket') handler, keeps the frames of the blazor circuit."""
+        if not _BLAZOR_SOCKET.search(websocket.url):
+            return
+        socket = self.sockets
+        self.sockets += 1
+        websocket.on('framesent', lambda payload: self._add(socket, 'sent', payload))
+        websocket.on('framereceived', lambda payload: self._add(socket, 'received', payload))
+
+    def _add(self, socket, direction, payload):
+        frame = {'socket': socket, 'dir': direction}
+        if isinstance(payload, bytes):
+            frame['binary'] = b64encode(payload).decode('ascii')
+        else:
+            frame['text'] = payload
+        self.frames.append(frame)
+
+    def finish(self):
+        """Keep the recording of a successful run, throw away a failed one."""
+        from os import remove, replace
+        from os.path import exists, join
+        try:
+            if not self.succeeded:
+                if exists(self.har_path):
+                    remove(self.har_path)
+                return
+            replace(self.har_path, join(self.directory, _RECORDED_HAR))
+            with open(join(self.directory, _RECORDED_FRAMES), 'w', encoding='utf-8') as handle:
+                for frame in self.frames:
+                    handle.write(dumps(frame) + '\n')
+            log.info("Recorded the session (%s websocket frames) to %s",
+                     len(self.frames), self.directory)
+        except Exception as error:  # a recording must never break the run
+            log.warning("Could not write the recording: %s", error)
+
+
+def _frame_payload(frame):
+    if 'binary' in frame:
+        return b64decode(frame['binary'])
+    return frame['text']
+
+
+def load_recorded_sockets(directory):
+    """The recorded frames, as one list per websocket in the order they opened."""
+    from os.path import join
+    sockets = {}
+    with open(join(directory, _RECORDED_FRAMES), encoding='utf-8') as handle:
+        for line in handle:
+            if line.strip():
+                frame = loads(line)
+                sockets.setdefault(frame['socket'], []).append(frame)
+    return [sockets[socket] for socket in sorted(sockets)]
+
+
+class SocketReplay:
+    """route_web_socket handler that plays the recorded server side back.
+
+    Every websocket the page opens gets the next recorded one. The recorded
+    server frames are sent in order, and wherever the page sent something in
+    the recording, the replay waits for the page to send a message first. The
+    content of the page's messages is not compared: ids and timestamps differ
+    between runs, the order of the conversation does not.
+    """
+
+    def __init__(self, sockets):
+        self.sockets = list(sockets)
+
+    def __call__(self, route):
+        pending = deque(self.sockets.pop(0) if self.sockets else [])
+
+        def flush():
+            while pending and pending[0]['dir'] == 'received':
+                route.send(_frame_payload(pending.popleft()))
+
+        def on_message(message):
+            if pending and pending[0]['dir'] == 'sent':
+                pending.popleft()
+            flush()
+
+        route.on_message(on_message)
+        flush()
+
+
+def replay_session(context, directory):
+    """Serve a recorded session to the browser, nothing reaches the network."""
+    from os.path import join
+    context.route_from_har(join(directory, _RECORDED_HAR), not_found='abort')
+    context.route_web_socket(_BLAZOR_SOCKET, SocketReplay(load_recorded_sockets(directory)))
+    log.info("Replaying the recorded session in %s instead of the site", directory)
+
+
+def publish_message(topic, message, retries=None, retain=False, deadline=None):
     """Publish to MQTT, retrying transient broker/network errors."""
     retries = mqtt_retries if retries is None else retries
+    deadline = deadline or _no_deadline
     for attempt in range(1, retries + 1):
         try:
             publish(topic, message, hostname=mqtt_broker, port=mqtt_port,
@@ -311,7 +1163,12 @@ def publish_message(topic, message, retries=None, retain=False):
             log.warning("Can't connect to mqtt server (attempt %s/%s): %s",
                         attempt, retries, error)
             if attempt < retries:
-                sleep(min(30, 2 ** attempt))
+                delay = min(30, 2 ** attempt)
+                remaining = deadline.remaining()
+                if remaining is not None and remaining < delay:
+                    log.warning("Not enough time left in the run to try mqtt again")
+                    break
+                sleep(delay)
     return False
 
 
@@ -320,12 +1177,23 @@ def publish_status(status):
         publish_message(mqtt_status_topic, status, retries=1, retain=True)
 
 
-def discovery_config(meter_id):
-    """Home Assistant mqtt discovery config, one entry per entity.
+_DISCOVERY_FORMATS = ('entity', 'device')
+if discovery_format not in _DISCOVERY_FORMATS:
+    log.warning("Unknown mqtt-discovery-format '%s', using 'entity'. Choose one of %s",
+                discovery_format, ', '.join(_DISCOVERY_FORMATS))
+    discovery_format = 'entity'
+
+
+def discovery_config(meter_id, layout=None):
+    """Home Assistant mqtt discovery config as (topic, payload) pairs.
 
     See https://www.home-assistant.io/integrations/mqtt/#mqtt-discovery. The
-    payloads are retained so the entities survive a Home Assistant restart.
+    'entity' format has one pair per entity, the 'device' format a single one
+    that declares every entity as a component of the device. `layout` is one
+    of those, 'mqtt-discovery-format' when not given. The payloads are
+    retained so the entities survive a Home Assistant restart.
     """
+    layout = layout or discovery_format
     node_id = f'minvandforsyning_{meter_id}'
     device = {
         "identifiers": [node_id],
@@ -373,84 +1241,1258 @@ def discovery_config(meter_id):
             "icon": "mdi:counter",
         },
     }
+    if usage_sensors:
+        for window, name in (('hour', 'Last hour'), ('day', 'Last 24 hours'),
+                             ('month', 'Last 30 days')):
+            entities[f'usage_{window}'] = {
+                "name": f"Used {name.lower()}",
+                "unique_id": f'{node_id}_usage_{window}',
+                "state_topic": mqtt_usage_topic,
+                "state_class": "measurement",
+                "unit_of_measurement": "m³",
+                "value_template": f"{{{{ value_json.{window} }}}}",
+                "icon": "mdi:water-outline",
+            }
+        entities['flow'] = {
+            "name": "Average flow",
+            "unique_id": f'{node_id}_flow',
+            "state_topic": mqtt_usage_topic,
+            "device_class": "volume_flow_rate",
+            "state_class": "measurement",
+            "unit_of_measurement": "L/min",
+            "value_template": "{{ value_json.flow }}",
+        }
+
+    if leak_detection:
+        entities['leak'] = {
+            "platform": "binary_sensor",
+            "name": "Leak",
+            "unique_id": f'{node_id}_leak',
+            "state_topic": mqtt_leak_topic,
+            "device_class": "problem",
+            "value_template": "{{ 'ON' if value_json.leak or value_json.spike else 'OFF' }}",
+            "json_attributes_topic": mqtt_leak_topic,
+        }
+
+    if mqtt_commands:
+        entities['read_now'] = {
+            "platform": "button",
+            "name": "Read now",
+            "unique_id": f'{node_id}_read_now',
+            "command_topic": mqtt_command_topic,
+            "payload_press": "scrape",
+            "icon": "mdi:refresh",
+        }
+
+    if layout == 'device':
+        # a component inherits what the device has, and a button has no state
+        state_topic = shared.pop('state_topic')
+        components = {}
+        for object_id, config in entities.items():
+            component = {"platform": "sensor", **config}
+            if component['platform'] != 'button':
+                component.setdefault('state_topic', state_topic)
+            components[object_id] = component
+        return [(f'{discovery_prefix}/device/{node_id}/config',
+                 {**shared, "components": components})]
+    configs = []
+    for object_id, config in entities.items():
+        config = dict(config)
+        platform = config.pop('platform', 'sensor')
+        common = dict(shared)
+        if platform == 'button':  # a button has no state
+            del common['state_topic']
+        configs.append((f'{discovery_prefix}/{platform}/{node_id}/{object_id}/config',
+                        {**common, **config}))
+    return configs
+
+
+_DISCOVERY_STATE = 'discovery.json'
+
+
+def _load_discovery_state():
+    """meter id -> digest of the config announced before a restart, from state-dir."""
+    from os.path import join
+    if not state_dir:
+        return {}
+    try:
+        with open(join(state_dir, _DISCOVERY_STATE), encoding='utf-8') as handle:
+            return {int(meter_id): digest for meter_id, digest in loads(handle.read()).items()}
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError, AttributeError) as error:
+        log.warning("Ignoring the discovery state in %s: %s", state_dir, error)
+        return {}
+
+
+def _save_discovery_state():
+    from os import makedirs, replace
+    from os.path import join
+    if not state_dir:
+        return
+    _discovery_state.update(_announced_meters)
+    path = join(state_dir, _DISCOVERY_STATE)
+    try:
+        makedirs(state_dir, exist_ok=True)
+        # a crash half way through the write must not leave a broken file behind
+        with open(f'{path}.tmp', 'w', encoding='utf-8') as handle:
+            handle.write(dumps({str(meter_id): digest
+                                for meter_id, digest in sorted(_discovery_state.items())}))
+        replace(f'{path}.tmp', path)
+    except OSError as error:
+        log.warning("Could not save the discovery state: %s", error)
+
+
+_discovery_state = _load_discovery_state()
+
+
+def _discovery_digest(configs):
+    from hashlib import sha256
+    return sha256(dumps(configs, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def mqtt_client(purpose):
+    """A paho client of our own, for what needs more than publishing a message."""
+    from paho.mqtt.client import CallbackAPIVersion, Client
+    # a broker disconnects a client when another connects with its id, so every
+    # client of every replica and run process gets one of its own
+    client = Client(CallbackAPIVersion.VERSION2,
+                    client_id=f'{mqtt_client_id}-{purpose}-{uuid4().hex[:8]}')
+    if mqtt_auth:
+        client.username_pw_set(mqtt_auth['username'], mqtt_auth['password'])
+    return client
 
-    return [
-        (f'{discovery_prefix}/sensor/{node_id}/{object_id}/config', {**shared, **config})
-        for object_id, config in entities.items()
-    ]
 
+def retained_messages(topics, wait=2.0):
+    """The payloads the broker holds retained for `topics`, topic -> text.
 
-def publish_discovery(meter_id):
-    """Announce the entities to Home Assistant. Only needed once per meter."""
-    if not mqtt_discovery or meter_id in _announced_meters:
+    The broker sends the retained messages right after the subscription, so
+    whatever has not arrived after `wait` seconds is not there.
+    """
+    found = {}
+    complete = Event()
+
+    def on_connect(client, userdata, flags, reason_code, properties):
+        client.subscribe([(topic, 0) for topic in topics])
+
+    def on_message(client, userdata, message):
+        if message.retain:
+            found[message.topic] = message.payload.decode('utf-8', errors='replace')
+        if len(found) == len(topics):
+            complete.set()
+
+    client = mqtt_client('verify')
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.connect(mqtt_broker, mqtt_port)
+    client.loop_start()
+    try:
+        complete.wait(wait)
+    finally:
+        client.disconnect()
+        client.loop_stop()
+    return found
+
+
+def publish_discovery(meter_id, deadline=None):
+    """Announce the entities to Home Assistant, when they are not announced already.
+
+    What was announced is remembered as a digest per meter, in state-dir when
+    that is set, so a restart does not announce everything again and a changed
+    config (another device-name, say) is announced on the next run. With
+    'mqtt-discovery-verify' the retained configs on the broker are compared
+    instead of trusting the state file, and only what differs is published.
+    """
+    if not mqtt_discovery:
         return
-    for topic, config in discovery_config(meter_id):
-        if not publish_message(topic, dumps(config), retain=True):
+    configs = discovery_config(meter_id)
+    digest = _discovery_digest(configs)
+    if _announced_meters.get(meter_id) == digest:
+        return
+    if not mqtt_discovery_verify and _discovery_state.get(meter_id) == digest:
+        log.debug("Meter %s was announced before the restart", meter_id)
+        _announced_meters[meter_id] = digest
+        return
+
+    payloads = [(topic, dumps(config)) for topic, config in configs]
+    # after a switch of 'mqtt-discovery-format' the configs of the other format
+    # are still retained, and Home Assistant would show every entity twice
+    other = discovery_config(meter_id, 'entity' if discovery_format == 'device' else 'device')
+    cleared = [(topic, '') for topic, _ in other]
+    announced = _announced_meters.get(meter_id) or _discovery_state.get(meter_id)
+    stale = cleared if announced == _discovery_digest(other) else []
+    if mqtt_discovery_verify:
+        try:
+            retained = retained_messages([topic for topic, _ in cleared + payloads])
+        except OSError as error:
+            log.warning("Could not read the discovery config on the broker: %s", error)
+            payloads = stale + payloads
+        else:
+            # what is there of the other format goes, whatever the state file says
+            payloads = [(topic, payload) for topic, payload in cleared + payloads
+                        if retained.get(topic, '') != payload]
+    else:
+        payloads = stale + payloads
+
+    for topic, payload in payloads:
+        if not publish_message(topic, payload, retain=True, deadline=deadline):
             log.warning("Could not publish the discovery config to %s", topic)
             return
-    _announced_meters.add(meter_id)
-    log.info("Announced meter %s to Home Assistant on %s/sensor/minvandforsyning_%s/",
-             meter_id, discovery_prefix, meter_id)
+    _announced_meters[meter_id] = digest
+    _save_discovery_state()
+    if payloads:
+        log.info("Announced meter %s to Home Assistant on %s", meter_id,
+                 ', '.join(topic for topic, _ in payloads))
+    else:
+        log.info("Meter %s is already announced on the broker", meter_id)
+
+
+class RollingUsage:
+    """Water used in the last hour, day and 30 days, from the totals of one meter.
+
+    Each window is a deque of the readings inside it plus the one just before
+    it, which is what the usage is measured from. A reading only appends and
+    drops what fell out of the windows, so it is O(1) however long the
+    scraper runs. When the reading before a window is older than the window
+    (runs failed in between), the usage is scaled down to the window.
+    """
+
+    WINDOWS = {'hour': 60 * 60, 'day': 24 * 60 * 60, 'month': 30 * 24 * 60 * 60}
+
+    def __init__(self, samples=()):
+        self.windows = {window: deque() for window in self.WINDOWS}
+        for when, total in samples:
+            self.add(when, total)
+
+    @property
+    def last(self):
+        samples = self.windows['month']
+        return samples[-1] if samples else None
+
+    def add(self, when, total):
+        """Add a reading. False when it is the reading we already have."""
+        last = self.last
+        if last is not None and when <= last[0]:
+            return False
+        if last is not None and total < last[1]:  # a new meter starts from zero
+            for samples in self.windows.values():
+                samples.clear()
+        for window, seconds in self.WINDOWS.items():
+            samples = self.windows[window]
+            samples.append((when, total))
+            while len(samples) > 1 and samples[1][0] <= when - seconds:
+                samples.popleft()
+        return True
+
+    def usage(self):
+        """m³ used per window, and the average flow of the last day in L/min."""
+        when, total = self.last
+        usage = {}
+        for window, seconds in self.WINDOWS.items():
+            since, start = self.windows[window][0]
+            used = total - start
+            if when - since > seconds:
+                used = used * seconds / (when - since)
+            usage[window] = round(used, 3)
+        since, start = self.windows['day'][0]
+        minutes = (when - since) / 60
+        usage['flow'] = round((total - start) * 1000 / minutes, 3) if minutes else 0.0
+        return usage
+
+    def samples(self):
+        return list(self.windows['month'])
+
+
+_USAGE_STATE = 'usage.json'
+
+
+def _load_usage():
+    """meter id -> RollingUsage, from the readings kept in state-dir."""
+    from os.path import join
+    if not state_dir:
+        return {}
+    try:
+        with open(join(state_dir, _USAGE_STATE), encoding='utf-8') as handle:
+            return {int(meter_id): RollingUsage(samples)
+                    for meter_id, samples in loads(handle.read()).items()}
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError, TypeError, AttributeError) as error:
+        log.warning("Ignoring the usage history in %s: %s", state_dir, error)
+        return {}
+
+
+def _save_usage():
+    from os import makedirs, replace
+    from os.path import join
+    if not state_dir:
+        return
+    path = join(state_dir, _USAGE_STATE)
+    try:
+        makedirs(state_dir, exist_ok=True)
+        with open(f'{path}.tmp', 'w', encoding='utf-8') as handle:
+            handle.write(dumps({str(meter_id): usage.samples()
+                                for meter_id, usage in sorted(_usage.items())}))
+        replace(f'{path}.tmp', path)
+    except OSError as error:
+        log.warning("Could not save the usage history: %s", error)
+
+
+_usage = _load_usage()
+
+
+def publish_usage(values):
+    """Add the reading to the rolling usage of its meter and publish that. Never raises."""
+    if not usage_sensors:
+        return None
+    try:
+        meter_id = values['meter_id']
+        usage = _usage.setdefault(meter_id, RollingUsage())
+        when = datetime.fromisoformat(values['timestamp_iso']).timestamp()
+        if not usage.add(when, values['total']):
+            log.debug("The site shows the same reading as last time, usage is unchanged")
+            return None
+        _save_usage()
+        message = {'meter_id': meter_id, **usage.usage(),
+                   'timestamp_iso': values['timestamp_iso']}
+        if not publish_message(mqtt_usage_topic, dumps(message), retain=mqtt_retain):
+            log.warning("Could not publish the usage to mqtt")
+        return message
+    except Exception as error:  # the reading itself is published already
+        log.warning("Could not work out the usage: %s", error)
+        return None
+
+
+# Every reading of a meter is kept as two little-endian doubles, the time as unix
+# seconds and the total in m³, appended to 'history-<meter id>.bin' in state-dir.
+_HISTORY_RECORD = struct.Struct('<2d')
+_history = {}  # meter id -> readings, when there is no state-dir to keep them in
+_history_last = {}  # meter id -> time of the last reading kept
+
+
+def _history_path(meter_id):
+    from os.path import join
+    return join(state_dir, f'history-{meter_id}.bin')
+
+
+def record_history(meter_id, when, total):
+    """Keep a reading for the leak detection. False when it is the one we already have."""
+    from os import makedirs
+    from os.path import getsize
+    path = _history_path(meter_id) if state_dir else None
+    if meter_id not in _history_last and path:
+        try:
+            size = getsize(path) // _HISTORY_RECORD.size * _HISTORY_RECORD.size
+            if size:
+                with open(path, 'rb') as handle:
+                    handle.seek(size - _HISTORY_RECORD.size)
+                    _history_last[meter_id] = _HISTORY_RECORD.unpack(
+                        handle.read(_HISTORY_RECORD.size))[0]
+        except OSError:  # no history yet
+            pass
+    if when <= _history_last.get(meter_id, float('-inf')):
+        return False
+    _history_last[meter_id] = when
+    if not state_dir:
+        _history.setdefault(meter_id, []).append((when, total))
+        return True
+    makedirs(state_dir, exist_ok=True)
+    with open(path, 'ab') as handle:
+        handle.write(_HISTORY_RECORD.pack(when, total))
+    return True
+
+
+def load_history(meter_id):
+    """All readings of a meter as an (n, 2) array of time and total."""
+    import numpy as np
+    if not state_dir:
+        return np.array(_history.get(meter_id, []), dtype='<f8').reshape(-1, 2)
+    try:
+        readings = np.fromfile(_history_path(meter_id), dtype='<f8')
+    except (OSError, ValueError):
+        return np.empty((0, 2))
+    # a write cut short by a crash leaves half a record at the end
+    return readings[:len(readings) // 2 * 2].reshape(-1, 2)
+
+
+def _utc_offsets(times, timezone):
+    """The utc offset of `timezone` at each of `times`, in seconds.
+
+    The offset changes only twice a year, so it is looked up once a day, and
+    for every hour only on the days it changed.
+    """
+    import numpy as np
+    if timezone is None:
+        return np.zeros(len(times))
+
+    def offset(hour):
+        return datetime.fromtimestamp(int(hour) * 3600, timezone).utcoffset().total_seconds()
+
+    hours = np.floor_divide(times, 3600).astype(np.int64)
+    days, index = np.unique(hours // 24, return_inverse=True)
+    at_midnight = np.array([offset(day * 24) for day in days])
+    next_midnight = np.array([offset(day * 24 + 24) for day in days])
+    offsets = at_midnight[index]
+    for day in days[at_midnight != next_midnight]:
+        on_day = hours // 24 == day
+        offsets[on_day] = [offset(hour) for hour in hours[on_day]]
+    return offsets
+
+
+def analyse_history(readings, timezone=None):
+    """Look for a leak and for unusual use in the readings of one meter.
+
+    A leak is water that keeps running at night: the lowest hourly flow between
+    midnight and 5 is at least 'leak-min-flow' for 'leak-nights' nights in a row.
+    A spike is a last hour that used 'leak-spike-factor' times what the median
+    of that hour of the week is. Everything is done on whole arrays, so years of
+    hourly readings take milliseconds. The hours are those of the clock in
+    `timezone` at each reading, utc without one.
+    """
+    import numpy as np
+    times, totals = readings[:, 0], readings[:, 1]
+    order = np.argsort(times, kind='stable')
+    times, first = np.unique(times[order], return_index=True)
+    totals = totals[order][first]
+    result = {'leak': False, 'spike': False, 'night_flow': None, 'leak_nights': 0,
+              'flow': None, 'baseline': None, 'readings': int(len(times))}
+    if len(times) < 2:
+        return result
+
+    hours = np.diff(times) / 3600
+    flow = np.diff(totals) * 1000 / hours  # L/h of each interval
+    # a gap or a new meter says nothing about a single hour
+    valid = (hours > 0) & (hours <= 2) & (flow >= 0)
+    # the offset of every reading itself, summer and winter time both count from midnight
+    local = times[:-1] + _utc_offsets(times[:-1], timezone)
+    day = np.floor_divide(local, 86400).astype(np.int64)
+    hour = (np.mod(local, 86400) // 3600).astype(np.int64)
+
+    night = valid & (hour < 5)
+    if night.any():
+        nights, index = np.unique(day[night], return_inverse=True)
+        lowest = np.full(len(nights), np.inf)
+        np.minimum.at(lowest, index, flow[night])
+        result['night_flow'] = round(float(lowest[-1]), 2)
+        # nights in a row at the end with water running all night: the streak
+        # starts after the last dry night, and at the last night after a gap
+        gaps = np.flatnonzero(np.diff(nights, prepend=nights[0] - 2) != 1)
+        dry = np.flatnonzero(lowest < leak_min_flow)
+        streak = len(nights) - max(gaps[-1], dry[-1] + 1 if len(dry) else 0)
+        recent = nights[-1] >= day[-1] - 1
+        result['leak_nights'] = int(streak) if recent else 0
+        result['leak'] = bool(recent and streak >= leak_nights)
+
+    if valid[-1]:
+        # 1970-01-01 was a thursday, so monday is 0
+        week_hour = ((day + 3) % 7) * 24 + hour
+        latest = float(flow[-1])
+        result['flow'] = round(latest, 2)
+        past = valid.copy()
+        past[-1] = False
+        same = past & (week_hour == week_hour[-1])
+        if same.sum() >= 4:
+            baseline = float(np.median(flow[same]))
+            result['baseline'] = round(baseline, 2)
+            # below 10 L/h any use would look like a spike
+            result['spike'] = latest > leak_spike_factor * max(baseline, 10.0)
+    return result
+
+
+def publish_leak(values):
+    """Keep the reading, look for a leak in the history and publish that. Never raises."""
+    if not leak_detection:
+        return None
+    try:
+        meter_id = values['meter_id']
+        reading_time = datetime.fromisoformat(values['timestamp_iso'])
+        if not record_history(meter_id, reading_time.timestamp(), values['total']):
+            return None
+        result = analyse_history(load_history(meter_id), reading_time.tzinfo)
+        if result['leak']:
+            log.warning("Meter %s: water has been running for %s nights, at least %s L/h",
+                        meter_id, result['leak_nights'], result['night_flow'])
+        if result['spike']:
+            log.warning("Meter %s: %s L/h in the last hour, usually %s L/h",
+                        meter_id, result['flow'], result['baseline'])
+        message = {'meter_id': meter_id, **result, 'timestamp_iso': values['timestamp_iso']}
+        if not publish_message(mqtt_leak_topic, dumps(message), retain=mqtt_retain):
+            log.warning("Could not publish the leak detection to mqtt")
+        return message
+    except Exception as error:  # the reading itself is published already
+        log.warning("Could not look for leaks: %s", error)
+        return None
+
+
+class Sink(ABC):
+    """Somewhere a reading goes. `send` must not block the scraper for long."""
+
+    name = 'sink'
+
+    @abstractmethod
+    def send(self, values, deadline=None):
+        """Hand the reading over. False when it is lost."""
+
+    def close(self):
+        pass
+
+
+class MqttSink(Sink):
+    """The reading on 'mqtt-topic', the one every setup has. Synchronous, the run fails with it."""
+
+    name = 'mqtt'
+
+    def send(self, values, deadline=None):
+        return publish_message(mqtt_topic, dumps(values), retain=mqtt_retain, deadline=deadline)
+
+
+class BufferedSink(Sink):
+    """A sink that writes in batches on a thread of its own.
+
+    Readings wait in a bounded queue for 'sink-flush-interval' seconds or until
+    'sink-batch-size' of them are there, with 0 every reading is written as soon
+    as it comes in. A failed write is tried again
+    'sink-retries' times, after that the batch waits for the next flush. When
+    the sink stays down, the oldest readings are dropped once
+    'sink-queue-size' are waiting. Every sink has its own thread, so a slow one
+    does not hold up the others.
+    """
+
+    def __init__(self, batch_size=None, flush_interval=None, queue_size=None, retries=None):
+        from queue import Queue
+        self.batch_size = batch_size or sink_batch_size
+        self.flush_interval = max(0, sink_flush_interval if flush_interval is None
+                                  else flush_interval)
+        self.queue_size = queue_size or sink_queue_size
+        self.retries = retries or sink_retries
+        self.pending = []
+        self._queue = Queue(maxsize=self.queue_size)
+        self._closed = Event()
+        self._thread = Thread(target=self._run, name=f'sink-{self.name}', daemon=True)
+        self._thread.start()
+
+    @abstractmethod
+    def write(self, batch):
+        """Write a list of readings. Raises on failure."""
+
+    def send(self, values, deadline=None):
+        from queue import Full
+        try:
+            self._queue.put_nowait(values)
+        except Full:
+            log.warning("The %s sink is %s readings behind, dropping a reading",
+                        self.name, self.queue_size)
+            return False
+        return True
+
+    def close(self, timeout=10):
+        """Write what is waiting and stop the thread."""
+        from queue import Full
+        self._closed.set()
+        try:
+            self._queue.put_nowait(None)  # wakes the thread up
+        except Full:  # then it is not waiting for the queue
+            pass
+        self._thread.join(timeout)
+
+    def _run(self):
+        from queue import Empty
+        while True:
+            try:
+                # a timeout of 0 would never wait, without an interval the reading is waited for
+                values = self._queue.get(timeout=self.flush_interval or None)
+                if values is not None:
+                    self.pending.append(values)
+                if (self.flush_interval and len(self.pending) < self.batch_size
+                        and not self._closed.is_set()):
+                    continue
+            except Empty:
+                pass
+            while True:  # whatever else is in the queue goes in the same batch
+                try:
+                    values = self._queue.get_nowait()
+                except Empty:
+                    break
+                if values is not None:
+                    self.pending.append(values)
+            if self.pending:
+                self._flush()
+            if self._closed.is_set():
+                return
+
+    def _flush(self):
+        for attempt in range(1, self.retries + 1):
+            batch = self.pending[:self.batch_size]
+            try:
+                self.write(batch)
+            except Exception as error:
+                log.warning("Could not write %s readings to the %s sink (attempt %s/%s): %s",
+                            len(batch), self.name, attempt, self.retries, error)
+                if self._closed.wait(min(30, 2 ** attempt)):
+                    break
+                continue
+            del self.pending[:len(batch)]
+            if not self.pending:
+                return
+        if len(self.pending) > self.queue_size:
+            dropped = len(self.pending) - self.queue_size
+            del self.pending[:dropped]
+            log.warning("The %s sink is down, dropped the %s oldest readings", self.name, dropped)
+
+
+def _post(url, body, content_type, headers=None):
+    from urllib.request import Request, urlopen
+    request = Request(url, data=body, method='POST',
+                      headers={'Content-Type': content_type, **(headers or {})})
+    with urlopen(request, timeout=30) as response:
+        response.read()
+
+
+class InfluxSink(BufferedSink):
+    """Readings as influx line protocol, posted to a /write (v1) or /api/v2/write url."""
+
+    name = 'influx'
+
+    def __init__(self, url, token=None, **options):
+        self.url = url
+        self.token = token
+        super().__init__(**options)
+
+    @staticmethod
+    def line(values):
+        stamp = int(datetime.fromisoformat(values['timestamp_iso']).timestamp()) * 10 ** 9
+        return f"water,meter_id={values['meter_id']} total={values['total']} {stamp}"
+
+    def write(self, batch):
+        headers = {'Authorization': f'Token {self.token}'} if self.token else {}
+        body = '\n'.join(self.line(values) for values in batch).encode('utf-8')
+        _post(self.url, body, 'text/plain; charset=utf-8', headers)
+
+
+class WebhookSink(BufferedSink):
+    """A json list of readings, posted to a url."""
+
+    name = 'webhook'
+
+    def __init__(self, url, **options):
+        self.url = url
+        super().__init__(**options)
+
+    def write(self, batch):
+        _post(self.url, dumps(batch).encode('utf-8'), 'application/json')
+
+
+class FileSink(BufferedSink):
+    """Readings appended to a local file, a json object per line or csv by the extension."""
+
+    name = 'file'
+    _COLUMNS = ('timestamp_iso', 'meter_id', 'total', 'timestamp')
+
+    def __init__(self, path, **options):
+        self.path = path
+        super().__init__(**options)
+
+    def write(self, batch):
+        from csv import writer
+        from os.path import exists
+        if not self.path.endswith('.csv'):
+            with open(self.path, 'a', encoding='utf-8') as handle:
+                handle.writelines(f'{dumps(values)}\n' for values in batch)
+            return
+        new = not exists(self.path)
+        with open(self.path, 'a', encoding='utf-8', newline='') as handle:
+            rows = writer(handle)
+            if new:
+                rows.writerow(self._COLUMNS)
+            rows.writerows([values.get(column) for column in self._COLUMNS] for values in batch)
+
+
+_SINK_TYPES = {'influx': InfluxSink, 'webhook': WebhookSink, 'file': FileSink}
+
+
+def create_sinks(specs):
+    """The sinks from 'output-sinks', each 'type=target'."""
+    sinks = []
+    for spec in specs:
+        kind, _, target = spec.partition('=')
+        if kind.strip() not in _SINK_TYPES or not target.strip():
+            log.warning("Ignoring the output sink '%s', expected one of %s followed by "
+                        "'=' and a url or path", spec, ', '.join(_SINK_TYPES))
+            continue
+        options = {'token': influx_token} if kind.strip() == 'influx' else {}
+        sinks.append(_SINK_TYPES[kind.strip()](target.strip(), **options))
+    return sinks
+
+
+_mqtt_sink = MqttSink()
+_sinks = None  # created on first use, the threads belong in the main process
+
+
+def send_to_sinks(values):
+    """Hand the reading to every extra sink. Never blocks on a sink, never raises."""
+    global _sinks
+    if _sinks is None:
+        _sinks = create_sinks(output_sinks)
+    for sink in _sinks:
+        try:
+            sink.send(values)
+        except Exception as error:
+            log.warning("The %s sink failed: %s", sink.name, error)
+
+
+def close_sinks():
+    for sink in _sinks or ():
+        sink.close()
+
+
+# The browserless engine. The site is a Blazor Server app, so after the login
+# everything it shows comes over a SignalR hub. SignalR also speaks long polling,
+# which is plain http, so a cookie jar and urllib are enough to log in, start a
+# circuit and read the text out of the render batches the server sends.
+_B2C_SETTINGS = re.compile(r'var SETTINGS = (\{.*?\});', re.DOTALL)
+_BLAZOR_MARKER = re.compile(r'<!--Blazor:(\{.*?\})-->', re.DOTALL)
+_BLAZOR_STATE = re.compile(r'<!--Blazor-(?:Server-)?Component-State:(.*?)-->', re.DOTALL)
+_RECORD_SEPARATOR = '\x1e'
+
+
+class HttpEngineError(Exception):
+    """The browserless engine could not read the meter, the browser takes over."""
+
+
+class HttpSession:
+    """urllib with a cookie jar, which is all the login needs."""
+
+    def __init__(self, timeout):
+        from http.cookiejar import CookieJar
+        from urllib.request import HTTPCookieProcessor, build_opener
+        self.timeout = timeout
+        self.opener = build_opener(HTTPCookieProcessor(CookieJar()))
+        self.opener.addheaders = [('User-Agent', 'Mozilla/5.0 minvandforsyningdk-scraper')]
+
+    def request(self, url, data=None, headers=None):
+        """GET, or POST when there is data. Returns the final url and the body."""
+        from urllib.parse import urlencode
+        from urllib.request import Request
+        if isinstance(data, dict):
+            data = urlencode(data).encode('utf-8')
+        with self.opener.open(Request(url, data=data, headers=headers or {}),
+                              timeout=self.timeout) as response:
+            return response.geturl(), response.read().decode('utf-8', errors='replace')
+
+
+def _forms(html):
+    """(action, method, fields) of every form on a page."""
+    from html.parser import HTMLParser
+
+    class Forms(HTMLParser):
+        def __init__(self):
+            super().__init__()
+            self.forms = []
+
+        def handle_starttag(self, tag, attrs):
+            attrs = dict(attrs)
+            if tag == 'form':
+                method = (attrs.get('method') or 'get').lower()
+                self.forms.append((attrs.get('action') or '', method, {}))
+            elif tag == 'input' and self.forms and attrs.get('name'):
+                self.forms[-1][2][attrs['name']] = attrs.get('value') or ''
+
+    parser = Forms()
+    parser.feed(html)
+    return parser.forms
+
+
+def _follow_forms(session, url, html, limit=5):
+    """Submit the forms that only post a token on to the next site.
+
+    That is how the identity provider hands the login back to the site, the
+    browser does it with a bit of javascript.
+    """
+    from urllib.parse import urljoin
+    for _ in range(limit):
+        forms = [form for form in _forms(html) if form[1] == 'post' and form[2]]
+        if not forms:
+            return url, html
+        action, _, fields = forms[0]
+        url, html = session.request(urljoin(url, action), data=fields)
+    return url, html
+
+
+def _b2c_login(session, entry_url, deadline=None):
+    """Log in on the Azure AD B2C form the login provider leads to."""
+    from urllib.parse import urlencode, urlsplit
+    polite('login page', deadline)
+    page_url, html = session.request(entry_url)
+    match = _B2C_SETTINGS.search(html)
+    if not match:
+        raise HttpEngineError(f"No login form at {page_url}")
+    settings = loads(match.group(1))
+    parts = urlsplit(page_url)
+    base = f"{parts.scheme}://{parts.netloc}{settings['hosts']['tenant']}"
+    query = {'tx': settings['transId'], 'p': settings['hosts']['policy']}
+
+    polite('login', deadline)
+    _, answer = session.request(
+        f"{base}/SelfAsserted?{urlencode(query)}",
+        data={'request_type': 'RESPONSE', 'signInName': mvf_username,
+              'password': mvf_password},
+        headers={'X-CSRF-TOKEN': settings['csrf'], 'X-Requested-With': 'XMLHttpRequest',
+                 'Referer': page_url})
+    if loads(answer).get('status') != '200':
+        raise HttpEngineError("The login was refused, check the username and password")
+
+    url, html = session.request(
+        f"{base}/api/{settings.get('api', 'CombinedSigninAndSignup')}/confirmed?"
+        + urlencode({'rememberMe': 'false', 'csrf_token': settings['csrf'], **query}))
+    return _follow_forms(session, url, html)
+
+
+def _render_batch_strings(batch):
+    """Every string in the string table of a Blazor render batch.
+
+    A batch ends with five int32 offsets, the last one points at the string
+    table: an int32 offset per string, each string written the way .NET's
+    BinaryWriter does it, a 7-bit encoded length and the utf-8 bytes.
+    """
+    from struct import error as StructError, unpack_from
+    try:
+        table = unpack_from('<i', batch, len(batch) - 4)[0]
+        strings = []
+        for entry in range(table, len(batch) - 20, 4):
+            position = unpack_from('<i', batch, entry)[0]
+            length = shift = 0
+            while True:
+                byte = batch[position]
+                position += 1
+                length |= (byte & 0x7f) << shift
+                shift += 7
+                if byte < 0x80:
+                    break
+            strings.append(batch[position:position + length].decode('utf-8', errors='replace'))
+        return strings
+    except (IndexError, StructError) as error:
+        raise HttpEngineError(f"Could not read a render batch: {error}") from error
+
+
+class BlazorCircuit:
+    """A Blazor Server circuit over SignalR long polling and the json protocol."""
+
+    def __init__(self, session, page_url):
+        from urllib.parse import urljoin
+        self.session = session
+        self.page_url = page_url
+        self.hub = urljoin(page_url, '/_blazor')
+        self.url = None
+        self.strings = []
+
+    def connect(self):
+        _, answer = self.session.request(f'{self.hub}/negotiate?negotiateVersion=1', data=b'')
+        negotiated = loads(answer)
+        transports = [t['transport'] for t in negotiated.get('availableTransports', [])]
+        if 'LongPolling' not in transports:
+            raise HttpEngineError(f"The hub only offers {transports}, not long polling")
+        token = negotiated.get('connectionToken') or negotiated['connectionId']
+        self.url = f'{self.hub}?id={token}'
+        self.send({'protocol': 'json', 'version': 1})
+        self.poll()
+
+    def send(self, message):
+        self.session.request(self.url, data=(dumps(message) + _RECORD_SEPARATOR).encode('utf-8'),
+                             headers={'Content-Type': 'text/plain;charset=UTF-8'})
+
+    def invoke(self, target, *arguments, invocation_id=None):
+        message = {'type': 1, 'target': target, 'arguments': list(arguments)}
+        if invocation_id is not None:
+            message['invocationId'] = invocation_id
+        self.send(message)
+
+    def poll(self):
+        _, text = self.session.request(self.url)
+        return [loads(part) for part in text.split(_RECORD_SEPARATOR) if part.strip()]
+
+    def start(self, html):
+        """Start the circuit for the components prerendered into `html`."""
+        components = [marker for marker in map(loads, _BLAZOR_MARKER.findall(html))
+                      if 'descriptor' in marker]
+        if not components:
+            raise HttpEngineError("The page has no server components to start")
+        from urllib.parse import urljoin
+        state = _BLAZOR_STATE.search(html)
+        self.invoke('StartCircuit', urljoin(self.page_url, '/'), self.page_url,
+                    dumps(components), state.group(1) if state else '', invocation_id='0')
+
+    def handle(self, message):
+        """Keep the text of render batches, and answer what the server waits for."""
+        if message.get('type') == 7:
+            raise HttpEngineError(f"The hub closed the circuit: {message.get('error')}")
+        if message.get('type') != 1:
+            return
+        target, arguments = message.get('target'), message.get('arguments', [])
+        if target == 'JS.RenderBatch':
+            batch_id, batch = arguments[0], arguments[1]
+            self.strings.extend(_render_batch_strings(b64decode(batch)))
+            self.invoke('OnRenderCompleted', batch_id, None)
+        elif target == 'JS.BeginInvokeJS':
+            # there is no javascript here, claim success and move on
+            self.invoke('EndInvokeJSFromDotNet', arguments[0], True,
+                        dumps([arguments[0], True, None]))
+
+
+def _values_from_text(text, profile):
+    """The reading, from text that is not on a page: all three or nothing."""
+    raw = {}
+    for target, pattern in (('total', profile.total_re), ('meter-id', profile.meter_id_re),
+                            ('timestamp', profile.timestamp_re)):
+        match = pattern.search(text)
+        if not match:
+            return None
+        raw[target] = match.group(1) if match.groups() else match.group(0)
+    return _reading(_parse_decimal(raw['total']), int(raw['meter-id']),
+                    profile.parse_timestamp(raw['timestamp']))
+
+
+def scrape_http(deadline=None):
+    """Log in and read the meter without a browser. Raises HttpEngineError."""
+    if not http_login_url:
+        raise HttpEngineError("Set 'http-login-url' to the login page of the identity provider")
+    deadline = deadline or _no_deadline
+    profile = current_profile()
+    session = HttpSession(deadline.limit(page_load_timeout))
+    try:
+        url, html = _b2c_login(session, http_login_url, deadline)
+        circuit = BlazorCircuit(session, url)
+        circuit.connect()
+        circuit.start(html)
+        give_up = monotonic() + deadline.limit(dashboard_timeout)
+        while monotonic() < give_up:
+            for message in circuit.poll():
+                circuit.handle(message)
+            values = _values_from_text('\n'.join(circuit.strings), profile)
+            if values:
+                return values
+    except HttpEngineError:
+        raise
+    except (OSError, ValueError, KeyError, TypeError) as error:
+        raise HttpEngineError(f"{type(error).__name__}: {error}") from error
+    raise HttpEngineError("The reading never showed up in the render batches")
+
+
+_TRACE_MODES = ('off', 'always', 'sampled', 'retry', 'ring')
+if trace_mode not in _TRACE_MODES:
+    log.warning("Unknown trace-mode '%s', using 'always'. Choose one of %s",
+                trace_mode, ', '.join(_TRACE_MODES))
+    trace_mode = 'always'
+
+
+def _should_trace(attempt):
+    """Whether this attempt records a full playwright trace."""
+    if not debug_dir:
+        return False
+    if trace_mode == 'always':
+        return True
+    if trace_mode == 'sampled':
+        return (_run_count - 1) % max(1, trace_sample_rate) == 0
+    if trace_mode == 'retry':
+        return attempt > 1
+    return False
+
+
+class RunSteps:
+    """How long each step of an attempt took.
+
+    This is the timing output to compare settings with, the trace modes
+    included. In 'ring' trace mode it also keeps the DOM after the last few
+    steps, which costs a page.content() per step instead of a full trace.
+    """
+
+    # the steps of a browser attempt, in order
+    STAGES = ('browser', 'login-page', 'login-form', 'login', 'dashboard', 'publish')
+
+    def __init__(self, ring_size=0):
+        self.started = self._last = monotonic()
+        self.timings = []
+        self.ring = deque(maxlen=ring_size) if ring_size else None
+
+    def done(self, step, page=None):
+        now = monotonic()
+        self.timings.append((step, now - self._last))
+        if _progress is not None:  # the parent of a run process follows along
+            _progress.send(('step', step, now - self._last))
+        self._last = now
+        if self.ring is not None and page is not None:
+            try:
+                self.ring.append((step, page.content()))
+            except PlaywrightError:
+                pass
+
+    @property
+    def total(self):
+        return self._last - self.started
+
+    def summary(self):
+        return ', '.join(f'{step} {seconds:.1f}s' for step, seconds in self.timings)
+
+    def dump_ring(self):
+        """Write the kept DOM snapshots of a failed attempt to debug-dir."""
+        if not self.ring or not debug_dir:
+            return
+        from os.path import join
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        for index, (step, html) in enumerate(self.ring, 1):
+            _diagnostics.submit(_diagnostics.write_page,
+                                join(debug_dir, f'{stamp}-failure-step{index}-{step}'),
+                                html, None)
+
+
+def publish_reading(values, deadline=None):
+    """Announce the meter, publish the reading and report online. Raises on failure."""
+    publish_discovery(values['meter_id'], deadline=deadline)
+    if not _mqtt_sink.send(values, deadline=deadline):
+        raise RuntimeError("Could not publish the reading to mqtt")
+    publish_status('online')
+
+
+_LOGIN_ENTRY_STATE = 'login-entry.json'
+
+
+def _login_entry_path():
+    from os.path import join
+    if state_dir:
+        return join(state_dir, _LOGIN_ENTRY_STATE)
+    # every attempt can be a process of its own, so even without state-dir it is a file
+    from tempfile import gettempdir
+    return join(gettempdir(), f'minvandforsyning-login-entry-{_main_pid}.json')
+
+
+def _login_entries():
+    try:
+        with open(_login_entry_path(), encoding='utf-8') as handle:
+            return loads(handle.read())
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as error:
+        log.warning("Ignoring the cached login page: %s", error)
+        return {}
+
+
+def _save_login_entries(entries):
+    from os import makedirs, replace
+    from os.path import dirname
+    path = _login_entry_path()
+    try:
+        makedirs(dirname(path), exist_ok=True)
+        with open(f'{path}.tmp', 'w', encoding='utf-8') as handle:
+            handle.write(dumps(entries))
+        replace(f'{path}.tmp', path)
+    except OSError as error:
+        log.warning("Could not save the login page: %s", error)
+
+
+def cached_login_entry():
+    """Where the picker on 'login-url' led last time, while it is fresh."""
+    from time import time
+    if not login_entry_ttl or replay_dir:  # a replay has to go the way it was recorded
+        return None
+    entry = _login_entries().get(login_url)
+    if not entry or entry.get('expires', 0) < time():
+        return None
+    return entry.get('url')
+
+
+def remember_login_entry(url):
+    from time import time
+    if not login_entry_ttl or not url or url == login_url:
+        return
+    entries = _login_entries()
+    entry = entries.get(login_url)
+    if entry and entry.get('url') is None and entry.get('expires', 0) >= time():
+        return  # the shortcut did not log in here, it is not taken again for a while
+    entries[login_url] = {'url': url, 'expires': time() + login_entry_ttl}
+    _save_login_entries(entries)
+
+
+def forget_login_entry(keep_out=False):
+    """Drop the cached login page. With `keep_out` none is cached for 'login-entry-ttl'."""
+    from time import time
+    entries = _login_entries()
+    if keep_out:
+        entries[login_url] = {'url': None, 'expires': time() + login_entry_ttl}
+    elif entries.pop(login_url, None) is None:
+        return
+    _save_login_entries(entries)
 
 
+def open_login_form(page, deadline=None, steps=None):
+    """Get `page` to the login form. True when the cached entry was used.
+
+    The picker on 'login-url' is a full page render and a click before the
+    form. With 'login-entry-ttl' the page the click led to is kept, and later
+    runs go straight there. When the form does not show up that way, the entry
+    is dropped and the picker is used after all.
+    """
+    deadline = deadline or _no_deadline
+    entry = cached_login_entry()
+    if entry:
+        polite('login page', deadline)
+        page.goto(entry, timeout=deadline.limit(page_load_timeout) * 1000)
+        if steps:
+            steps.done('login-page', page)
+        try:
+            find(page, 'username', deadline=deadline)
+            return True
+        except ElementNotFoundError:
+            log.info("The cached login page has no login form, going through the picker")
+            forget_login_entry()
+    polite('login page', deadline)
+    page.goto(login_url, timeout=deadline.limit(page_load_timeout) * 1000)
+    if steps:
+        steps.done('login-page', page)
+    click(page, 'login-provider', deadline=deadline)
+    # the login form is rendered by javascript, so wait for it
+    find(page, 'username', deadline=deadline)
+    remember_login_entry(page.url)
+    return False
 
 
-def scrape_once():
-    """One full attempt: log in, read the meter, publish. Raises on failure."""
+def log_in(page, deadline=None, steps=None):
+    """Fill in the login form and submit it. True when the cached entry was used."""
+    deadline = deadline or _no_deadline
+    steps = steps or RunSteps()
+    direct = open_login_form(page, deadline, steps)
+    steps.done('login-form', page)
+    try:
+        # give the form a moment to settle before typing into it
+        sleep(deadline.limit(form_settle_delay))
+        find(page, 'username', deadline=deadline).fill(mvf_username)
+        find(page, 'password', deadline=deadline).fill(mvf_password)
+        polite('login', deadline)
+        click(page, 'submit', deadline=deadline)
+    except Exception:
+        if direct:
+            forget_login_entry()
+        raise
+    steps.done('login', page)
+    return direct
+
+
+def log_in_and_read(page, deadline=None, steps=None):
+    """Log in and read the dashboard, through the picker when the shortcut does not get there.
+
+    The page the picker led to can carry a one-time state tied to a cookie of
+    the picker: the form shows up, but the login goes nowhere. Then the picker
+    is used in the same attempt, and the shortcut is not cached for a while.
+    """
+    if log_in(page, deadline, steps):
+        try:
+            return read_values(page, deadline=deadline)
+        except (ElementNotFoundError, PlaywrightError) as error:
+            log.info("The cached login page did not lead to the dashboard, "
+                     "going through the picker: %s", error)
+            forget_login_entry(keep_out=True)
+            log_in(page, deadline, steps)
+    return read_values(page, deadline=deadline)
+
+
+def scrape_once(attempt=1, deadline=None, publish=True):
+    """One full attempt: log in, read the meter, publish. Raises on failure.
+
+    With `publish` false the values are only returned, for the parent of a run
+    process to publish: of two hedged attempts only the winner may.
+    """
+    deadline = deadline or _no_deadline
+    if scrape_engine == 'http':
+        try:
+            values = scrape_http(deadline)
+        except DeadlineExceededError:
+            raise
+        except Exception as error:  # whatever broke the fast path, the browser may still work
+            log.warning("The browserless engine failed, using the browser: %s", error)
+        else:
+            log.info("Read meter %s without a browser: %s m3 at %s",
+                     values['meter_id'], values['total'], values['timestamp'])
+            if publish:
+                publish_reading(values, deadline)
+            return values
+
+    steps = RunSteps(trace_ring_size if debug_dir and trace_mode == 'ring' else 0)
     with sync_playwright() as playwright:
         browser = context = page = None
-        tracing = False
+        tracing = traced = False
+        recorder = SessionRecorder(record_dir) if record_dir else None
+        monitor = None
         try:
             browser = open_browser(playwright)
+            pool = cdp_pool()
+            if not (pool and pool.connected):  # a remote one is not ours to measure
+                monitor = MemoryMonitor(browser_memory_budget).start()
             # a fresh context per run is the playwright equivalent of incognito
-            context = browser.new_context()
-            context.set_default_timeout(element_timeout * 1000)
-            if debug_dir:
+            context = browser.new_context(**_context_options(recorder))
+            context.set_default_timeout(deadline.limit(element_timeout) * 1000)
+            if replay_dir:
+                replay_session(context, replay_dir)
+            traced = _should_trace(attempt)
+            if traced:
                 context.tracing.start(screenshots=True, snapshots=True)
                 tracing = True
             page = context.new_page()
+            if recorder:
+                page.on('websocket', recorder.attach)
+            steps.done('browser')
 
-            page.goto(login_url, timeout=page_load_timeout * 1000)
-            click(page, 'login-provider')
-            # the login form is rendered by javascript, so wait for it and give
-            # it a moment to settle before typing into it
-            find(page, 'username')
-            sleep(form_settle_delay)
-            find(page, 'username').fill(mvf_username)
-            find(page, 'password').fill(mvf_password)
-            click(page, 'submit')
-
-            values = read_values(page)
+            values = log_in_and_read(page, deadline, steps)
+            steps.done('dashboard', page)
             log.info("Read meter %s: %s m3 at %s",
                      values['meter_id'], values['total'], values['timestamp'])
 
-            publish_discovery(values['meter_id'])
-            if not publish_message(mqtt_topic, dumps(values), retain=mqtt_retain):
-                raise RuntimeError("Could not publish the reading to mqtt")
-            publish_status('online')
+            if publish:
+                publish_reading(values, deadline)
+                steps.done('publish')
+            if recorder:
+                recorder.succeeded = True
             return values
-        except Exception:
+        except Exception as error:
+            steps.done('failed', page)
             dump_diagnostics(page, 'failure')
+            steps.dump_ring()
             tracing = save_trace(context, tracing)
+            if monitor and monitor.exceeded:
+                raise BrowserMemoryError(
+                    f"The browser went over the budget of {browser_memory_budget} MB "
+                    f"and was killed") from error
             raise
         finally:
+            log.info("Attempt took %.1fs (trace-mode %s%s): %s", steps.total, trace_mode,
+                     ', traced' if traced else '', steps.summary())
+            if monitor:
+                monitor.stop()
             close_quietly(context, tracing)
             close_quietly(browser)
+            # the HAR is only complete once the context is closed
+            if recorder:
+                recorder.finish()
 
 
 def save_trace(context, tracing):
-    """Write the playwright trace of a failed run, viewable with trace.playwright.dev."""
+    """Write the playwright trace of a failed run, viewable with trace.playwright.dev.
+
+    Playwright stops the trace into a temporary file, which is fast, and the
+    background writer moves it to debug-dir, which can be a slow sd card.
+    """
     if not tracing or context is None:
         return tracing
+    from os import close, remove
     from os.path import join
+    from tempfile import mkstemp
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    handle, path = mkstemp(suffix='-failure-trace.zip')
+    close(handle)
     try:
-        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
-        path = join(debug_dir, f'{stamp}-failure-trace.zip')
         context.tracing.stop(path=path)
-        log.info("Wrote a playwright trace to %s, open it on https://trace.playwright.dev",
-                 path)
+        _diagnostics.submit(_diagnostics.move_trace, path,
+                            join(debug_dir, f'{stamp}-failure-trace.zip'))
     except Exception as error:
         log.warning("Could not write the trace: %s", error)
+        remove(path)
     return False
 
 
@@ -466,11 +2508,450 @@ def close_quietly(closeable, tracing=False):
         log.warning("Could not close the browser cleanly: %s", error)
 
 
+class RunTimeoutError(Exception):
+    """Raised when an attempt in its own process went over 'run-timeout'."""
+
+
+def _limit_resources():
+    """Resource limits of the run process, inherited by the driver and chromium."""
+    import resource
+    if run_memory_limit:
+        limit = run_memory_limit * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    if run_cpu_limit:
+        resource.setrlimit(resource.RLIMIT_CPU, (run_cpu_limit, run_cpu_limit))
+
+
+_progress = None  # in a run process, where RunSteps reports to
+
+
+def _child_state():
+    """What a run process learned that the next runs need, for the parent to keep."""
+    return {
+        'announced': dict(_announced_meters),
+        'profile': _detected_profile.name if _detected_profile else None,
+        'cdp': {key: pool.stats for key, pool in _cdp_pools.items()},
+    }
+
+
+def _adopt_child_state(state):
+    """Keep what a run process learned, so the next one starts from it."""
+    global _detected_profile
+    _announced_meters.update(state.get('announced', {}))
+    if state.get('profile') in PROFILES:
+        _detected_profile = PROFILES[state['profile']]
+    for key, stats in state.get('cdp', {}).items():
+        if key == browser_cdp_url:
+            cdp_pool().merge(stats)
+
+
+def _run_child(connection, function, args):
+    """Body of the run process: do the work and hand the outcome to the parent."""
+    from os import setsid
+    # a session of its own, so the whole tree can be killed as one process group
+    setsid()
+    global _progress
+    _progress = connection
+    try:
+        _limit_resources()
+        outcome = ('ok', function(*args))
+    except BaseException as error:  # everything goes back to the parent
+        outcome = ('error', error)
+    # failed or not, the child may have learned something the next attempt needs
+    outcome += (_child_state(),)
+    try:
+        connection.send(outcome)
+    except Exception:  # an exception that does not pickle
+        connection.send(('error', RuntimeError(f"{type(outcome[1]).__name__}: {outcome[1]}"),
+                         outcome[2]))
+    connection.close()
+
+
+def _kill_tree(pid, processes):
+    """Kill the run process, its process group and everything it started."""
+    from os import killpg
+    try:
+        killpg(pid, SIGKILL)
+    except OSError:  # already gone
+        pass
+    alive = _process_table()
+    for child, name in processes.items():
+        # whatever moved to a session of its own is still found by pid
+        if child in alive and alive[child][1] == name:
+            try:
+                kill(child, SIGKILL)
+            except OSError:
+                pass
+
+
+class RunProcess:
+    """One attempt running in a child process, see run_supervised.
+
+    The child reports every step it finishes, so the parent knows which step
+    it is in and how long it has been there.
+    """
+
+    def __init__(self, function, args):
+        from multiprocessing import get_context
+        context = get_context('fork')
+        self.receiver, sender = context.Pipe(duplex=False)
+        self.child = context.Process(target=_run_child, args=(sender, function, args),
+                                     name='scrape-run', daemon=True)
+        self.child.start()
+        sender.close()
+        self.started = self.step_started = self.heard = monotonic()
+        self.steps = []
+        self.events = []
+        self.outcome = None
+
+    @property
+    def stage(self):
+        """The step the child is working on now."""
+        if not self.steps:
+            return RunSteps.STAGES[0]
+        last = self.steps[-1][0]
+        if last not in RunSteps.STAGES[:-1]:
+            return None
+        return RunSteps.STAGES[RunSteps.STAGES.index(last) + 1]
+
+    def poll(self, timeout=None):
+        """Wait up to `timeout` seconds for the outcome. True when it is there."""
+        end = None if timeout is None else monotonic() + timeout
+        while self.outcome is None:
+            if not self.receiver.poll(None if end is None else max(0, end - monotonic())):
+                return False
+            try:
+                message = self.receiver.recv()
+            except EOFError:
+                self.child.join()
+                self.outcome = ('error', RuntimeError(
+                    f"The run process died with exit code {self.child.exitcode}"), {})
+                break
+            self.heard = monotonic()
+            if message[0] == 'step':
+                self.steps.append(message[1:])
+                self.step_started = self.heard
+            elif message[0] in ('ok', 'error'):
+                self.outcome = message
+            elif message[0] == 'diagnostics':  # captured there, written here
+                _diagnostics.submit(getattr(_diagnostics, message[1]), *message[2])
+            else:  # what the function reports on the way, see watch
+                self.events.append(message)
+        return True
+
+    def stop(self):
+        """Kill the child and every process below it. The number of browser processes."""
+        processes = {}
+        try:
+            # a browser that did not close cleanly is not left for the next run
+            processes = browser_processes(self.child.pid)
+            if self.outcome is not None:
+                self.child.join(5)
+        finally:
+            _kill_tree(self.child.pid, processes)
+            self.child.join()
+            self.receiver.close()
+        return len(processes)
+
+    def result(self):
+        """What the function returned, or raise what it raised."""
+        outcome, result, state = self.outcome
+        _adopt_child_state(state)
+        if outcome == 'error':
+            raise result
+        _stage_times.learn(self.steps)
+        return result
+
+
+def run_supervised(function, *args, timeout=None):
+    """Call function in a child process and return its result, or raise its error.
+
+    The child is given `timeout` seconds, 'run-timeout' when that is not given
+    and no limit when both are None or 0. When that runs out, or when the
+    child is done, the child and every process below it (the playwright driver,
+    chromium) are killed, so a wedged browser can neither stall the loop nor
+    leak processes into the next run.
+    """
+    timeout = (timeout or run_timeout) or None
+    run = RunProcess(function, args)
+    try:
+        finished = run.poll(timeout)
+    finally:
+        killed = run.stop()
+    if not finished:
+        raise RunTimeoutError(f"The attempt took more than {timeout:.0f} seconds, "
+                              f"killed it and {killed} browser processes")
+    return run.result()
+
+
+class StageTimes:
+    """How long every step of the successful attempts took, the last 100 of each."""
+
+    MIN_SAMPLES = 5
+
+    def __init__(self):
+        self.samples = {}
+
+    def learn(self, steps):
+        for step, seconds in steps:
+            self.samples.setdefault(step, deque(maxlen=100)).append(seconds)
+
+    def p95(self, step):
+        """95% of the attempts got through `step` within this, None until that is known."""
+        import numpy as np
+        samples = self.samples.get(step, ())
+        if len(samples) < self.MIN_SAMPLES:
+            return None
+        return float(np.percentile(samples, 95))
+
+
+_stage_times = StageTimes()
+if hedge_attempts and not run_isolation:
+    log.warning("'hedge-attempts' needs 'run-isolation', a thread can not be killed. "
+                "Running the attempts one after another")
+    hedge_attempts = False
+
+
+def run_hedged(function, *args, timeout=None):
+    """run_supervised, with a second attempt next to a first one that is slow.
+
+    When the first attempt is in a step for longer than 95% of the successful
+    attempts took for it, a second one starts next to it. Whichever of them
+    gets the values first wins and the other is killed. An attempt that fails
+    leaves the other one running; only when both have failed is the error of
+    the last one raised.
+    """
+    from multiprocessing.connection import wait
+    timeout = (timeout or run_timeout) or None
+    runs = [RunProcess(function, args)]
+    hedged = False
+    error = None
+    try:
+        while runs:
+            for run in list(runs):
+                if run.poll(0):
+                    runs.remove(run)
+                    run.stop()
+                    try:
+                        return run.result()
+                    except Exception as failure:
+                        error = failure
+                        log.warning("An attempt of a hedged run failed: %s", failure)
+                elif timeout and monotonic() - run.started > timeout:
+                    runs.remove(run)
+                    killed = run.stop()
+                    error = RunTimeoutError(f"The attempt took more than {timeout:.0f} seconds, "
+                                            f"killed it and {killed} browser processes")
+                    log.warning("%s", error)
+            if not runs:
+                break
+            first = runs[0]
+            limit = _stage_times.p95(first.stage)
+            waited = monotonic() - first.step_started
+            if not hedged and limit is not None and waited > limit:
+                log.info("The attempt is %.1fs into '%s' where 95%% took %.1fs, "
+                         "starting a second one next to it", waited, first.stage, limit)
+                runs.append(RunProcess(function, args))
+                hedged = True
+            wait([run.receiver for run in runs], timeout=0.5)
+        raise error
+    finally:
+        for run in runs:
+            run.stop()
+
+
+# an attempt stopped by the run deadline still closes its browser and writes diagnostics
+_DEADLINE_GRACE = 30
+
+
+def record_reading(values):
+    """The sinks, usage and leak history of a published reading.
+
+    Done in the parent, the history has to outlive the run process.
+    """
+    send_to_sinks(values)
+    publish_usage(values)
+    publish_leak(values)
+
+
+# installed on the dashboard in watch mode. Blazor patches the DOM in several
+# small steps, so the change is reported once it has been quiet for a moment.
+_WATCH_SCRIPT = """() => {
+    if (window.__minvandforsyningObserver) return;
+    let pending = null;
+    window.__minvandforsyningObserver = new MutationObserver(() => {
+        clearTimeout(pending);
+        pending = setTimeout(() => window.minvandforsyningChanged(), 500);
+    });
+    window.__minvandforsyningObserver.observe(
+        document.body, {subtree: true, childList: true, characterData: true});
+}"""
+
+# blazor's own reconnect dialog, once it has given up on the circuit
+_CIRCUIT_LOST = ('#components-reconnect-modal.components-reconnect-failed, '
+                 '#components-reconnect-modal.components-reconnect-rejected')
+
+
+_WATCH_RESTART = 30  # seconds before logging in again when a watched session ended
+
+
+def watch_session(keep_going=None, on_reload=None):
+    """Log in once and publish the reading every time the dashboard changes.
+
+    A MutationObserver on the dashboard calls back into python, and the values
+    are read again only then. The page is reloaded every
+    'watch-reload-interval' seconds, and right away when the blazor circuit
+    drops; `on_reload` is called before every reload. Returns the last reading
+    when the session is lost or `keep_going` says stop, None when there never
+    was one, and the caller logs in again.
+
+    In a run process the readings go to the parent to publish, see watch.
+    """
+    keep_going = keep_going or (lambda: True)
+    changed, dropped = Event(), Event()
+    last = None
+
+    def on_socket(socket):
+        if _BLAZOR_SOCKET.search(socket.url):
+            socket.on('close', lambda _: dropped.set())
+
+    with sync_playwright() as playwright:
+        browser = context = page = None
+        monitor = None
+        try:
+            browser = open_browser(playwright)
+            pool = cdp_pool()
+            if not (pool and pool.connected):
+                monitor = MemoryMonitor(browser_memory_budget).start()
+            context = browser.new_context(**_context_options())
+            context.set_default_timeout(element_timeout * 1000)
+            page = context.new_page()
+            # the sync api runs the callback while it waits, so an Event is enough
+            page.expose_function('minvandforsyningChanged', changed.set)
+            page.on('websocket', on_socket)
+            log_in(page)
+            reloaded = monotonic()
+            changed.set()
+            while keep_going():
+                if _progress is not None:  # still alive, for the parent to see
+                    _progress.send(('watching',))
+                if dropped.is_set() or page.locator(_CIRCUIT_LOST).count():
+                    log.info("The dashboard lost its connection, reloading it")
+                    reloaded = -watch_reload_interval
+                if monotonic() - reloaded >= watch_reload_interval:
+                    if on_reload:
+                        on_reload()
+                    if _progress is not None:
+                        _progress.send(('reload',))
+                    dropped.clear()
+                    polite('page load')
+                    page.reload(timeout=page_load_timeout * 1000)
+                    reloaded = monotonic()
+                    changed.set()
+                if changed.is_set():
+                    changed.clear()
+                    values = read_values(page)
+                    page.evaluate(_WATCH_SCRIPT)  # a reload took the observer with it
+                    if last is None or (values['total'], values['timestamp']) != (
+                            last['total'], last['timestamp']):
+                        log.info("Read meter %s: %s m3 at %s",
+                                 values['meter_id'], values['total'], values['timestamp'])
+                        if _progress is not None:
+                            _progress.send(('reading', values))
+                        else:
+                            publish_reading(values)
+                            record_reading(values)
+                        last = values
+                page.wait_for_timeout(1000)
+        except Exception as error:  # the caller logs in again
+            log.warning("Stopped watching the dashboard: %s", error)
+            if monitor and monitor.exceeded:
+                log.warning("The browser went over the budget of %s MB and was killed",
+                            browser_memory_budget)
+            dump_diagnostics(page, 'watch')
+        finally:
+            if monitor:
+                monitor.stop()
+            close_quietly(context)
+            close_quietly(browser)
+    return last
+
+
+def watch(keep_going=None, on_reload=None):
+    """Watch the dashboard until the session ends. The last reading, or None.
+
+    With 'run-isolation' the session runs in a process of its own, like an
+    attempt. It reports every second, and when it has not for 'run-timeout'
+    seconds (a wedged browser) it is killed with its browser. The readings are
+    published from here. `on_reload` is called on every reload of the page;
+    when it returns True (a new config) the session ends, so the next one logs
+    in with it.
+    """
+    keep_going = keep_going or (lambda: True)
+    if not run_isolation:
+        return watch_session(keep_going, on_reload)
+    run = RunProcess(watch_session, ())
+    last = None
+    going = True
+    try:
+        while going:
+            finished = run.poll(1)
+            events, run.events = run.events, []
+            for event, *payload in events:
+                if event == 'reading':
+                    try:
+                        publish_reading(payload[0])
+                    except Exception as error:
+                        log.warning("Could not publish the watched reading: %s", error)
+                        continue
+                    record_reading(payload[0])
+                    last = payload[0]
+                elif event == 'reload' and going and on_reload and on_reload():
+                    log.info("The config changed, logging in again with it")
+                    going = False
+            if finished or not keep_going():
+                going = False
+            elif run_timeout and monotonic() - run.heard > run_timeout:
+                log.warning("The watched dashboard was not heard from in %s seconds, "
+                            "killing it", run_timeout)
+                going = False
+    finally:
+        run.stop()
+    if run.outcome is not None:
+        try:
+            run.result()  # keeps what the session learned
+        except Exception as error:
+            log.warning("The watch process ended: %s", error)
+    return last
+
+
+def back_off(seconds):
+    """The wait between two attempts of a run."""
+    sleep(seconds)
+
+
 def scrape():
     """Run scrape_once with retries. Never raises, returns the values or None."""
+    global _run_count
+    _run_count += 1
+    deadline = Deadline(run_deadline)
     for attempt in range(1, max_attempts + 1):
         try:
-            return scrape_once()
+            if run_isolation:
+                remaining = deadline.remaining()
+                timeout = run_timeout or None
+                if remaining is not None:
+                    timeout = min(timeout or remaining, remaining) + _DEADLINE_GRACE
+                run = run_hedged if hedge_attempts else run_supervised
+                values = run(scrape_once, attempt, deadline, False, timeout=timeout)
+                publish_reading(values, deadline)  # once, for the attempt that won
+            else:
+                values = scrape_once(attempt=attempt, deadline=deadline)
+            record_reading(values)
+            return values
+        except DeadlineExceededError as error:
+            log.error("Attempt %s/%s stopped: %s", attempt, max_attempts, error)
+            break
         except ElementNotFoundError as error:
             log.error("Attempt %s/%s failed: %s", attempt, max_attempts, error)
         except PlaywrightTimeoutError as error:
@@ -478,30 +2959,611 @@ def scrape():
         except PlaywrightError as error:
             log.error("Attempt %s/%s failed, browser problem: %s",
                       attempt, max_attempts, error)
+        except RunTimeoutError as error:
+            log.error("Attempt %s/%s wedged: %s", attempt, max_attempts, error)
         except Exception as error:
             log.error("Attempt %s/%s failed: %s", attempt, max_attempts, error)
 
         if attempt < max_attempts:
             backoff = min(120, 2 ** attempt * 5) + uniform(0, 5)
+            remaining = deadline.remaining()
+            if remaining is not None and remaining < backoff:
+                log.error("Not enough of the %s second run deadline left to retry", run_deadline)
+                break
             log.info("Retrying in %.0f seconds", backoff)
-            sleep(backoff)
+            back_off(backoff)
 
-    log.error("Giving up on this run after %s attempts", max_attempts)
+    log.error("Giving up on this run after %s attempts", attempt)
     publish_status('offline')
     return None
 
 
+class CommandListener:
+    """Scrape requests from the command topic, for a reading now instead of at the next run.
+
+    Requests are coalesced: whatever arrives while a run is going is answered
+    by that run. A request within 'command-cache-ttl' seconds of a reading of
+    every account is answered by publishing those readings again, each to the
+    topic of its account, without a browser. A run never starts within
+    'command-min-interval' seconds of the one before.
+    """
+
+    def __init__(self):
+        self.requested = Event()
+        self.readings = {}  # account -> (topic, values, when it was read)
+        self.started = float('-inf')
+        self.client = None
+
+    def start(self):
+        self.client = mqtt_client('commands')
+        self.client.on_connect = self.on_connect
+        self.client.on_message = self.on_message
+        self.client.connect_async(mqtt_broker, mqtt_port)
+        self.client.loop_start()  # reconnects by itself
+        return self
+
+    def on_connect(self, client, userdata, flags, reason_code, properties):
+        # subscribed again on every reconnect
+        client.subscribe(mqtt_command_topic)
+
+    def on_message(self, client, userdata, message):
+        command = message.payload.decode('utf-8', errors='replace').strip().lower()
+        if command not in ('scrape', 'press'):
+            log.warning("Unknown command '%s' on %s, send 'scrape'", command, message.topic)
+            return
+        readings = list(self.readings.values())
+        oldest = min((read for _, _, read in readings), default=float('-inf'))
+        if monotonic() - oldest < command_cache_ttl:
+            log.info("Read now: answering with the readings from %.0f seconds ago",
+                     monotonic() - oldest)
+            for topic, values, _ in readings:
+                publish_message(topic, dumps(values), retries=1, retain=mqtt_retain)
+            return
+        log.info("Read now requested")
+        self.requested.set()
+
+    def run_started(self):
+        self.started = monotonic()
+
+    def run_finished(self, results, accounts=(None,)):
+        """Keep the readings of a run, `results` of `accounts` as scrape_accounts returns them."""
+        for account, values in zip(accounts, results):
+            if values:
+                # looked up here, in the loop: use_account is not for other threads
+                with use_account(account):
+                    topic = mqtt_topic
+                self.readings[_account_key(account)] = (topic, values, monotonic())
+            else:  # a failed run leaves the cached reading as old as it is
+                self.readings.setdefault(_account_key(account), (None, None, float('-inf')))
+        # the requests that came in while it ran got this run's reading
+        self.requested.clear()
+
+    def wait(self, delay):
+        """Sleep until the next run: `delay` seconds, or earlier when a run is requested."""
+        until = monotonic() + delay
+        if not self.requested.wait(delay):
+            return
+        not_before = self.started + command_min_interval
+        if monotonic() < not_before:
+            log.info("Read now in %.0f seconds, runs are at least %s seconds apart",
+                     not_before - monotonic(), command_min_interval)
+            sleep(max(0, min(not_before, until) - monotonic()))
+
+    def stop(self):
+        if self.client is not None:
+            self.client.loop_stop()
+            self.client.disconnect()
+
+
+class LeaderElection:
+    """Active/standby replicas, with a lease on the broker as the lock.
+
+    The leader publishes a retained lease with its node id every third of
+    'leader-lease-ttl'. A node that has not seen the lease renewed for the
+    whole ttl takes it over. Every node sees the lease messages in the same
+    order, so when two claim it at once, the claim the broker delivered last
+    wins and the other node steps down. The ttl is counted from when a lease
+    is received, so the clocks of the hosts do not have to agree. A leader that
+    dies without saying goodbye is released by its last will on
+    '<lease topic>/released', so the standby does not have to wait the ttl out.
+    """
+
+    def __init__(self, topic=None, ttl=None, node=None):
+        self.topic = topic or leader_lease_topic
+        self.ttl = ttl or leader_lease_ttl
+        self.node = node or node_id or gethostname()
+        self.holder = None
+        self.expires = float('-inf')
+        self.changed = Event()
+        self.client = None
+        self._stop = Event()
+
+    def start(self):
+        self.client = mqtt_client('leader')
+        self.client.will_set(f'{self.topic}/released', self.node, qos=1)
+        self.client.on_connect = self.on_connect
+        self.client.on_message = self.on_message
+        self.client.connect_async(mqtt_broker, mqtt_port)
+        self.client.loop_start()
+        Thread(target=self._run, name='leader-election', daemon=True).start()
+        log.info("Node %s is standing by for the lease on %s", self.node, self.topic)
+        return self
+
+    def on_connect(self, client, userdata, flags, reason_code, properties):
+        client.subscribe([(self.topic, 1), (f'{self.topic}/released', 1)])
+
+    def on_message(self, client, userdata, message):
+        was_leader = self.is_leader()
+        payload = message.payload.decode('utf-8', errors='replace')
+        if message.topic == self.topic:
+            try:
+                lease = loads(payload) if payload else {}
+                holder, ttl = lease.get('node'), float(lease.get('ttl', 0))
+            except (ValueError, TypeError, AttributeError):
+                log.warning("Ignoring a lease that is not ours: %s", payload)
+                return
+            self.holder, self.expires = (holder, monotonic() + ttl) if ttl else (None, 0)
+        elif payload == self.holder:
+            log.info("Leader %s is gone", payload)
+            self.holder, self.expires = None, 0
+        if was_leader and not self.is_leader():
+            log.warning("Node %s lost the lease to %s", self.node, self.holder or 'nobody')
+        elif self.is_leader() and not was_leader:
+            log.info("Node %s is the leader now", self.node)
+        self.changed.set()
+        if self.holder is None and not self._stop.is_set():
+            self.renew()
+
+    def is_leader(self):
+        return self.holder == self.node and monotonic() < self.expires
+
+    def renew(self):
+        """Claim the lease when it is ours or free. A held lease is left alone."""
+        if self.holder in (None, self.node) or monotonic() >= self.expires:
+            self.client.publish(self.topic, dumps({'node': self.node, 'ttl': self.ttl}),
+                                qos=1, retain=True)
+
+    def _run(self):
+        while not self._stop.wait(self.ttl / 3):
+            self.renew()
+
+    def wait_for_leadership(self):
+        """Block until this node holds the lease."""
+        while not self.is_leader():
+            self.changed.clear()
+            self.changed.wait(self.ttl / 3)
+
+    def stop(self):
+        """Give the lease up, so the standby takes over right away."""
+        self._stop.set()
+        if self.client is None:
+            return
+        if self.is_leader():
+            self.client.publish(self.topic, dumps({'node': self.node, 'ttl': 0}),
+                                qos=1, retain=True).wait_for_publish(5)
+        self.client.disconnect()
+        self.client.loop_stop()
+
+
+# what an account changes: who logs in, and where its readings go
+_ACCOUNT_TOPICS = ('mqtt_topic', 'mqtt_status_topic', 'mqtt_usage_topic', 'mqtt_leak_topic')
+
+
+def load_accounts():
+    """The accounts from 'accounts-file', or the one from 'username' and 'password'.
+
+    Without a 'topic' of its own, every topic of an account gets its 'name'
+    (or its username) appended, so the meters do not share topics.
+    """
+    if not accounts_file:
+        return [None]  # the account of the environment
+    with open(accounts_file, encoding='utf-8') as handle:
+        accounts = loads(handle.read())
+    for account in accounts:
+        if not account.get('username') or not account.get('password'):
+            raise ValueError(f"Every account in {accounts_file} needs a username and a password")
+        account.setdefault('name', re.sub(r'[^A-Za-z0-9_-]+', '_', account['username']))
+    return accounts
+
+
+def _account_key(account):
+    return account['username'] if account else mvf_username
+
+
+@contextmanager
+def use_account(account):
+    """Point the settings at `account` for a run, and back afterwards."""
+    if account is None:
+        yield
+        return
+    names = ('mvf_username', 'mvf_password', 'device_name') + _ACCOUNT_TOPICS
+    saved = {name: globals()[name] for name in names}
+    settings = {'mvf_username': account['username'], 'mvf_password': account['password'],
+                'device_name': account.get('device_name', device_name)}
+    for name in _ACCOUNT_TOPICS:
+        if saved[name]:
+            settings[name] = f"{saved[name]}/{account['name']}"
+    if account.get('topic'):
+        settings['mqtt_topic'] = account['topic']
+    globals().update(settings)
+    try:
+        yield
+    finally:
+        globals().update(saved)
+
+
+def _ring_point(key):
+    from hashlib import sha256
+    return int.from_bytes(sha256(key.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent hashing: every node owns the arcs of the ring before its points.
+
+    With many points per node the accounts spread evenly, and a node that joins
+    or leaves only moves the accounts on its own arcs, about 1/n of them.
+    """
+
+    def __init__(self, nodes, points=160):
+        self._ring = sorted((_ring_point(f'{node}#{point}'), node)
+                            for node in nodes for point in range(points))
+        self._points = [point for point, _ in self._ring]
+
+    def owner(self, key):
+        from bisect import bisect
+        if not self._ring:
+            return None
+        return self._ring[bisect(self._points, _ring_point(key)) % len(self._ring)][1]
+
+
+class Cluster:
+    """The scraper nodes sharing the accounts, found through retained presence messages.
+
+    Each node keeps 'online' retained on '<cluster topic>/nodes/<node id>'. Its
+    last will clears that, so when a node dies the broker removes it after
+    1.5 times 'cluster-keepalive'. Every node hashes the accounts onto a ring of
+    the nodes it sees and scrapes only its own part, so they agree without
+    talking to each other.
+    """
+
+    SETTLE = 1  # seconds without presence messages before the nodes seen are all there are
+
+    def __init__(self, topic=None, node=None):
+        self.topic = topic or cluster_topic
+        self.node = node or node_id or gethostname()
+        self.nodes = {self.node}
+        self.client = None
+        self.subscribed = Event()
+        self.seen = Event()
+        self._shard = None
+
+    @property
+    def presence_topic(self):
+        return f'{self.topic}/nodes/{self.node}'
+
+    def start(self):
+        self.client = mqtt_client('cluster')
+        self.client.will_set(self.presence_topic, '', qos=1, retain=True)
+        self.client.on_connect = self.on_connect
+        self.client.on_subscribe = self.on_subscribe
+        self.client.on_message = self.on_message
+        self.client.connect_async(mqtt_broker, mqtt_port, keepalive=cluster_keepalive)
+        self.client.loop_start()
+        return self
+
+    def on_connect(self, client, userdata, flags, reason_code, properties):
+        client.publish(self.presence_topic, 'online', qos=1, retain=True)
+        client.subscribe(f'{self.topic}/nodes/+', qos=1)
+
+    def on_subscribe(self, client, userdata, mid, reason_codes, properties):
+        self.subscribed.set()
+
+    def on_message(self, client, userdata, message):
+        node = message.topic.rsplit('/', 1)[-1]
+        if message.payload:
+            self.nodes.add(node)
+        elif node != self.node:
+            self.nodes.discard(node)
+        self.seen.set()
+
+    def wait_for_nodes(self, timeout=10):
+        """Wait for the retained presence of the other nodes. False when it did not settle.
+
+        Without it the first shard is taken with only this node in the ring,
+        and every node scrapes every account after a restart.
+        """
+        end = monotonic() + timeout
+        if self.subscribed.wait(timeout):
+            # the broker sends what is retained right after the subscription
+            while monotonic() < end:
+                self.seen.clear()
+                if not self.seen.wait(min(self.SETTLE, max(0.0, end - monotonic()))):
+                    return True
+        log.warning("The nodes of the cluster did not settle in %s seconds, going with %s",
+                    timeout, ', '.join(sorted(self.nodes)))
+        return False
+
+    def shard(self, accounts):
+        """The accounts this node scrapes, given the nodes it sees now."""
+        ring = HashRing(sorted(self.nodes))
+        mine = [account for account in accounts if ring.owner(_account_key(account)) == self.node]
+        shard = sorted(_account_key(account) for account in mine)
+        if shard != self._shard:
+            log.info("Node %s of %s scrapes %s of the %s accounts", self.node,
+                     len(self.nodes), len(mine), len(accounts))
+            self._shard = shard
+        return mine
+
+    def stop(self):
+        if self.client is None:
+            return
+        self.client.publish(self.presence_topic, '', qos=1, retain=True).wait_for_publish(5)
+        self.client.disconnect()
+        self.client.loop_stop()
+
+
+def _start_offset(key):
+    """Where in the interval `key` runs: spread evenly, and the same after a restart."""
+    return _ring_point(key) % max(1, _run_timer)
+
+
+def scrape_accounts(accounts, spread=True):
+    """Scrape every account in turn. The readings, None for an account that failed.
+
+    With 'schedule-spread' the accounts get a slot each, evenly over the
+    interval, instead of all logging in right after each other. A retry of
+    the failed accounts is not spread, it has to be done by the next full run.
+    """
+    results = []
+    started = monotonic()
+    slot = _run_timer / len(accounts) if spread and schedule_spread and accounts else 0
+    for index, account in enumerate(accounts):
+        if slot and index:
+            sleep(max(0.0, started + index * slot - monotonic()))
+        with use_account(account):
+            results.append(scrape())
+    return results
+
+
+def _parse_bool(value):
+    lowered = value.strip().lower()
+    if lowered in ('1', 'true', 'yes', 'on'):
+        return True
+    if lowered in ('0', 'false', 'no', 'off'):
+        return False
+    raise ValueError(f"'{value}' is not a boolean")
+
+
+def _non_negative(value):
+    number = int(value)
+    if number < 0:
+        raise ValueError(f"{number} is below 0")
+    return number
+
+
+def _positive(value):
+    number = int(value)
+    if number < 1:
+        raise ValueError(f"{number} is below 1")
+    return number
+
+
+def _log_level(value):
+    if not isinstance(logging.getLevelName(value.upper()), int):
+        raise ValueError(f"'{value}' is not a log level")
+    return value
+
+
+# what 'config-file' can change: variable -> (global, parser), the selectors go
+# into SELECTORS. The rest is read once, it is held by a browser, a thread or a
+# connection that lives as long as the process. The broker and its credentials
+# are among those: the command, leader and cluster clients stay connected.
+_RELOADABLE = {
+    **{f'selector-{name}': (None, _parse_selectors) for name in _DEFAULT_SELECTORS},
+    'pattern-total': ('total_pattern', str),
+    'pattern-meter-id': ('meter_id_pattern', str),
+    'datetime-format': ('datetime_format', str),
+    'scrape-interval': ('_run_timer', _positive),
+    'retry-interval': ('retry_interval', _non_negative),
+    'max-attempts': ('max_attempts', _positive),
+    'element-timeout': ('element_timeout', _positive),
+    'dashboard-timeout': ('dashboard_timeout', _positive),
+    'page-load-timeout': ('page_load_timeout', _positive),
+    'form-settle-delay': ('form_settle_delay', _non_negative),
+    'run-timeout': ('run_timeout', _non_negative),
+    'run-deadline': ('run_deadline', _non_negative),
+    'mqtt-topic': ('mqtt_topic', str),
+    'mqtt-status-topic': ('mqtt_status_topic', str),
+    'mqtt-retain': ('mqtt_retain', _parse_bool),
+    'mqtt-retries': ('mqtt_retries', _non_negative),
+    'log-level': ('log_level', _log_level),
+}
+
+
+def _startup_settings():
+    """The values from the environment, what a variable left out of the file goes back to."""
+    settings = {name: globals()[attribute] for name, (attribute, _) in _RELOADABLE.items()
+                if attribute}
+    for name in _DEFAULT_SELECTORS:
+        settings[f'selector-{name}'] = list(SELECTORS[name])
+    return settings
+
+
+_env_settings = _startup_settings()
+
+
+def load_config(path):
+    """The settings with the file on top of the environment. Raises ValueError when invalid.
+
+    Every problem is collected, so one reload attempt tells about all of them,
+    and nothing is applied unless the whole file is good.
+    """
+    from dotenv import dotenv_values
+    settings = dict(_env_settings)
+    problems = []
+    for name, value in dotenv_values(path).items():
+        if name not in _RELOADABLE:
+            log.warning("'%s' in %s is not reloaded, it needs a restart", name, path)
+            continue
+        try:
+            settings[name] = _RELOADABLE[name][1](value or '')
+        except ValueError as error:
+            problems.append(f"{name}: {error}")
+    for name in _DEFAULT_SELECTORS:
+        if not settings[f'selector-{name}']:
+            problems.append(f"selector-{name}: no selectors")
+    try:
+        # every profile again, those of 'site-profiles-file' take the patterns
+        # they leave out from here as well. That compiles every pattern, so a
+        # broken regex or format is caught here
+        settings['profiles'] = _load_profiles(total_pattern=settings['pattern-total'],
+                                              meter_id_pattern=settings['pattern-meter-id'],
+                                              datetime_format=settings['datetime-format'])
+        datetime.now().strftime(settings['datetime-format'])
+    except (re.error, ValueError, OSError) as error:
+        problems.append(f"patterns: {error}")
+    else:
+        if site_profile != 'auto' and site_profile not in settings['profiles']:
+            problems.append(f"site-profile: '{site_profile}' is not in {site_profiles_file}")
+    if problems:
+        raise ValueError('; '.join(problems))
+    return settings
+
+
+def apply_config(settings):
+    """Swap the settings in. Only called between runs, so a run sees one config."""
+    global SELECTORS, _overridden_selectors, PROFILES, _detected_profile
+    updates = {attribute: settings[name] for name, (attribute, _) in _RELOADABLE.items()
+               if attribute}
+    selectors = {name: settings[f'selector-{name}'] for name in _DEFAULT_SELECTORS}
+    overridden = {name for name in _DEFAULT_SELECTORS
+                  if selectors[name] != _parse_selectors(_DEFAULT_SELECTORS[name])}
+    globals().update(updates)
+    SELECTORS = selectors
+    _overridden_selectors = overridden
+    PROFILES = settings['profiles']
+    _detected_profile = None
+    log.setLevel(getattr(logging, log_level.upper()))
+
+
+class ConfigWatcher:
+    """Reload 'config-file' when it changes, or on SIGHUP.
+
+    Checked at the start of every run, so a change takes effect with the next
+    run. A file that does not validate is rejected as a whole, and the running
+    config stays.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.loaded = None
+        self.requested = Event()
+
+    def install(self):
+        from signal import SIGHUP, signal
+        signal(SIGHUP, lambda signum, frame: self.requested.set())
+        return self
+
+    def _mtime(self):
+        from os import stat
+        try:
+            info = stat(self.path)
+        except OSError:
+            return None
+        return (info.st_mtime_ns, info.st_size)
+
+    def check(self):
+        """Reload when asked to or when the file changed. True when a new config is in."""
+        mtime = self._mtime()
+        if not self.requested.is_set() and mtime == self.loaded:
+            return False
+        self.requested.clear()
+        self.loaded = mtime
+        if mtime is None:
+            log.warning("The config file %s is gone, keeping the current config", self.path)
+            return False
+        try:
+            settings = load_config(self.path)
+        except Exception as error:  # a bad file must never stop the scraper
+            log.error("Rejected the config in %s, keeping the current one: %s", self.path, error)
+            return False
+        apply_config(settings)
+        log.info("Loaded the config in %s", self.path)
+        return True
+
+
 def main():
     log.info("Starting, scraping every %s seconds", _run_timer)
-    while True:
-        try:
-            values = scrape()
-        except Exception as error:  # the loop must survive anything
-            log.exception("Unexpected error in the scrape loop: %s", error)
-            values = None
-        delay = _run_timer if values else retry_interval
-        log.info("Next run in %s seconds", delay)
-        sleep(delay)
+    watcher = ConfigWatcher(config_file).install() if config_file else None
+    accounts = load_accounts()
+    commands = CommandListener().start() if mqtt_commands else None
+    election = LeaderElection().start() if leader_lease_topic else None
+    cluster = Cluster().start() if cluster_topic else None
+    if cluster:
+        cluster.wait_for_nodes()
+    watching = watch_mode and len(accounts) == 1 and not cluster
+    if watch_mode and not watching:
+        log.warning("'watch-mode' keeps one dashboard open, so it needs a single account "
+                    "and no cluster. Scraping on a schedule instead")
+    if schedule_spread:
+        # replicas and containers started together do not log in together
+        offset = _start_offset(f'{node_id or gethostname()}/{mvf_username}')
+        log.info("Spreading the schedule, the first run is in %.0f seconds", offset)
+        sleep(offset)
+    retry = []  # the accounts that failed, tried again on their own until the next full run
+    full_at = 0.0
+    try:
+        while True:
+            if watcher:
+                watcher.check()
+            started = monotonic()
+            if election and not election.is_leader():
+                election.wait_for_leadership()
+            if commands:
+                commands.run_started()
+            batch = retry or (cluster.shard(accounts) if cluster else accounts)
+            try:
+                if watching:
+                    with use_account(accounts[0]):
+                        results = [watch(election.is_leader if election else None,
+                                         watcher.check if watcher else None)]
+                else:
+                    results = scrape_accounts(batch, spread=not retry)
+            except Exception as error:  # the loop must survive anything
+                log.exception("Unexpected error in the scrape loop: %s", error)
+                results = [None] * max(1, len(batch))
+            if commands:
+                commands.run_finished(results, batch)
+            if watching:
+                # when the session ran out, log in again soon
+                delay = _WATCH_RESTART if all(results) else retry_interval
+            else:
+                if not retry:  # a full run, the next one is an interval away
+                    delay = _run_timer
+                    if schedule_spread:  # the spread accounts took up the interval
+                        delay = max(0, round(delay - (monotonic() - started)))
+                    full_at = monotonic() + delay
+                else:
+                    delay = max(0, round(full_at - monotonic()))
+                # one bad password must not send every account back to the site
+                failed = [account for account, result in zip(batch, results) if result is None]
+                retry = failed if failed and retry_interval < delay else []
+                if retry:
+                    delay = retry_interval
+                    log.info("Trying the %s failed of %s accounts again", len(retry), len(batch))
+            log.info("Next run in %s seconds", delay)
+            if commands:
+                commands.wait(delay)
+            else:
+                sleep(delay)
+    finally:
+        # a standby takes over right away instead of waiting for the lease to run out
+        if election:
+            election.stop()
+        if cluster:
+            cluster.stop()
+        if commands:
+            commands.stop()
 
 
 if __name__ == "__main__":
@@ -509,3 +3571,5 @@ if __name__ == "__main__":
         main()
     except KeyboardInterrupt:
         log.info("Stopped")
+    finally:
+        close_sinks()
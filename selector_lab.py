@@ -0,0 +1,159 @@
+"""Try selectors and patterns against saved pages, without the site.
+
+    python selector_lab.py debug/ saved/dashboard.html
+
+Every .html and .html.gz under the given paths (what debug-dir collects, or
+pages saved from a browser) is loaded into one headless page, one after the
+other, and every candidate in SELECTORS is evaluated against it, together with
+the total and meter id patterns and the timestamp regex of the site profile.
+The 'selector-*' and 'pattern-*' variables are read like the scraper reads
+them, so an override can be checked against hundreds of pages before it is
+deployed.
+"""
+import os
+import re
+import sys
+from argparse import ArgumentParser
+from time import perf_counter
+
+# the lab never talks to mqtt or the site, but app wants them configured
+for _name in ('mqtt-broker', 'username', 'password'):
+    os.environ.setdefault(_name, 'selector-lab')
+
+import app  # noqa: E402
+
+SYMBOLS = {'match': '+', 'unparsable': '~', None: '.', 'error': '!'}
+
+_PARSERS = {
+    'total': app._parse_decimal,
+    'meter-id': lambda text: int(re.sub(r'\D', '', text)),
+}
+
+
+def snapshots(paths):
+    """The saved pages under `paths`, sorted so two runs print the same."""
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                found.extend(os.path.join(root, name) for name in names
+                             if name.endswith(('.html', '.htm', '.html.gz')))
+        else:
+            found.append(path)
+    return sorted(found)
+
+
+def read_snapshot(path):
+    if path.endswith('.gz'):
+        from gzip import open as gzip_open
+        with gzip_open(path, 'rt', encoding='utf-8') as handle:
+            return handle.read()
+    with open(path, encoding='utf-8') as handle:
+        return handle.read()
+
+
+def columns(profile):
+    """(kind, target, selector or compiled pattern), in the order find() tries them."""
+    result = [('selector', target, selector)
+              for target in app.SELECTORS for selector in profile.candidates(target)]
+    result += [('pattern', 'total', profile.total_re),
+               ('pattern', 'meter-id', profile.meter_id_re),
+               ('pattern', 'timestamp', profile.timestamp_re)]
+    return result
+
+
+def _parses(target, text, profile):
+    parser = profile.parse_timestamp if target == 'timestamp' else _PARSERS.get(target)
+    if parser is None:  # a button or an input, being there is all it takes
+        return True
+    try:
+        parser(text)
+    except ValueError:
+        return False
+    return True
+
+
+def evaluate(page, columns, profile):
+    """(outcome, seconds) of every column on the page that is loaded now."""
+    results = []
+    body = None
+    for kind, target, candidate in columns:
+        started = perf_counter()
+        if kind == 'selector':
+            locator = page.locator(candidate).first
+            try:
+                text = locator.inner_text() if locator.is_visible() else None
+            except app.PlaywrightError:  # not a selector playwright understands
+                results.append(('error', perf_counter() - started))
+                continue
+        else:
+            if body is None:
+                body = app._body_text(page)
+            match = candidate.search(body)
+            text = (match.group(1) if match.groups() else match.group(0)) if match else None
+        if text is None:
+            outcome = None
+        else:
+            outcome = 'match' if _parses(target, text.strip(), profile) else 'unparsable'
+        results.append((outcome, perf_counter() - started))
+    return results
+
+
+def run(paths, profile, playwright_factory=None):
+    """[(snapshot, results)] for every snapshot, in one browser and one page."""
+    playwright_factory = playwright_factory or app.sync_playwright
+    table = columns(profile)
+    rows = []
+    with playwright_factory() as playwright:
+        browser = playwright.chromium.launch(headless=True, args=['--disable-dev-shm-usage'])
+        try:
+            # the saved DOM is already rendered: no scripts, and nothing from the network
+            context = browser.new_context(java_script_enabled=False)
+            context.route('**/*', lambda route: route.abort())
+            page = context.new_page()
+            for path in paths:
+                page.set_content(read_snapshot(path), wait_until='domcontentloaded')
+                rows.append((path, evaluate(page, table, profile)))
+        finally:
+            browser.close()
+    return table, rows
+
+
+def report(table, rows, out=sys.stdout):
+    """The legend with hit counts and timings, then a row of symbols per snapshot."""
+    width = len(str(len(table)))
+    for index, (kind, target, candidate) in enumerate(table):
+        hits = sum(1 for _, results in rows if results[index][0] == 'match')
+        average = sum(results[index][1] for _, results in rows) / max(1, len(rows)) * 1000
+        shown = candidate.pattern if kind == 'pattern' else candidate
+        print(f"c{index + 1:<{width}} {target:<14} {kind:<8} {hits:>4}/{len(rows)} "
+              f"{average:6.2f} ms  {shown}", file=out)
+    print(file=out)
+    print("  ".join(f"{symbol} {name or 'no match'}" for name, symbol in SYMBOLS.items()),
+          file=out)
+    for path, results in rows:
+        print(''.join(SYMBOLS[outcome] for outcome, _ in results), path, file=out)
+
+
+def main(argv=None):
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('paths', nargs='+', help="saved pages, or directories of them")
+    parser.add_argument('--profile', choices=sorted(app.PROFILES),
+                        help="site profile to take the patterns from (default: as the scraper picks)")
+    args = parser.parse_args(argv)
+
+    paths = snapshots(args.paths)
+    if not paths:
+        print("No .html or .html.gz files found", file=sys.stderr)
+        return 2
+    profile = app.PROFILES[args.profile] if args.profile else app.current_profile()
+    started = perf_counter()
+    table, rows = run(paths, profile)
+    report(table, rows)
+    print(f"\n{len(rows)} snapshots, {len(table)} candidates, profile '{profile.name}', "
+          f"{perf_counter() - started:.1f}s")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
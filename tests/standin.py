@@ -0,0 +1,250 @@
+"""
+Stand-ins for the site and the mqtt broker, for tests that need the real network.
+
+The site is the picker -> login form -> dashboard of minvandforsyning.dk in
+three pages, and it can be told to misbehave the ways the real one does: slow
+pages, error responses, a dashboard that renders late or waits for a websocket
+that never answers, and ids that changed. The broker speaks just enough MQTT
+3.1.1 for paho to connect, publish and subscribe, and keeps what was published.
+"""
+import socket
+import threading
+import time
+from base64 import b64encode
+from hashlib import sha1
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+PICKER = (
+    "<html><head><meta charset='utf-8'></head><body><div><div>"
+    "<div>a</div><div><div>x</div><div>y</div><div>"
+    "<button onclick=\"location.href='login.html'\"><span><p>"
+    "Log ind med Rambøll konto</p></span></button>"
+    "</div></div></div></div></body></html>"
+)
+LOGIN = (
+    "<html><head><meta charset='utf-8'></head><body>"
+    "<form action='dashboard.html'>"
+    "<input id='signInName' name='signInName'>"
+    "<input type='password' name='password'>"
+    "<button id='next' type='submit'>Log ind</button>"
+    "</form></body></html>"
+)
+# the login form after a redesign: only the fallback selectors still match
+CHANGED_LOGIN = (
+    "<html><head><meta charset='utf-8'></head><body>"
+    "<form action='dashboard.html'>"
+    "<input id='email' name='email' type='email'>"
+    "<input type='password' name='secret'>"
+    "<button id='continue' type='submit'>Log ind</button>"
+    "</form></body></html>"
+)
+VALUES = (
+    "<span><b>23522852</b></span>"
+    "<span><b>kl. 18.58, d. 07.10.2024</b><b>1.234,50</b></span>"
+)
+DASHBOARD = (
+    "<html><head><meta charset='utf-8'></head><body><div>"
+    f"{VALUES}"
+    "</div></body></html>"
+)
+# the values are rendered by script, after `delay` ms and, like blazor, only
+# once the websocket has sent something when `websocket` is true
+RENDERED_DASHBOARD = (
+    "<html><head><meta charset='utf-8'></head><body><div id='app'></div><script>"
+    "function render() {{ document.getElementById('app').innerHTML = \"{values}\"; }}"
+    "function later() {{ setTimeout(render, {delay}); }}"
+    "if ({websocket}) {{"
+    "  new WebSocket('ws://' + location.host + '/_blazor').onmessage = later;"
+    "}} else {{ later(); }}"
+    "</script></body></html>"
+)
+_WEBSOCKET_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+# the picker button sits at a different path in this copy of the site
+SELECTORS = {'login-provider': ['role=button[name=/Ramb/i]']}
+
+
+class StandInSite:
+    """Serve the three pages from `directory` on a free port, with the faults asked for.
+
+    slow: page -> seconds every response of it takes
+    errors: page -> status codes its next requests get, one per request
+    late_render: seconds before the dashboard shows the values
+    websocket: the dashboard waits for a message on '/_blazor' before it renders
+    hang_websockets: that many websockets are accepted and then never answered
+    changed_ids: the login form only matches the fallback selectors
+    """
+
+    def __init__(self, directory, slow=None, errors=None, late_render=0, websocket=False,
+                 hang_websockets=0, changed_ids=False):
+        self.slow = dict(slow or {})
+        self.errors = {page: list(codes) for page, codes in (errors or {}).items()}
+        self.hang_websockets = hang_websockets
+        self.requests = []
+        self.stopped = threading.Event()
+        self._lock = threading.Lock()
+        if late_render or websocket or hang_websockets:
+            dashboard = RENDERED_DASHBOARD.format(
+                values=VALUES, delay=int(late_render * 1000),
+                websocket='true' if websocket or hang_websockets else 'false')
+        else:
+            dashboard = DASHBOARD
+        for name, html in (('index.html', PICKER),
+                           ('login.html', CHANGED_LOGIN if changed_ids else LOGIN),
+                           ('dashboard.html', dashboard)):
+            (directory / name).write_text(html, encoding='utf-8')
+        site = self
+
+        class Handler(SimpleHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # a browser will not upgrade a 1.0 response
+
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, directory=str(directory), **kwargs)
+
+            def do_GET(self):
+                page = self.path.split('?')[0].lstrip('/')
+                if page == '_blazor':
+                    return site._websocket(self)
+                status = site._fault(page)
+                if status:
+                    return self.send_error(status)
+                return super().do_GET()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}/index.html'
+
+    def _fault(self, page):
+        """Wait as long as `page` is slow, and the error status it gets this time, if any."""
+        time.sleep(self.slow.get(page, 0))
+        with self._lock:
+            codes = self.errors.get(page)
+            status = codes.pop(0) if codes else None
+            self.requests.append((page, status or 200))
+        return status
+
+    def _websocket(self, handler):
+        key = handler.headers.get('Sec-WebSocket-Key', '').encode()
+        handler.send_response(101)
+        handler.send_header('Upgrade', 'websocket')
+        handler.send_header('Connection', 'Upgrade')
+        accept = b64encode(sha1(key + _WEBSOCKET_GUID).digest()).decode()
+        handler.send_header('Sec-WebSocket-Accept', accept)
+        handler.end_headers()
+        handler.close_connection = True
+        with self._lock:
+            hang = self.hang_websockets > 0
+            self.hang_websockets -= 1 if hang else 0
+            self.requests.append(('_blazor', 101))
+        if not hang:
+            payload = b'{"render": true}'
+            handler.wfile.write(bytes([0x81, len(payload)]) + payload)
+            handler.wfile.flush()
+        # held open, and quiet when hung, until the browser goes away
+        handler.connection.settimeout(0.5)
+        while not self.stopped.is_set():
+            try:
+                if not handler.connection.recv(1024):
+                    return
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def _read_exactly(connection, size):
+    data = b''
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("closed")
+        data += chunk
+    return data
+
+
+class StandInBroker:
+    """An MQTT 3.1.1 broker that acknowledges everything and delivers nothing."""
+
+    def __init__(self):
+        self.server = socket.create_server(('127.0.0.1', 0))
+        self.port = self.server.getsockname()[1]
+        self.messages = []
+        self.connections = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self._accept, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.close()
+
+    def _accept(self):
+        while True:
+            try:
+                connection, _ = self.server.accept()
+            except OSError:  # stopped
+                return
+            threading.Thread(target=self._serve, args=(connection,), daemon=True).start()
+
+    def _serve(self, connection):
+        with self._lock:
+            self.connections += 1
+        try:
+            while self._packet(connection):
+                pass
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            connection.close()
+            with self._lock:
+                self.connections -= 1
+
+    def _packet(self, connection):
+        header = _read_exactly(connection, 1)[0]
+        length, shift = 0, 0
+        while True:
+            byte = _read_exactly(connection, 1)[0]
+            length += (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        body = _read_exactly(connection, length)
+        kind = header >> 4
+        if kind == 1:  # CONNECT
+            connection.sendall(b'\x20\x02\x00\x00')
+        elif kind == 3:  # PUBLISH
+            qos = (header >> 1) & 3
+            size = int.from_bytes(body[:2], 'big')
+            topic = body[2:2 + size].decode('utf-8')
+            rest = body[2 + size:]
+            packet_id, payload = (rest[:2], rest[2:]) if qos else (b'', rest)
+            with self._lock:
+                self.messages.append((topic, payload.decode('utf-8', 'replace')))
+            if qos == 1:
+                connection.sendall(b'\x40\x02' + packet_id)
+            elif qos == 2:
+                connection.sendall(b'\x50\x02' + packet_id)
+        elif kind == 6:  # PUBREL
+            connection.sendall(b'\x70\x02' + body[:2])
+        elif kind == 8:  # SUBSCRIBE
+            topics, index = 0, 2
+            while index < len(body):
+                index += 2 + int.from_bytes(body[index:index + 2], 'big') + 1
+                topics += 1
+            connection.sendall(bytes([0x90, 2 + topics]) + body[:2] + b'\x00' * topics)
+        elif kind == 12:  # PINGREQ
+            connection.sendall(b'\xd0\x00')
+        elif kind == 14:  # DISCONNECT
+            return False
+        return True
@@ -3,15 +3,23 @@ import pytest
 from unittest.mock import Mock, patch
 from playwright.sync_api import Error as PlaywrightError
 from playwright.sync_api import TimeoutError as PlaywrightTimeoutError
+from base64 import b64encode
 from datetime import datetime
+from http.client import IncompleteRead
+from threading import Event, Timer
+import gzip
+import itertools
 import json
 import sys
 import os
+import time
 
 # Set up environment variables before importing app
 os.environ.setdefault('mqtt-broker', 'test-broker')
 os.environ.setdefault('username', 'test-user')
 os.environ.setdefault('password', 'test-pass')
+# the mocks below live in this process, an attempt in a child process would not see them
+os.environ.setdefault('run-isolation', 'false')
 
 # Import the functions we want to test
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
@@ -43,12 +51,14 @@ class FakeLocator:
         self.present = present
         self.clicks = 0
         self.filled = []
+        self.waited = []
 
     @property
     def first(self):
         return self
 
     def wait_for(self, state=None, timeout=None):
+        self.waited.append(timeout)
         if not self.present:
             raise PlaywrightTimeoutError(f"Timeout {timeout}ms exceeded")
 
@@ -63,6 +73,9 @@ class FakeLocator:
     def fill(self, value):
         self.filled.append(value)
 
+    def count(self):
+        return 1 if self.present else 0
+
 
 class FakePage:
     """A page where only the given selectors resolve to an element."""
@@ -71,8 +84,13 @@ class FakePage:
         self.elements = elements or {}
         self.locators = {}
         self.goto_calls = []
+        self.url = 'about:blank'
         self.screenshots = []
         self.goto_error = None
+        self.handlers = {}
+
+    def on(self, event, handler):
+        self.handlers.setdefault(event, []).append(handler)
 
     def locator(self, selector):
         if selector not in self.locators:
@@ -82,6 +100,7 @@ class FakePage:
 
     def goto(self, url, timeout=None):
         self.goto_calls.append(url)
+        self.url = url
         if self.goto_error:
             raise self.goto_error
 
@@ -90,6 +109,8 @@ class FakePage:
 
     def screenshot(self, path=None, full_page=False):
         self.screenshots.append(path)
+        if path is None:
+            return b'png'
         with open(path, 'w') as handle:
             handle.write('png')
 
@@ -104,6 +125,9 @@ class FakeTracing:
 
     def stop(self, path=None):
         self.stopped_to = path
+        if path:
+            with open(path, 'w') as handle:
+                handle.write('trace')
 
 
 class FakeContext:
@@ -112,6 +136,15 @@ class FakeContext:
         self.tracing = FakeTracing()
         self.closed = False
         self.default_timeout = None
+        self.har = None
+        self.socket_routes = []
+        self.record_har_path = None
+
+    def route_from_har(self, har, **kwargs):
+        self.har = har
+
+    def route_web_socket(self, url, handler):
+        self.socket_routes.append((url, handler))
 
     def set_default_timeout(self, timeout):
         self.default_timeout = timeout
@@ -121,6 +154,10 @@ class FakeContext:
 
     def close(self):
         self.closed = True
+        # playwright writes the HAR when the context closes
+        if self.record_har_path:
+            with open(self.record_har_path, 'w') as handle:
+                handle.write('{"log": {}}')
 
 
 class FakeBrowser:
@@ -128,8 +165,11 @@ class FakeBrowser:
         self.context = FakeContext(page if page is not None else FakePage())
         self.closed = False
         self.close_error = None
+        self.context_options = None
 
-    def new_context(self):
+    def new_context(self, **options):
+        self.context_options = options
+        self.context.record_har_path = options.get('record_har_path')
         return self.context
 
     def close(self):
@@ -291,6 +331,125 @@ class TestReadValues:
             app.read_values(FakePage({'body': 'Ingen data'}))
 
 
+def profile(name, **spec):
+    import app
+
+    return app.SiteProfile(name, **{
+        'total_pattern': app.total_pattern,
+        'meter_id_pattern': app.meter_id_pattern,
+        'datetime_format': app.datetime_format,
+        **spec,
+    })
+
+
+class TestSiteProfiles:
+    """Tests for the per portal profiles"""
+
+    def test_the_fast_timestamp_parser_agrees_with_strptime(self):
+        import app
+
+        default = app.PROFILES['minvandforsyning']
+        text = 'kl. 18.58, d. 07.10.2024'
+
+        assert default.parse_timestamp(text) == datetime.strptime(text, app.datetime_format)
+
+    @pytest.mark.parametrize('text', ['07.10.24 18:58', '07.10.68 18:58', '07.10.69 18:58',
+                                      '07.10.99 18:58'])
+    def test_two_digit_years_pivot_like_strptime(self, text):
+        site = profile('short', datetime_format='%d.%m.%y %H:%M')
+
+        assert site.parse_timestamp(text) == datetime.strptime(text, '%d.%m.%y %H:%M')
+
+    def test_formats_the_fast_parser_does_not_know_use_strptime(self):
+        site = profile('english', datetime_format='%d %b %Y %H:%M')
+
+        assert site.parse_timestamp('07 Oct 2024 18:58') == datetime(2024, 10, 7, 18, 58)
+
+    def test_a_bad_timestamp_still_raises(self):
+        import app
+
+        with pytest.raises(ValueError):
+            app.PROFILES['minvandforsyning'].parse_timestamp('i går')
+
+    def test_the_profile_is_picked_by_domain(self):
+        import app
+
+        other = profile('other', domains=['vand.example.dk'])
+        with patch.object(app, 'PROFILES', {**app.PROFILES, 'other': other}), \
+                patch.object(app, 'login_url', 'https://vand.example.dk/login'):
+            assert app.current_profile() is other
+
+    def test_the_profile_is_detected_from_the_page_and_remembered(self):
+        import app
+
+        first = profile('first', detect='Forsyning A')
+        second = profile('second', detect='Forsyning B')
+        page = FakePage({'body': 'Velkommen til Forsyning B'})
+
+        with patch.object(app, 'PROFILES', {'first': first, 'second': second}), \
+                patch.object(app, '_detected_profile', None), \
+                patch.object(app, 'login_url', 'http://127.0.0.1/index.html'):
+            assert app.current_profile() is first  # nothing to go by before the dashboard
+            assert app.current_profile(page) is second
+            assert app.current_profile() is second
+
+    def test_a_profile_has_its_own_selectors(self):
+        import app
+
+        site = profile('other', selectors={'total': '#forbrug||.total'})
+
+        assert site.candidates('total') == ['#forbrug', '.total']
+        assert site.candidates('username') == app.SELECTORS['username']
+
+    def test_a_selector_override_beats_the_profile(self):
+        import app
+
+        site = profile('other', selectors={'total': '#forbrug'})
+        with patch.object(app, '_overridden_selectors', {'total'}):
+            assert site.candidates('total') == app.SELECTORS['total']
+
+    def test_profiles_can_be_added_from_a_file(self, tmp_path):
+        import app
+
+        path = tmp_path / 'profiles.json'
+        path.write_text(json.dumps({
+            'nordvand': {'domains': ['nordvand.dk'], 'total_pattern': r'(\d+,\d+) kubik'},
+        }))
+        with patch.object(app, 'site_profiles_file', str(path)):
+            profiles = app._load_profiles()
+
+        assert set(profiles) == {'minvandforsyning', 'nordvand'}
+        assert profiles['nordvand'].total_re.search('i alt 12,5 kubik').group(1) == '12,5'
+        # the rest comes from the global settings
+        assert profiles['nordvand'].datetime_format == app.datetime_format
+
+    def test_an_unknown_key_in_the_file_is_named(self, tmp_path):
+        import app
+
+        path = tmp_path / 'profiles.json'
+        path.write_text(json.dumps({'nordvand': {'domains': ['nordvand.dk'], 'totl_pattern': 'x'}}))
+        with patch.object(app, 'site_profiles_file', str(path)), \
+                pytest.raises(ValueError, match="'totl_pattern' in profile 'nordvand'"):
+            app._load_profiles()
+
+    def test_values_are_read_with_the_profile_of_the_portal(self):
+        import app
+
+        site = profile('other', domains=['127.0.0.1'], selectors={'total': '#forbrug'},
+                       datetime_format='%d-%m-%Y %H:%M')
+        page = FakePage({
+            '#forbrug': '12,50',
+            'xpath=//b': '23522852',
+            'xpath=//span[2]/b': '07-10-2024 18:58',
+        })
+        with patch.object(app, 'PROFILES', {'other': site}), \
+                patch.object(app, 'login_url', 'http://127.0.0.1/'):
+            values = app.read_values(page)
+
+        assert values['total'] == 12.5
+        assert values['timestamp'] == '2024-10-07 18:58:00'
+
+
 class TestPublishMessage:
     """Tests for MQTT publishing with retries"""
 
@@ -392,6 +551,45 @@ class TestDiscoveryConfig:
         for _, config in app.discovery_config(23522852):
             json.loads(json.dumps(config))
 
+    def test_the_device_format_is_one_config_per_meter(self):
+        import app
+
+        with patch.object(app, 'discovery_format', 'device'):
+            configs = app.discovery_config(23522852)
+
+        assert [topic for topic, _ in configs] == [
+            'homeassistant/device/minvandforsyning_23522852/config']
+        config = configs[0][1]
+        # device, origin and availability are given once for all entities
+        assert config['device']['identifiers'] == ['minvandforsyning_23522852']
+        assert config['availability_topic'] == app.mqtt_status_topic
+        assert set(config['components']) == {'total', 'timestamp', 'meter_id'}
+        total = config['components']['total']
+        assert total['platform'] == 'sensor'
+        assert total['state_topic'] == app.mqtt_topic
+        assert total['device_class'] == 'water'
+        assert total['unique_id'] == 'minvandforsyning_23522852_total'
+        assert 'device' not in total
+
+    def test_both_formats_declare_the_same_entities(self):
+        import app
+
+        with patch.object(app, 'mqtt_commands', True):
+            by_entity = {config['unique_id']: config for _, config in app.discovery_config(1)}
+            device = app.discovery_config(1, 'device')[0][1]
+
+        # so switching format keeps the entities and their history
+        assert 'state_topic' not in device
+        for component in device['components'].values():
+            entity = by_entity[component['unique_id']]
+            assert {key: value for key, value in component.items() if key != 'platform'} == {
+                key: value for key, value in entity.items()
+                if key not in ('device', 'origin')
+                and not key.startswith(('availability', 'payload_'))
+                or key == 'payload_press'}
+        # a button has no state, in either format
+        assert 'state_topic' not in device['components']['read_now']
+
 
 class TestPublishDiscovery:
     """Tests for announcing the entities"""
@@ -424,6 +622,17 @@ class TestPublishDiscovery:
 
         assert mock_publish.call_count == 6
 
+    @patch('app.publish')
+    def test_the_device_format_is_a_single_message(self, mock_publish):
+        import app
+
+        with patch.object(app, 'discovery_format', 'device'):
+            app.publish_discovery(23522852)
+
+        mock_publish.assert_called_once()
+        assert mock_publish.call_args[0][0] == 'homeassistant/device/minvandforsyning_23522852/config'
+        assert mock_publish.call_args[1]['retain'] is True
+
     @patch('app.publish')
     def test_can_be_disabled(self, mock_publish):
         import app
@@ -443,353 +652,3022 @@ class TestPublishDiscovery:
 
         assert 23522852 not in app._announced_meters
 
-
-class TestScrapeFunction:
-    """Tests for the scrape function"""
-
     @patch('app.publish')
-    @patch('app.sleep')
-    def test_scrape_success(self, mock_sleep, mock_publish):
-        """Test successful scraping and MQTT publishing"""
+    def test_a_changed_config_is_announced_again(self, mock_publish):
         import app
 
-        page = dashboard_page()
-        browser = FakeBrowser(page)
-
-        with patch('app.sync_playwright', fake_playwright()), \
-                patch('app.open_browser', return_value=browser):
-            values = app.scrape()
-
-        assert page.goto_calls == [app.login_url]
-        # the credentials went into the form
-        assert page.locators['#signInName'].filled == [app.mvf_username]
-        assert page.locators['input[type=password]'].filled == [app.mvf_password]
-        assert page.locators['#next'].clicks == 1
-        assert browser.closed and browser.context.closed
-
-        messages = published(mock_publish)
-        parsed_msg = json.loads(messages[app.mqtt_topic][0])
-        assert parsed_msg['total'] == 234.32
-        assert parsed_msg['meter_id'] == 23522852
-        assert parsed_msg['timestamp_iso'] == '2024-10-07T18:58:00+02:00'
-        assert values['total'] == 234.32
+        app.publish_discovery(23522852)
+        with patch.object(app, 'device_name', 'Kitchen'):
+            app.publish_discovery(23522852)
 
-        # the entities are announced to home assistant before the reading
-        assert mock_publish.call_args_list[0][0][0].startswith('homeassistant/sensor/')
-        assert messages[app.mqtt_status_topic] == ['online']
+        assert mock_publish.call_count == 6
+        assert json.loads(mock_publish.call_args[0][1])['device']['name'] == 'Kitchen'
 
     @patch('app.publish')
-    @patch('app.sleep')
-    def test_scrape_mqtt_connection_error(self, mock_sleep, mock_publish):
-        """Test scrape handles MQTT connection errors without crashing"""
+    def test_the_state_survives_a_restart(self, mock_publish, tmp_path):
         import app
 
-        browsers = [FakeBrowser(dashboard_page()) for _ in range(app.max_attempts)]
-        mock_publish.side_effect = ConnectionRefusedError("Connection refused")
+        with patch.object(app, 'state_dir', str(tmp_path)), \
+                patch.object(app, '_discovery_state', {}):
+            app.publish_discovery(23522852)
+            # a restart: nothing in memory, only what is on disk
+            app._announced_meters.clear()
+            with patch.object(app, '_discovery_state', app._load_discovery_state()):
+                app.publish_discovery(23522852)
 
-        with patch('app.sync_playwright', fake_playwright()), \
-                patch('app.open_browser', side_effect=browsers):
-            assert app.scrape() is None
+        assert mock_publish.call_count == 3
+        assert json.loads((tmp_path / 'discovery.json').read_text()) == {
+            '23522852': app._discovery_digest(app.discovery_config(23522852))}
 
-        # every attempt closed its browser
-        assert all(browser.closed for browser in browsers)
+    def test_a_broken_state_file_announces_again(self, tmp_path):
+        import app
+
+        (tmp_path / 'discovery.json').write_text('{not json')
+        with patch.object(app, 'state_dir', str(tmp_path)):
+            assert app._load_discovery_state() == {}
 
     @patch('app.publish')
-    @patch('app.sleep')
-    def test_scrape_general_exception(self, mock_sleep, mock_publish):
-        """Test scrape survives an exception and retries"""
+    def test_only_what_differs_on_the_broker_is_published(self, mock_publish):
         import app
 
-        page = FakePage()
-        page.goto_error = Exception("Test exception")
-        browser = FakeBrowser(page)
-
-        with patch('app.sync_playwright', fake_playwright()), \
-                patch('app.open_browser', return_value=browser):
-            assert app.scrape() is None
+        configs = app.discovery_config(23522852)
+        on_broker = {topic: json.dumps(config) for topic, config in configs[:2]}
+        # the broker has an old version of the last one
+        on_broker[configs[2][0]] = '{"name": "old"}'
+        with patch.object(app, 'mqtt_discovery_verify', True), \
+                patch('app.retained_messages', return_value=on_broker):
+            app.publish_discovery(23522852)
 
-        assert len(page.goto_calls) == app.max_attempts
+        assert [call_args[0][0] for call_args in mock_publish.call_args_list] == [configs[2][0]]
 
     @patch('app.publish')
-    @patch('app.sleep')
-    def test_scrape_survives_a_browser_that_will_not_start(self, mock_sleep, mock_publish):
-        """A browser that cannot launch must not kill the job"""
+    def test_verify_trusts_the_broker_over_the_state_file(self, mock_publish):
         import app
 
-        with patch('app.sync_playwright', fake_playwright()), \
-                patch('app.open_browser',
-                      side_effect=PlaywrightError("browser closed")) as mock_open:
-            assert app.scrape() is None
+        digest = app._discovery_digest(app.discovery_config(23522852))
+        with patch.object(app, 'mqtt_discovery_verify', True), \
+                patch.object(app, '_discovery_state', {23522852: digest}), \
+                patch('app.retained_messages', return_value={}):
+            app.publish_discovery(23522852)
 
-        assert mock_open.call_count == app.max_attempts
+        # the state file says announced, but the broker lost it
+        assert mock_publish.call_count == 3
 
     @patch('app.publish')
-    @patch('app.sleep')
-    def test_scrape_survives_a_timeout(self, mock_sleep, mock_publish):
-        """A page that never loads must not kill the job"""
+    def test_switching_format_clears_the_other_one(self, mock_publish):
         import app
 
-        page = FakePage()
-        page.goto_error = PlaywrightTimeoutError("Timeout 60000ms exceeded")
+        app.publish_discovery(23522852)
+        with patch.object(app, 'discovery_format', 'device'):
+            app.publish_discovery(23522852)
 
-        with patch('app.sync_playwright', fake_playwright()), \
-                patch('app.open_browser', return_value=FakeBrowser(page)):
-            assert app.scrape() is None
+        sent = [(call_args[0][0], call_args[0][1]) for call_args in mock_publish.call_args_list]
+        entity_topics = [topic for topic, _ in app.discovery_config(23522852)]
+        # the old entities go before the device declares them again
+        assert sent[3:6] == [(topic, '') for topic in entity_topics]
+        assert sent[6][0] == 'homeassistant/device/minvandforsyning_23522852/config'
+        assert all(call_args[1]['retain'] for call_args in mock_publish.call_args_list)
 
     @patch('app.publish')
-    @patch('app.sleep')
-    def test_scrape_recovers_on_the_second_attempt(self, mock_sleep, mock_publish):
-        """A transient failure is retried within the same run"""
+    def test_verify_clears_what_the_broker_has_of_the_other_format(self, mock_publish):
         import app
 
-        broken = FakePage()
-        broken.goto_error = PlaywrightTimeoutError("Timeout")
-
-        with patch('app.sync_playwright', fake_playwright()), \
-                patch('app.open_browser',
-                      side_effect=[FakeBrowser(broken), FakeBrowser(dashboard_page())]):
-            values = app.scrape()
+        configs = app.discovery_config(23522852)
+        device_topic = 'homeassistant/device/minvandforsyning_23522852/config'
+        on_broker = {topic: json.dumps(config) for topic, config in configs}
+        on_broker[device_topic] = '{"components": {}}'
+        with patch.object(app, 'mqtt_discovery_verify', True), \
+                patch('app.retained_messages', return_value=on_broker):
+            app.publish_discovery(23522852)
 
-        assert values['total'] == 234.32
-        assert len(published(mock_publish)[app.mqtt_topic]) == 1
+        assert [call_args[0][:2] for call_args in mock_publish.call_args_list] == [
+            (device_topic, '')]
 
     @patch('app.publish')
-    @patch('app.sleep')
-    def test_browser_close_error_is_not_fatal(self, mock_sleep, mock_publish):
-        """A browser that cannot be closed must not take the job down"""
+    def test_an_unreachable_broker_publishes_everything(self, mock_publish):
         import app
 
-        browser = FakeBrowser(dashboard_page())
-        browser.close_error = PlaywrightError("browser already gone")
+        with patch.object(app, 'mqtt_discovery_verify', True), \
+                patch('app.retained_messages', side_effect=OSError("refused")):
+            app.publish_discovery(23522852)
 
-        with patch('app.sync_playwright', fake_playwright()), \
-                patch('app.open_browser', return_value=browser):
-            values = app.scrape()
+        assert mock_publish.call_count == 3
 
-        assert values['total'] == 234.32
 
+HOUR = 60 * 60
 
-class TestBrowserOptions:
-    """Tests for how the browser is started"""
 
-    def test_launches_its_own_chromium(self):
+class TestRollingUsage:
+    """Tests for the hourly, daily and monthly usage sensors"""
+
+    def test_usage_per_window(self):
         import app
 
-        playwright = Mock()
-        app.open_browser(playwright)
+        usage = app.RollingUsage()
+        for hour in range(49):  # two days of readings, 10 litres an hour
+            usage.add(hour * HOUR, 100 + hour * 0.01)
 
-        playwright.chromium.launch.assert_called_once()
-        kwargs = playwright.chromium.launch.call_args[1]
-        assert kwargs['headless'] is True
-        assert '--disable-dev-shm-usage' in kwargs['args']
-        playwright.chromium.connect_over_cdp.assert_not_called()
+        result = usage.usage()
+        assert result['hour'] == 0.01
+        assert result['day'] == 0.24
+        assert result['month'] == 0.48
+        assert result['flow'] == round(10 / 60, 3)
 
-    def test_connects_to_a_remote_browser_when_configured(self):
+    def test_the_windows_stay_small(self):
         import app
 
-        playwright = Mock()
-        with patch.object(app, 'browser_cdp_url', 'http://chrome:9222'):
-            app.open_browser(playwright)
+        usage = app.RollingUsage()
+        for hour in range(24 * 365):
+            usage.add(hour * HOUR, hour * 0.01)
 
-        playwright.chromium.connect_over_cdp.assert_called_once_with('http://chrome:9222')
-        playwright.chromium.launch.assert_not_called()
+        # the readings inside a window plus the one the usage is measured from
+        assert len(usage.windows['hour']) == 2
+        assert len(usage.windows['day']) == 25
+        assert len(usage.windows['month']) == 30 * 24 + 1
 
-    def test_a_custom_browser_build_can_be_used(self):
+    def test_a_gap_is_scaled_down_to_the_window(self):
         import app
 
-        playwright = Mock()
-        with patch.object(app, 'browser_executable', '/usr/bin/chromium'):
-            app.open_browser(playwright)
+        usage = app.RollingUsage([(0, 100.0), (4 * HOUR, 100.4)])
 
-        assert playwright.chromium.launch.call_args[1]['executable_path'] == '/usr/bin/chromium'
+        assert usage.usage()['hour'] == 0.1
 
-    @patch('app.publish')
-    @patch('app.sleep')
-    def test_each_run_gets_a_fresh_context(self, mock_sleep, mock_publish):
-        """A fresh context is the playwright equivalent of incognito"""
+    def test_the_same_reading_twice_is_ignored(self):
         import app
 
-        browser = FakeBrowser(dashboard_page())
-        with patch('app.sync_playwright', fake_playwright()), \
-                patch('app.open_browser', return_value=browser):
-            app.scrape()
+        usage = app.RollingUsage([(0, 100.0), (HOUR, 100.1)])
 
-        assert browser.context.default_timeout == app.element_timeout * 1000
-        assert browser.context.closed
+        assert usage.add(HOUR, 100.1) is False
+        assert usage.usage()['hour'] == 0.1
 
+    def test_a_new_meter_starts_over(self):
+        import app
 
-class TestDiagnostics:
-    """Tests for the failure diagnostics dump"""
+        usage = app.RollingUsage([(0, 900.0), (HOUR, 900.1), (2 * HOUR, 0.2)])
 
-    def test_dump_writes_page_source_and_screenshot(self, tmp_path):
+        assert usage.usage() == {'hour': 0.0, 'day': 0.0, 'month': 0.0, 'flow': 0.0}
+
+    @patch('app.publish')
+    def test_the_usage_is_published(self, mock_publish):
         import app
 
-        page = FakePage()
-        with patch.object(app, 'debug_dir', str(tmp_path)):
-            app.dump_diagnostics(page, 'failure')
+        readings = [{'meter_id': 7, 'total': total, 'timestamp_iso': stamp}
+                    for total, stamp in ((1.0, '2024-10-07T18:00:00+02:00'),
+                                         (1.06, '2024-10-07T19:00:00+02:00'))]
+        with patch.object(app, 'usage_sensors', True), patch.object(app, '_usage', {}):
+            for values in readings:
+                app.publish_usage(values)
 
-        dumps = list(tmp_path.glob('*-failure.html'))
-        assert len(dumps) == 1
-        assert dumps[0].read_text() == '<html>changed layout</html>'
-        assert len(page.screenshots) == 1
+        message = json.loads(published(mock_publish)[app.mqtt_usage_topic][-1])
+        assert message['meter_id'] == 7
+        assert message['hour'] == 0.06
+        assert message['flow'] == 1.0
 
-    def test_dump_is_skipped_without_a_debug_dir(self):
+    @patch('app.publish')
+    def test_off_by_default(self, mock_publish):
         import app
 
-        page = FakePage()
-        with patch.object(app, 'debug_dir', None):
-            app.dump_diagnostics(page, 'failure')
-
-        assert page.screenshots == []
+        assert app.publish_usage({'meter_id': 7, 'total': 1.0,
+                                  'timestamp_iso': '2024-10-07T18:00:00+02:00'}) is None
+        mock_publish.assert_not_called()
 
-    def test_dump_swallows_its_own_errors(self, tmp_path):
+    @patch('app.publish')
+    def test_the_history_survives_a_restart(self, mock_publish, tmp_path):
         import app
 
-        page = Mock()
-        page.content.side_effect = PlaywrightError("page closed")
+        with patch.object(app, 'usage_sensors', True), \
+                patch.object(app, 'state_dir', str(tmp_path)), \
+                patch.object(app, '_usage', {}):
+            app.publish_usage({'meter_id': 7, 'total': 1.0,
+                               'timestamp_iso': '2024-10-07T18:00:00+02:00'})
+            restarted = app._load_usage()
 
-        with patch.object(app, 'debug_dir', str(tmp_path)):
-            app.dump_diagnostics(page, 'failure')  # must not raise
+        assert restarted[7].samples() == app.RollingUsage(
+            [(datetime.fromisoformat('2024-10-07T18:00:00+02:00').timestamp(), 1.0)]).samples()
 
-    def test_a_trace_is_written_for_a_failed_run(self, tmp_path):
+    @patch('app.publish')
+    def test_a_broken_reading_does_not_raise(self, mock_publish):
         import app
 
-        context = FakeContext(FakePage())
-        with patch.object(app, 'debug_dir', str(tmp_path)):
-            assert app.save_trace(context, True) is False
-
-        assert context.tracing.stopped_to.endswith('-failure-trace.zip')
+        with patch.object(app, 'usage_sensors', True), patch.object(app, '_usage', {}):
+            assert app.publish_usage({'meter_id': 7, 'total': 1.0, 'timestamp_iso': 'x'}) is None
 
-    def test_no_trace_when_tracing_was_never_started(self):
+    def test_the_usage_sensors_are_discovered(self):
         import app
 
-        context = FakeContext(FakePage())
-        app.save_trace(context, False)
+        with patch.object(app, 'usage_sensors', True):
+            configs = dict(app.discovery_config(7))
 
-        assert context.tracing.stopped_to is None
+        day = configs['homeassistant/sensor/minvandforsyning_7/usage_day/config']
+        assert day['state_topic'] == app.mqtt_usage_topic
+        assert day['value_template'] == '{{ value_json.day }}'
+        flow = configs['homeassistant/sensor/minvandforsyning_7/flow/config']
+        assert flow['device_class'] == 'volume_flow_rate'
 
     @patch('app.publish')
     @patch('app.sleep')
-    def test_tracing_runs_when_a_debug_dir_is_set(self, mock_sleep, mock_publish, tmp_path):
+    def test_scrape_publishes_the_usage(self, mock_sleep, mock_publish):
         import app
 
-        page = FakePage()
-        page.goto_error = PlaywrightError("boom")
-        browser = FakeBrowser(page)
-
-        with patch.object(app, 'debug_dir', str(tmp_path)), \
-                patch.object(app, 'max_attempts', 1), \
+        with patch.object(app, 'usage_sensors', True), patch.object(app, '_usage', {}), \
                 patch('app.sync_playwright', fake_playwright()), \
-                patch('app.open_browser', return_value=browser):
+                patch('app.open_browser', return_value=FakeBrowser(dashboard_page())):
             app.scrape()
 
-        assert browser.context.tracing.started
-        assert browser.context.tracing.stopped_to.endswith('-failure-trace.zip')
+        assert app.mqtt_usage_topic in published(mock_publish)
 
 
-class TestDataParsing:
-    """Tests for data parsing and formatting"""
+def hourly_readings(days, day_flow=20.0, night_flow=0.0, start=1_700_000_000 // 86400 * 86400):
+    """Hourly readings of a meter, flows in L/h, midnight to 5 at night_flow."""
+    import numpy as np
+    times = start + np.arange(days * 24 + 1) * HOUR
+    hours = (times[:-1] // HOUR) % 24
+    litres = np.where(hours < 5, night_flow, day_flow)
+    totals = 100 + np.concatenate(([0.0], np.cumsum(litres) / 1000))
+    return np.column_stack((times.astype(float), totals))
 
-    def test_total_parsing(self):
-        """Test parsing of total value with comma decimal separator"""
-        from app import _parse_decimal
 
-        assert _parse_decimal("234,32") == 234.32
+class TestLeakDetection:
+    """Tests for spotting leaks in the reading history"""
 
-    def test_total_parsing_with_thousand_separator(self):
-        from app import _parse_decimal
+    def test_a_dry_night_is_no_leak(self):
+        import app
 
-        assert _parse_decimal("1.234,32") == 1234.32
+        result = app.analyse_history(hourly_readings(10))
 
-    def test_total_parsing_without_decimals(self):
-        from app import _parse_decimal
+        assert result['leak'] is False
+        assert result['night_flow'] == 0.0
+        assert result['leak_nights'] == 0
+
+    def test_water_running_every_night_is_a_leak(self):
+        import app
+
+        result = app.analyse_history(hourly_readings(10, night_flow=3.0))
+
+        assert result['leak'] is True
+        assert result['night_flow'] == 3.0
+        assert result['leak_nights'] == 10
+
+    def test_the_nights_have_to_be_in_a_row(self):
+        import app
+        import numpy as np
+
+        dry = hourly_readings(5)
+        wet = hourly_readings(2, night_flow=3.0, start=dry[-1, 0])
+        wet[:, 1] += dry[-1, 1] - wet[0, 1]
+
+        result = app.analyse_history(np.concatenate((dry, wet[1:])))
+
+        assert result['leak_nights'] == 2
+        assert result['leak'] is False
+
+    def test_a_spike_against_the_same_hour_last_weeks(self):
+        import app
+
+        readings = hourly_readings(35)
+        readings[-1, 1] += 0.5  # 500 litres in the last hour
+
+        result = app.analyse_history(readings)
+
+        assert result['spike'] is True
+        assert result['baseline'] == 20.0
+        assert result['flow'] == 520.0
+
+    def test_usual_use_is_no_spike(self):
+        import app
+
+        result = app.analyse_history(hourly_readings(35))
+
+        assert result['spike'] is False
+
+    def test_gaps_and_a_new_meter_are_left_out(self):
+        import app
+        import numpy as np
+
+        readings = hourly_readings(3, night_flow=3.0)
+        # a new meter, and a day without readings
+        readings[40:, 1] -= 50
+        readings = np.delete(readings, range(50, 60), axis=0)
+
+        result = app.analyse_history(readings)
+
+        assert result['night_flow'] == 3.0
+        assert result['readings'] == len(readings)
+
+    def test_duplicate_and_unsorted_readings(self):
+        import app
+        import numpy as np
+
+        readings = hourly_readings(10, night_flow=3.0)
+        shuffled = np.concatenate((readings, readings[:20]))[::-1]
+
+        assert app.analyse_history(shuffled) == app.analyse_history(readings)
+
+    def test_the_night_follows_the_clock_across_a_dst_change(self):
+        import app
+        import numpy as np
+        from zoneinfo import ZoneInfo
+
+        copenhagen = ZoneInfo('Europe/Copenhagen')
+        start = datetime(2024, 3, 26, tzinfo=copenhagen).timestamp()
+        times = start + np.arange(10 * 24) * HOUR
+        # water running from midnight to 5 on the clock, a trickle the rest of the day
+        hours = np.array([datetime.fromtimestamp(when, copenhagen).hour for when in times[:-1]])
+        litres = np.where(hours < 5, 3.0, 0.5)
+        totals = 100 + np.concatenate(([0.0], np.cumsum(litres) / 1000))
+
+        result = app.analyse_history(np.column_stack((times, totals)), copenhagen)
+
+        # the winter nights before the change are not an hour off
+        assert result['night_flow'] == 3.0
+        assert result['leak_nights'] == 10
+        assert result['leak'] is True
+
+    def test_years_of_readings_for_many_meters_are_fast(self):
+        import app
+        import time
+
+        readings = hourly_readings(3 * 365, night_flow=3.0)
+        started = time.perf_counter()
+        for _ in range(20):
+            app.analyse_history(readings, app.reading_timezone)
+
+        assert time.perf_counter() - started < 1
+
+    def test_the_history_is_kept_in_state_dir(self, tmp_path):
+        import app
+
+        with patch.object(app, 'state_dir', str(tmp_path)), patch.object(app, '_history_last', {}):
+            assert app.record_history(7, 1000.0, 1.5)
+            assert app.record_history(7, 2000.0, 1.6)
+            assert not app.record_history(7, 2000.0, 1.6)
+            # a restart reads the last time back from the file
+            app._history_last.clear()
+            assert not app.record_history(7, 2000.0, 1.6)
+
+            assert app.load_history(7).tolist() == [[1000.0, 1.5], [2000.0, 1.6]]
+        assert (tmp_path / 'history-7.bin').stat().st_size == 32
+
+    @patch('app.publish')
+    def test_the_result_is_published(self, mock_publish):
+        import app
+
+        readings = hourly_readings(4, night_flow=3.0)
+        with patch.object(app, 'leak_detection', True), \
+                patch.object(app, '_history', {7: [tuple(row) for row in readings[:-1].tolist()]}), \
+                patch.object(app, '_history_last', {7: readings[-2, 0]}):
+            stamp = datetime.fromtimestamp(readings[-1, 0], app.reading_timezone)
+            app.publish_leak({'meter_id': 7, 'total': readings[-1, 1],
+                              'timestamp_iso': stamp.isoformat()})
+
+        message = json.loads(published(mock_publish)[app.mqtt_leak_topic][0])
+        assert message['meter_id'] == 7
+        assert message['leak'] is True
+
+    def test_the_leak_sensor_is_a_discovered_binary_sensor(self):
+        import app
+
+        with patch.object(app, 'leak_detection', True):
+            configs = dict(app.discovery_config(7))
+            with patch.object(app, 'discovery_format', 'device'):
+                device = app.discovery_config(7)[0][1]
+
+        leak = configs['homeassistant/binary_sensor/minvandforsyning_7/leak/config']
+        assert leak['device_class'] == 'problem'
+        assert leak['json_attributes_topic'] == app.mqtt_leak_topic
+        assert 'platform' not in leak
+        assert device['components']['leak']['platform'] == 'binary_sensor'
+
+
+READING = {'total': 234.32, 'meter_id': 23522852, 'timestamp': '2024-10-07 18:58:00',
+           'timestamp_iso': '2024-10-07T18:58:00+02:00'}
+
+
+class TestSinks:
+    """Tests for the extra places a reading goes"""
+
+    def test_jsonl_file(self, tmp_path):
+        import app
+
+        sink = app.FileSink(str(tmp_path / 'readings.jsonl'), flush_interval=0.05)
+        sink.send(READING)
+        sink.send({**READING, 'total': 235.0})
+        sink.close()
+
+        lines = (tmp_path / 'readings.jsonl').read_text().splitlines()
+        assert [json.loads(line)['total'] for line in lines] == [234.32, 235.0]
+
+    def test_csv_file(self, tmp_path):
+        import app
+
+        for total in (1.5, 2.5):  # the header is only written once
+            sink = app.FileSink(str(tmp_path / 'readings.csv'), flush_interval=0.05)
+            sink.send({**READING, 'total': total})
+            sink.close()
+
+        assert (tmp_path / 'readings.csv').read_text().splitlines() == [
+            'timestamp_iso,meter_id,total,timestamp',
+            '2024-10-07T18:58:00+02:00,23522852,1.5,2024-10-07 18:58:00',
+            '2024-10-07T18:58:00+02:00,23522852,2.5,2024-10-07 18:58:00',
+        ]
+
+    def test_influx_line_protocol(self):
+        import app
+
+        with patch('app._post') as mock_post:
+            sink = app.InfluxSink('http://influx:8086/api/v2/write?bucket=water', token='secret',
+                                  flush_interval=0.05)
+            sink.send(READING)
+            sink.close()
+
+        url, body, content_type, headers = mock_post.call_args[0]
+        assert body == b'water,meter_id=23522852 total=234.32 1728320280000000000'
+        assert headers == {'Authorization': 'Token secret'}
+
+    def test_a_batch_is_one_request(self):
+        import app
+
+        with patch('app._post') as mock_post:
+            sink = app.WebhookSink('http://hook', flush_interval=0.2, batch_size=10)
+            for total in range(5):
+                sink.send({**READING, 'total': total})
+            sink.close()
+
+        assert mock_post.call_count == 1
+        assert [values['total'] for values in json.loads(mock_post.call_args[0][1])] == [
+            0, 1, 2, 3, 4]
+
+    def test_without_a_flush_interval_every_reading_is_written_at_once(self):
+        import app
+        from queue import Queue
+
+        class CountingQueue(Queue):
+            gets = 0
+
+            def get(self, *args, **kwargs):
+                CountingQueue.gets += 1
+                return super().get(*args, **kwargs)
+
+        written = Event()
+        with patch('app._post', side_effect=lambda *args: written.set()) as mock_post, \
+                patch('queue.Queue', CountingQueue):
+            sink = app.WebhookSink('http://hook', flush_interval=0, batch_size=10)
+            time.sleep(0.2)
+            idle = CountingQueue.gets
+            sink.send(READING)
+            assert written.wait(2)
+            sink.close()
+
+        # the thread waits for a reading instead of going round and round
+        assert idle == 1
+        assert len(json.loads(mock_post.call_args[0][1])) == 1
+
+    def test_a_failed_write_is_tried_again(self):
+        import app
+
+        with patch('app._post', side_effect=[OSError("down"), None]) as mock_post:
+            sink = app.WebhookSink('http://hook', flush_interval=0.05)
+            sink._closed.wait = lambda timeout: False  # no backoff in the test
+            sink.send(READING)
+            sink.close()
+
+        assert mock_post.call_count == 2
+        assert sink.pending == []
+
+    def test_a_full_queue_drops_readings(self):
+        import app
+
+        writing, release = Event(), Event()
+
+        def post(*args):
+            writing.set()
+            release.wait(5)
+
+        with patch('app._post', side_effect=post):
+            sink = app.WebhookSink('http://hook', flush_interval=0.05, queue_size=2, batch_size=1)
+            sink.send(READING)
+            writing.wait(5)
+            for total in range(10):  # the first is being written, the queue holds two
+                sink.send({**READING, 'total': total})
+            assert sink._queue.qsize() == 2
+            release.set()
+            sink.close()
+
+    def test_a_slow_sink_does_not_hold_up_the_others(self, tmp_path):
+        import app
+
+        release = Event()
+        with patch('app._post', side_effect=lambda *args: release.wait(5)):
+            slow = app.WebhookSink('http://hook', flush_interval=0.05)
+            fast = app.FileSink(str(tmp_path / 'readings.jsonl'), flush_interval=0.05)
+            with patch.object(app, '_sinks', [slow, fast]):
+                app.send_to_sinks(READING)
+            fast.close()
+            assert (tmp_path / 'readings.jsonl').read_text()
+            release.set()
+            slow.close()
+
+    def test_sinks_from_the_environment(self, tmp_path):
+        import app
+
+        sinks = app.create_sinks([f'file={tmp_path / "r.jsonl"}', 'influx=http://influx/write',
+                                  'carrier-pigeon=home', 'webhook='])
+        try:
+            assert [type(sink) for sink in sinks] == [app.FileSink, app.InfluxSink]
+            assert sinks[1].token == app.influx_token
+        finally:
+            for sink in sinks:
+                sink.close()
+
+    @patch('app.publish')
+    @patch('app.sleep')
+    def test_scrape_sends_the_reading_to_the_sinks(self, mock_sleep, mock_publish):
+        import app
+
+        sink = Mock()
+        with patch.object(app, '_sinks', [sink]), \
+                patch('app.sync_playwright', fake_playwright()), \
+                patch('app.open_browser', return_value=FakeBrowser(dashboard_page())):
+            values = app.scrape()
+
+        sink.send.assert_called_once_with(values)
+
+    def test_a_sink_has_to_implement_the_interface(self):
+        import app
+
+        class NoWrite(app.BufferedSink):
+            name = 'broken'
+
+        with pytest.raises(TypeError):
+            app.Sink()
+        with pytest.raises(TypeError):
+            NoWrite()
+
+    def test_every_sink_takes_a_reading_the_same_way(self, tmp_path):
+        import app
+
+        sink = app.FileSink(str(tmp_path / 'readings.jsonl'), flush_interval=0.05)
+        try:
+            assert sink.send(READING, deadline=app.Deadline(10)) is True
+        finally:
+            sink.close()
+
+    @patch('app.publish')
+    def test_mqtt_is_the_default_sink(self, mock_publish):
+        import app
+
+        assert app.MqttSink().send(READING) is True
+        assert json.loads(published(mock_publish)[app.mqtt_topic][0]) == READING
+
+
+class TestDeadline:
+    """Tests for the time budget of a run"""
+
+    def test_a_timeout_is_cut_to_what_is_left(self):
+        import app
+
+        with patch('app.monotonic', return_value=1000):
+            deadline = app.Deadline(30)
+        with patch('app.monotonic', return_value=1020):
+            assert deadline.limit(60) == 10
+            assert deadline.limit(5) == 5
+            assert deadline.limit(None) == 10
+
+    def test_a_spent_deadline_fails_fast(self):
+        import app
+
+        with patch('app.monotonic', return_value=1000):
+            deadline = app.Deadline(30)
+        with patch('app.monotonic', return_value=1031):
+            with pytest.raises(app.DeadlineExceededError):
+                deadline.limit(60)
+
+    def test_no_budget_changes_nothing(self):
+        import app
+
+        assert app.Deadline().limit(60) == 60
+        assert app.Deadline().remaining() is None
+
+    def test_find_waits_no_longer_than_the_budget(self):
+        import app
+
+        page = FakePage({})
+        with patch('app.monotonic', return_value=1000):
+            deadline = app.Deadline(3)
+            with pytest.raises(app.ElementNotFoundError):
+                app.find(page, 'submit', timeout=20, deadline=deadline)
+
+        # 4 candidates share 3 seconds instead of 20, with the 2 second floor
+        # still cut down to what the run has left
+        assert [locator.waited for locator in page.locators.values()] == [[2000]] * 4
+
+    @patch('app.sleep')
+    @patch('app.publish')
+    def test_publish_stops_retrying_when_the_budget_is_short(self, mock_publish, mock_sleep):
+        import app
+
+        mock_publish.side_effect = OSError("no broker")
+        with patch('app.monotonic', return_value=1000):
+            deadline = app.Deadline(3)
+            assert app.publish_message('topic', 'message', retries=5, deadline=deadline) is False
+
+        # 2 seconds fit in the budget, the 4 after them do not
+        assert mock_publish.call_count == 2
+        mock_sleep.assert_called_once_with(2)
+
+    @patch('app.publish')
+    @patch('app.sleep')
+    def test_scrape_does_not_retry_past_the_deadline(self, mock_sleep, mock_publish):
+        import app
+
+        with patch.object(app, 'run_deadline', 5), \
+                patch('app.scrape_once', side_effect=app.ElementNotFoundError("gone")) as mock_once:
+            assert app.scrape() is None
+
+        # the first backoff is at least 10 seconds, more than the run has left
+        assert mock_once.call_count == 1
+        mock_sleep.assert_not_called()
+
+    @patch('app.publish')
+    @patch('app.sleep')
+    def test_a_spent_deadline_ends_the_run(self, mock_sleep, mock_publish):
+        import app
+
+        with patch('app.scrape_once', side_effect=app.DeadlineExceededError("spent")) as mock_once:
+            assert app.scrape() is None
+
+        assert mock_once.call_count == 1
+
+
+class TestScrapeFunction:
+    """Tests for the scrape function"""
+
+    @patch('app.publish')
+    @patch('app.sleep')
+    def test_scrape_success(self, mock_sleep, mock_publish):
+        """Test successful scraping and MQTT publishing"""
+        import app
+
+        page = dashboard_page()
+        browser = FakeBrowser(page)
+
+        with patch('app.sync_playwright', fake_playwright()), \
+                patch('app.open_browser', return_value=browser):
+            values = app.scrape()
+
+        assert page.goto_calls == [app.login_url]
+        # the credentials went into the form
+        assert page.locators['#signInName'].filled == [app.mvf_username]
+        assert page.locators['input[type=password]'].filled == [app.mvf_password]
+        assert page.locators['#next'].clicks == 1
+        assert browser.closed and browser.context.closed
+
+        messages = published(mock_publish)
+        parsed_msg = json.loads(messages[app.mqtt_topic][0])
+        assert parsed_msg['total'] == 234.32
+        assert parsed_msg['meter_id'] == 23522852
+        assert parsed_msg['timestamp_iso'] == '2024-10-07T18:58:00+02:00'
+        assert values['total'] == 234.32
+
+        # the entities are announced to home assistant before the reading
+        assert mock_publish.call_args_list[0][0][0].startswith('homeassistant/sensor/')
+        assert messages[app.mqtt_status_topic] == ['online']
+
+    @patch('app.publish')
+    @patch('app.sleep')
+    def test_scrape_mqtt_connection_error(self, mock_sleep, mock_publish):
+        """Test scrape handles MQTT connection errors without crashing"""
+        import app
+
+        browsers = [FakeBrowser(dashboard_page()) for _ in range(app.max_attempts)]
+        mock_publish.side_effect = ConnectionRefusedError("Connection refused")
+
+        with patch('app.sync_playwright', fake_playwright()), \
+                patch('app.open_browser', side_effect=browsers):
+            assert app.scrape() is None
+
+        # every attempt closed its browser
+        assert all(browser.closed for browser in browsers)
+
+    @patch('app.publish')
+    @patch('app.sleep')
+    def test_scrape_general_exception(self, mock_sleep, mock_publish):
+        """Test scrape survives an exception and retries"""
+        import app
+
+        page = FakePage()
+        page.goto_error = Exception("Test exception")
+        browser = FakeBrowser(page)
+
+        with patch('app.sync_playwright', fake_playwright()), \
+                patch('app.open_browser', return_value=browser):
+            assert app.scrape() is None
+
+        assert len(page.goto_calls) == app.max_attempts
+
+    @patch('app.publish')
+    @patch('app.sleep')
+    def test_scrape_survives_a_browser_that_will_not_start(self, mock_sleep, mock_publish):
+        """A browser that cannot launch must not kill the job"""
+        import app
+
+        with patch('app.sync_playwright', fake_playwright()), \
+                patch('app.open_browser',
+                      side_effect=PlaywrightError("browser closed")) as mock_open:
+            assert app.scrape() is None
+
+        assert mock_open.call_count == app.max_attempts
+
+    @patch('app.publish')
+    @patch('app.sleep')
+    def test_scrape_survives_a_timeout(self, mock_sleep, mock_publish):
+        """A page that never loads must not kill the job"""
+        import app
+
+        page = FakePage()
+        page.goto_error = PlaywrightTimeoutError("Timeout 60000ms exceeded")
+
+        with patch('app.sync_playwright', fake_playwright()), \
+                patch('app.open_browser', return_value=FakeBrowser(page)):
+            assert app.scrape() is None
+
+    @patch('app.publish')
+    @patch('app.sleep')
+    def test_scrape_recovers_on_the_second_attempt(self, mock_sleep, mock_publish):
+        """A transient failure is retried within the same run"""
+        import app
+
+        broken = FakePage()
+        broken.goto_error = PlaywrightTimeoutError("Timeout")
+
+        with patch('app.sync_playwright', fake_playwright()), \
+                patch('app.open_browser',
+                      side_effect=[FakeBrowser(broken), FakeBrowser(dashboard_page())]), \
+                patch('app.back_off') as mock_back_off:
+            values = app.scrape()
+
+        assert values['total'] == 234.32
+        assert len(published(mock_publish)[app.mqtt_topic]) == 1
+        # one wait between the attempts, apart from the sleeps within them
+        (seconds,), _ = mock_back_off.call_args
+        assert mock_back_off.call_count == 1 and 10 <= seconds <= 15
+
+    @patch('app.publish')
+    @patch('app.sleep')
+    def test_browser_close_error_is_not_fatal(self, mock_sleep, mock_publish):
+        """A browser that cannot be closed must not take the job down"""
+        import app
+
+        browser = FakeBrowser(dashboard_page())
+        browser.close_error = PlaywrightError("browser already gone")
+
+        with patch('app.sync_playwright', fake_playwright()), \
+                patch('app.open_browser', return_value=browser):
+            values = app.scrape()
+
+        assert values['total'] == 234.32
+
+
+class TestCdpPool:
+    """Tests for spreading runs over a pool of remote browsers"""
+
+    def pool(self, health):
+        import app
+
+        pool = app.CdpPool(list(health))
+        pool.probe = lambda url: health[url]
+        return pool
+
+    def test_picks_the_least_loaded_healthy_endpoint(self):
+        pool = self.pool({'http://a:9222': (3, 5.0), 'http://b:9222': None,
+                          'http://c:9222': (1, 40.0), 'http://d:9222': (1, 10.0)})
+
+        assert pool.candidates() == ['http://d:9222', 'http://c:9222', 'http://a:9222']
+
+    def test_fails_over_to_the_next_endpoint(self):
+        import app
+
+        pool = self.pool({'http://a:9222': (0, 5.0), 'http://b:9222': (1, 5.0)})
+        playwright = Mock()
+        browser = Mock()
+        playwright.chromium.connect_over_cdp.side_effect = [PlaywrightError('refused'), browser]
+
+        assert pool.connect(playwright) is browser
+        assert pool.connected == 'http://b:9222'
+        assert pool.stats['http://a:9222']['failures'] == 1
+        assert pool.stats['http://b:9222']['connects'] == 1
+        assert pool.stats['http://b:9222']['latency_ms'] is not None
+        # the broken one sits out for a while
+        assert pool.candidates() == ['http://b:9222']
+
+    def test_launches_its_own_when_all_are_down(self):
+        import app
+
+        pool = self.pool({'http://a:9222': None})
+        playwright = Mock()
+        with patch.object(app, 'cdp_pool', return_value=pool):
+            app.open_browser(playwright)
+
+        playwright.chromium.connect_over_cdp.assert_not_called()
+        playwright.chromium.launch.assert_called_once()
+        assert pool.connected is None
+
+    def test_fails_when_all_are_down_and_fallback_is_off(self):
+        import app
+
+        pool = self.pool({'http://a:9222': None})
+        with patch.object(app, 'browser_cdp_fallback', False), pytest.raises(PlaywrightError):
+            pool.connect(Mock())
+
+    def test_probes_version_and_open_pages(self):
+        import app
+
+        pool = app.CdpPool(['http://a:9222'])
+        answers = {'/json/version': {'Browser': 'HeadlessChrome'},
+                   '/json/list': [{'type': 'page'}, {'type': 'page'}, {'type': 'service_worker'}]}
+        with patch.object(pool, '_get', side_effect=lambda url, path: answers[path]):
+            pages, elapsed = pool.probe('http://a:9222')
+
+        assert pages == 2
+        assert elapsed >= 0
+        with patch.object(pool, '_get', side_effect=OSError('refused')):
+            assert pool.probe('http://a:9222') is None
+
+    def test_a_comma_separated_url_is_a_pool(self):
+        import app
+
+        with patch.object(app, 'browser_cdp_url', 'http://a:9222, http://b:9222'):
+            pool = app.cdp_pool()
+            assert pool.urls == ['http://a:9222', 'http://b:9222']
+            assert app.cdp_pool() is pool
+
+    def test_the_numbers_of_a_run_process_are_kept(self):
+        import app
+
+        with patch.object(app, 'browser_cdp_url', 'http://a:9222,http://b:9222'), \
+                patch.object(app, '_cdp_pools', {}):
+            app.run_supervised(lambda: app.cdp_pool()._record('http://a:9222'))
+            app.run_supervised(lambda: app.cdp_pool()._record('http://b:9222', 40.0))
+            app.run_supervised(lambda: app.cdp_pool()._record('http://b:9222', 10.0))
+            pool = app.cdp_pool()
+            with patch.object(pool, 'probe', return_value=(0, 5.0)):
+                candidates = pool.candidates()
+
+        assert pool.stats['http://a:9222']['failures'] == 1
+        assert pool.stats['http://b:9222']['connects'] == 2
+        assert pool.stats['http://b:9222']['latency_ms'] == pytest.approx(31.0)
+        # the next run skips the endpoint that failed in the last one
+        assert candidates == ['http://b:9222']
+
+
+class TestBrowserOptions:
+    """Tests for how the browser is started"""
+
+    def test_launches_its_own_chromium(self):
+        import app
+
+        playwright = Mock()
+        app.open_browser(playwright)
+
+        playwright.chromium.launch.assert_called_once()
+        kwargs = playwright.chromium.launch.call_args[1]
+        assert kwargs['headless'] is True
+        assert '--disable-dev-shm-usage' in kwargs['args']
+        playwright.chromium.connect_over_cdp.assert_not_called()
+
+    def test_connects_to_a_remote_browser_when_configured(self):
+        import app
+
+        playwright = Mock()
+        with patch.object(app, 'browser_cdp_url', 'http://chrome:9222'), \
+                patch.object(app.CdpPool, 'probe', return_value=(0, 5.0)):
+            app.open_browser(playwright)
+
+        playwright.chromium.connect_over_cdp.assert_called_once_with('http://chrome:9222')
+        playwright.chromium.launch.assert_not_called()
+
+    def test_a_custom_browser_build_can_be_used(self):
+        import app
+
+        playwright = Mock()
+        with patch.object(app, 'browser_executable', '/usr/bin/chromium'):
+            app.open_browser(playwright)
+
+        assert playwright.chromium.launch.call_args[1]['executable_path'] == '/usr/bin/chromium'
+
+    @patch('app.publish')
+    @patch('app.sleep')
+    def test_each_run_gets_a_fresh_context(self, mock_sleep, mock_publish):
+        """A fresh context is the playwright equivalent of incognito"""
+        import app
+
+        browser = FakeBrowser(dashboard_page())
+        with patch('app.sync_playwright', fake_playwright()), \
+                patch('app.open_browser', return_value=browser):
+            app.scrape()
+
+        assert browser.context.default_timeout == app.element_timeout * 1000
+        assert browser.context.closed
+
+    def test_the_low_memory_profile_trims_chromium(self):
+        import app
+
+        playwright = Mock()
+        with patch.object(app, 'browser_profile', 'low-memory'), \
+                patch.object(app, 'browser_js_heap', 96):
+            app.open_browser(playwright)
+            options = app._context_options()
+
+        args = playwright.chromium.launch.call_args[1]['args']
+        assert '--renderer-process-limit=1' in args
+        assert '--disable-gpu' in args
+        assert '--js-flags=--max-old-space-size=96' in args
+        assert '--disable-dev-shm-usage' in args
+        assert options['viewport'] == {'width': 800, 'height': 600}
+
+    def test_an_unknown_profile_falls_back_to_the_default(self):
+        import app
+
+        playwright = Mock()
+        with patch.object(app, 'browser_profile', 'tiny'):
+            app.open_browser(playwright)
+
+        assert playwright.chromium.launch.call_args[1]['args'] == ['--disable-dev-shm-usage']
+
+
+class TestMemoryMonitor:
+    """Tests for measuring and limiting the memory of the browser"""
+
+    # this process -> playwright driver -> chromium -> chromium renderer
+    TABLE = {
+        100: (os.getpid(), 'node'),
+        101: (100, 'chrome'),
+        102: (101, 'chrome'),
+        200: (1, 'chrome'),  # somebody else's browser
+    }
+
+    def test_only_our_own_processes_are_counted(self):
+        import app
+
+        with patch('app._process_table', return_value=self.TABLE):
+            assert app.browser_processes() == {100: 'node', 101: 'chrome', 102: 'chrome'}
+
+    def test_the_peak_is_kept(self):
+        import app
+
+        monitor = app.MemoryMonitor()
+        with patch('app._process_table', return_value=self.TABLE), \
+                patch('app._rss', side_effect=[10, 20, 30, 1, 1, 1]):
+            monitor.sample()
+            monitor.sample()
+
+        assert monitor.peak == 60
+        assert not monitor.exceeded
+
+    def test_a_browser_over_budget_is_killed(self):
+        import app
+
+        monitor = app.MemoryMonitor(budget_mb=100)
+        with patch('app._process_table', return_value=self.TABLE), \
+                patch('app._rss', return_value=60 * 2 ** 20), \
+                patch('app.kill') as mock_kill:
+            monitor.sample()
+
+        assert monitor.exceeded
+        # chromium goes, the playwright driver stays to report the failure
+        assert sorted(call_args[0][0] for call_args in mock_kill.call_args_list) == [101, 102]
+
+    def test_the_process_table_reads_proc(self):
+        import app
+
+        table = app._process_table()
+
+        assert table[os.getpid()][0] == os.getppid()
+
+    @patch('app.publish')
+    @patch('app.sleep')
+    def test_a_killed_browser_fails_the_attempt(self, mock_sleep, mock_publish):
+        import app
+
+        page = FakePage()
+        page.goto_error = PlaywrightError("Target page, context or browser has been closed")
+        monitor = app.MemoryMonitor(budget_mb=1)
+        monitor.exceeded = True
+
+        with patch('app.sync_playwright', fake_playwright()), \
+                patch('app.open_browser', return_value=FakeBrowser(page)), \
+                patch('app.MemoryMonitor', return_value=Mock(start=Mock(return_value=monitor))):
+            with pytest.raises(app.BrowserMemoryError):
+                app.scrape_once()
+
+
+def sleep_in_a_grandchild(seconds):
+    """Stands in for a wedged browser: a process below the run that never returns."""
+    import subprocess
+    import time
+    process = subprocess.Popen([sys.executable, '-c', f'import time; time.sleep({seconds})'])
+    time.sleep(seconds)
+    return process.pid
+
+
+class TestSupervisedRun:
+    """Tests for running an attempt in a process of its own"""
+
+    def test_the_result_comes_back(self):
+        import app
+
+        assert app.run_supervised(lambda value: {'total': value}, 1.5) == {'total': 1.5}
+
+    def test_the_error_comes_back(self):
+        import app
+
+        def fail():
+            raise app.ElementNotFoundError("no 'submit'")
+
+        with pytest.raises(app.ElementNotFoundError, match="no 'submit'"):
+            app.run_supervised(fail)
+
+    def test_an_error_that_does_not_pickle(self):
+        import app
+
+        class Local(Exception):
+            pass
+
+        def fail():
+            raise Local("odd")
+
+        with pytest.raises(RuntimeError, match='Local: odd'):
+            app.run_supervised(fail)
+
+    def test_a_wedged_run_is_killed_with_everything_below_it(self):
+        import app
+
+        before = set(app._process_table())
+        with patch.object(app, 'run_timeout', 1):
+            with pytest.raises(app.RunTimeoutError, match='1 browser processes'):
+                app.run_supervised(sleep_in_a_grandchild, 60)
+
+        import time
+        for _ in range(50):  # the kill is delivered, reaping the orphan can lag a little
+            left = {pid for pid, (_, name) in app._process_table().items()
+                    if pid not in before and name.startswith('python')}
+            if not left:
+                break
+            time.sleep(0.1)
+        assert not left
+
+    def test_a_dead_run_is_an_error(self):
+        import app
+
+        with pytest.raises(RuntimeError, match='exit code 3'):
+            app.run_supervised(os._exit, 3)
+
+    def test_announced_meters_are_kept_by_the_parent(self):
+        import app
+
+        with patch.object(app, '_announced_meters', {}):
+            app.run_supervised(app._announced_meters.__setitem__, 4242, 'digest')
+            assert app._announced_meters == {4242: 'digest'}
+
+    def test_the_detected_profile_is_kept_by_the_parent(self):
+        import app
+
+        other = profile('other', detect='Forsyning B')
+        page = FakePage({'body': 'Velkommen til Forsyning B'})
+        with patch.object(app, 'PROFILES', {**app.PROFILES, 'other': other}), \
+                patch.object(app, '_detected_profile', None), \
+                patch.object(app, 'login_url', 'http://127.0.0.1/index.html'):
+            app.run_supervised(lambda: app.current_profile(page).name)
+            assert app._detected_profile is other
+
+    def test_the_parent_writes_the_pages_of_a_failed_run(self, tmp_path):
+        import app
+
+        def fail(name):
+            app._diagnostics.submit(app._diagnostics.write_page, str(tmp_path / name),
+                                    '<html>same</html>', None)
+            raise RuntimeError("Dashboard did not render")
+
+        with patch.object(app._diagnostics, '_snapshots', {}):
+            for name in ('20241007-185800-failure', '20241007-190000-failure'):
+                with pytest.raises(RuntimeError):
+                    app.run_supervised(fail, name)
+            app._diagnostics.flush()
+
+        assert len(list(tmp_path.glob('*.html.gz'))) == 1
+
+    def test_a_failed_run_does_not_wait_for_the_writer(self, tmp_path):
+        import app
+        import threading
+
+        release = threading.Event()
+        written = []
+
+        def write_page(self, base, html, png):
+            release.wait(10)
+            written.append(base)
+            return str(tmp_path)
+
+        def fail():
+            app._diagnostics.submit(app._diagnostics.write_page,
+                                    str(tmp_path / '20241007-185800-failure'), '<html/>', None)
+            raise RuntimeError("Dashboard did not render")
+
+        with patch.object(app.DiagnosticsWriter, 'write_page', write_page):
+            with pytest.raises(RuntimeError):
+                app.run_supervised(fail)
+            assert written == []  # the write is still going when the attempt is over
+            release.set()
+            app._diagnostics.flush()
+
+        assert written == [str(tmp_path / '20241007-185800-failure')]
+
+    def test_the_limits_apply_to_the_run(self):
+        import app
+        import resource
+
+        with patch.object(app, 'run_cpu_limit', 30):
+            limit = app.run_supervised(resource.getrlimit, resource.RLIMIT_CPU)
+
+        assert limit == (30, 30)
+        assert resource.getrlimit(resource.RLIMIT_CPU) != (30, 30)
+
+    @patch('app.publish')
+    @patch('app.sleep')
+    def test_scrape_isolates_every_attempt(self, mock_sleep, mock_publish):
+        import app
+
+        with patch.object(app, 'run_isolation', True), \
+                patch('app.run_supervised', return_value={'total': 1}) as mock_run, \
+                patch('app.publish_reading'):
+            assert app.scrape() == {'total': 1}
+
+        function, attempt, deadline, publish = mock_run.call_args.args
+        assert (function, attempt, publish) == (app.scrape_once, 1, False)
+        assert mock_run.call_args.kwargs == {'timeout': app.run_timeout}
+
+    @patch('app.publish')
+    @patch('app.sleep')
+    def test_an_isolated_scrape_keeps_the_profile_it_detected(self, mock_sleep, mock_publish):
+        import app
+
+        page = dashboard_page()
+        page.elements['body'] = 'Velkommen til Forsyning B'
+        other = profile('other', detect='Forsyning B')
+        with patch.object(app, 'run_isolation', True), \
+                patch.object(app, 'PROFILES', {**app.PROFILES, 'other': other}), \
+                patch.object(app, '_detected_profile', None), \
+                patch.object(app, 'login_url', 'http://127.0.0.1/index.html'), \
+                patch('app.sync_playwright', fake_playwright()), \
+                patch('app.open_browser', return_value=FakeBrowser(page)):
+            assert app.scrape()['total'] == 234.32
+            assert app._detected_profile is other
+
+    @patch('app.publish')
+    @patch('app.sleep')
+    def test_the_reading_is_published_by_the_parent(self, mock_sleep, mock_publish):
+        import app
+
+        with patch.object(app, 'run_isolation', True), \
+                patch.object(app, '_announced_meters', {}), \
+                patch('app.sync_playwright', fake_playwright()), \
+                patch('app.open_browser', return_value=FakeBrowser(dashboard_page())):
+            values = app.scrape()
+
+        # the mock of the child never reports back, so these were all sent from here
+        messages = published(mock_publish)
+        assert [json.loads(payload) for payload in messages[app.mqtt_topic]] == [values]
+        assert any(topic.startswith('homeassistant/') for topic in messages)
+
+    def test_the_run_deadline_bounds_the_run_process(self):
+        import app
+
+        with patch.object(app, 'run_isolation', True), \
+                patch.object(app, 'run_deadline', 100), \
+                patch('app.run_supervised', return_value={'total': 1}) as mock_run, \
+                patch('app.publish_reading'):
+            app.scrape()
+
+        timeout = mock_run.call_args.kwargs['timeout']
+        assert 100 < timeout <= 100 + app._DEADLINE_GRACE
+
+
+def stepping_attempt(marker, first_sleeps, first_fails=False):
+    """An attempt that reports its steps. The first one started takes long, the second does not."""
+    import time
+    import app
+    steps = app.RunSteps()
+    with open(marker, 'a') as handle:
+        handle.write('started\n')
+    with open(marker) as handle:
+        first = len(handle.readlines()) == 1
+    if first:
+        time.sleep(first_sleeps)
+        if first_fails:
+            raise app.ElementNotFoundError("no 'total'")
+    else:
+        time.sleep(0.2)
+    steps.done('browser')
+    return 'first' if first else 'second'
+
+
+@pytest.fixture
+def stage_times():
+    import app
+    times = app.StageTimes()
+    with patch.object(app, '_stage_times', times):
+        yield times
+
+
+class TestHedging:
+    """Tests for a second attempt next to a slow one"""
+
+    def test_the_steps_of_a_run_are_learned(self, tmp_path, stage_times):
+        import app
+
+        assert app.run_supervised(stepping_attempt, str(tmp_path / 'marker'), 0) == 'first'
+
+        assert len(stage_times.samples['browser']) == 1
+
+    def test_p95_needs_enough_samples(self, stage_times):
+        stage_times.learn([('browser', 1.0)] * 4)
+        assert stage_times.p95('browser') is None
+
+        stage_times.learn([('browser', 1.0)] * 95 + [('browser', 10.0)] * 5)
+        assert 1.0 <= stage_times.p95('browser') < 10.0
+
+    def test_a_slow_attempt_gets_a_second_one_next_to_it(self, tmp_path, stage_times):
+        import app
+
+        stage_times.learn([('browser', 0.1)] * 10)
+        marker = tmp_path / 'marker'
+        started = time.monotonic()
+
+        assert app.run_hedged(stepping_attempt, str(marker), 60) == 'second'
+
+        assert time.monotonic() - started < 10
+        assert marker.read_text().count('started') == 2
+
+    def test_a_failed_attempt_leaves_the_other_one_running(self, tmp_path, stage_times):
+        import app
+
+        stage_times.learn([('browser', 0.1)] * 10)
+
+        assert app.run_hedged(stepping_attempt, str(tmp_path / 'marker'), 1, True) == 'second'
+
+    def test_no_hedge_without_history(self, tmp_path, stage_times):
+        import app
+
+        marker = tmp_path / 'marker'
+
+        assert app.run_hedged(stepping_attempt, str(marker), 1) == 'first'
+        assert marker.read_text().count('started') == 1
+
+    def test_the_error_comes_back_when_all_failed(self, tmp_path, stage_times):
+        import app
+
+        with pytest.raises(app.ElementNotFoundError):
+            app.run_hedged(stepping_attempt, str(tmp_path / 'marker'), 0, True)
+
+    def test_scrape_hedges_when_configured(self):
+        import app
+
+        with patch.object(app, 'run_isolation', True), patch.object(app, 'hedge_attempts', True), \
+                patch('app.run_hedged', return_value={'total': 1}) as mock_run, \
+                patch('app.publish_reading') as mock_publish_reading, \
+                patch('app.record_reading'):
+            assert app.scrape() == {'total': 1}
+
+        assert mock_run.call_args.args[0] is app.scrape_once
+        # the attempts only read, the winner is published once, here
+        assert mock_run.call_args.args[3] is False
+        mock_publish_reading.assert_called_once()
+
+
+class TestDiagnostics:
+    """Tests for the failure diagnostics dump"""
+
+    def test_dump_writes_page_source_and_screenshot(self, tmp_path):
+        import app
+
+        page = FakePage()
+        with patch.object(app, 'debug_dir', str(tmp_path)):
+            app.dump_diagnostics(page, 'failure')
+            app._diagnostics.flush()
+
+        dumps = list(tmp_path.glob('*-failure.html.gz'))
+        assert len(dumps) == 1
+        assert gzip.decompress(dumps[0].read_bytes()) == b'<html>changed layout</html>'
+        assert [png.read_bytes() for png in tmp_path.glob('*-failure.png')] == [b'png']
+
+    def test_dump_is_skipped_without_a_debug_dir(self):
+        import app
+
+        page = FakePage()
+        with patch.object(app, 'debug_dir', None):
+            app.dump_diagnostics(page, 'failure')
+
+        assert page.screenshots == []
+
+    def test_dump_swallows_its_own_errors(self, tmp_path):
+        import app
+
+        page = Mock()
+        page.content.side_effect = PlaywrightError("page closed")
+
+        with patch.object(app, 'debug_dir', str(tmp_path)):
+            app.dump_diagnostics(page, 'failure')  # must not raise
+
+    def test_a_trace_is_written_for_a_failed_run(self, tmp_path):
+        import app
+
+        context = FakeContext(FakePage())
+        with patch.object(app, 'debug_dir', str(tmp_path)):
+            assert app.save_trace(context, True) is False
+            app._diagnostics.flush()
+
+        traces = list(tmp_path.glob('*-failure-trace.zip'))
+        assert [trace.read_text() for trace in traces] == ['trace']
+        # playwright wrote it somewhere fast, the writer moved it
+        assert not os.path.exists(context.tracing.stopped_to)
+
+    def test_no_trace_when_tracing_was_never_started(self):
+        import app
+
+        context = FakeContext(FakePage())
+        app.save_trace(context, False)
+
+        assert context.tracing.stopped_to is None
+
+    @patch('app.publish')
+    @patch('app.sleep')
+    def test_tracing_runs_when_a_debug_dir_is_set(self, mock_sleep, mock_publish, tmp_path):
+        import app
+
+        page = FakePage()
+        page.goto_error = PlaywrightError("boom")
+        browser = FakeBrowser(page)
+
+        with patch.object(app, 'debug_dir', str(tmp_path)), \
+                patch.object(app, 'max_attempts', 1), \
+                patch('app.sync_playwright', fake_playwright()), \
+                patch('app.open_browser', return_value=browser):
+            app.scrape()
+
+        assert browser.context.tracing.started
+        assert browser.context.tracing.stopped_to.endswith('-failure-trace.zip')
+
+    def test_trace_modes(self, tmp_path):
+        import app
+
+        with patch.object(app, 'debug_dir', str(tmp_path)):
+            with patch.object(app, 'trace_mode', 'off'):
+                assert not app._should_trace(1)
+            with patch.object(app, 'trace_mode', 'retry'):
+                assert not app._should_trace(1)
+                assert app._should_trace(2)
+            with patch.object(app, 'trace_mode', 'ring'):
+                assert not app._should_trace(2)
+            with patch.object(app, 'trace_mode', 'sampled'), \
+                    patch.object(app, 'trace_sample_rate', 3):
+                traced = []
+                for run in range(1, 7):
+                    with patch.object(app, '_run_count', run):
+                        traced.append(app._should_trace(1))
+                assert traced == [True, False, False, True, False, False]
+
+    def test_nothing_is_traced_without_a_debug_dir(self):
+        import app
+
+        with patch.object(app, 'debug_dir', None), patch.object(app, 'trace_mode', 'always'):
+            assert not app._should_trace(2)
+
+    @patch('app.publish')
+    @patch('app.sleep')
+    def test_retry_mode_traces_from_the_second_attempt(self, mock_sleep, mock_publish,
+                                                         tmp_path):
+        import app
+
+        broken = FakePage()
+        broken.goto_error = PlaywrightTimeoutError("Timeout")
+        browsers = [FakeBrowser(broken), FakeBrowser(dashboard_page())]
+
+        with patch.object(app, 'debug_dir', str(tmp_path)), \
+                patch.object(app, 'trace_mode', 'retry'), \
+                patch('app.sync_playwright', fake_playwright()), \
+                patch('app.open_browser', side_effect=browsers):
+            assert app.scrape()['total'] == 234.32
+
+        assert not browsers[0].context.tracing.started
+        assert browsers[1].context.tracing.started
+
+    @patch('app.publish')
+    @patch('app.sleep')
+    def test_ring_mode_keeps_the_last_steps(self, mock_sleep, mock_publish, tmp_path):
+        import app
+
+        # the login works, the dashboard never shows up
+        page = dashboard_page()
+        for selector in ('xpath=//span[2]/b[2]', 'xpath=//b', 'xpath=//span[2]/b'):
+            del page.elements[selector]
+        rendered = iter(range(100))
+        page.content = lambda: f'<html>render {next(rendered)}</html>'
+
+        with patch.object(app, 'debug_dir', str(tmp_path)), \
+                patch.object(app, 'trace_mode', 'ring'), \
+                patch.object(app, 'trace_ring_size', 2), \
+                patch('app.sync_playwright', fake_playwright()), \
+                patch('app.open_browser', return_value=FakeBrowser(page)):
+            with pytest.raises(app.ElementNotFoundError):
+                app.scrape_once()
+            app._diagnostics.flush()
+
+        assert list(tmp_path.glob('*-failure-trace.zip')) == []
+        steps = sorted(path.name.split('-step')[1] for path in tmp_path.glob('*-step*'))
+        assert steps == ['1-login.html.gz', '2-failed.html.gz']
+
+    def test_steps_are_timed(self):
+        import app
+
+        with patch('app.monotonic', side_effect=[10.0, 11.5]):
+            steps = app.RunSteps()
+            steps.done('login-page')
+
+        assert steps.summary() == 'login-page 1.5s'
+        assert steps.total == 1.5
+
+    def test_the_ring_is_bounded(self):
+        import app
+
+        steps = app.RunSteps(ring_size=2)
+        for step in ('login-page', 'login-form', 'login'):
+            steps.done(step, FakePage())
+
+        assert [step for step, _ in steps.ring] == ['login-form', 'login']
+
+    def test_the_same_page_is_only_written_once(self, tmp_path):
+        import app
+
+        with patch.object(app, 'debug_dir', str(tmp_path)):
+            app._diagnostics.write_page(str(tmp_path / '20241007-185800-failure'),
+                                        '<html>same</html>', b'png')
+            app._diagnostics.write_page(str(tmp_path / '20241007-190000-failure'),
+                                        '<html>same</html>', b'png')
+
+        assert len(list(tmp_path.glob('*.html.gz'))) == 1
+
+    def test_old_diagnostics_are_removed(self, tmp_path):
+        import app
+
+        old = tmp_path / '20240101-000000-failure.png'
+        old.write_bytes(b'png')
+        os.utime(old, (0, 0))
+        recent = tmp_path / '20241007-185800-failure.png'
+        recent.write_bytes(b'png')
+        mine = tmp_path / 'notes.txt'
+        mine.write_text('not ours')
+        os.utime(mine, (0, 0))
+
+        app._diagnostics._prune(str(tmp_path))
+
+        assert not old.exists()
+        assert recent.exists()
+        assert mine.exists()
+
+    def test_the_directory_is_kept_within_its_size(self, tmp_path):
+        import app
+
+        for minute in range(5):
+            path = tmp_path / f'20241007-18{minute}000-failure.png'
+            path.write_bytes(b'x' * 400 * 1024)
+            os.utime(path, (1e10 + minute, 1e10 + minute))
+
+        with patch.object(app, 'debug_max_size', 1):
+            app._diagnostics._prune(str(tmp_path))
+
+        # the newest two fit in 1 MB
+        assert sorted(p.name for p in tmp_path.iterdir()) == [
+            '20241007-183000-failure.png', '20241007-184000-failure.png']
+
+
+class FakeWebSocket:
+    """The websocket a page opened, as playwright hands it to page.on('websocket')."""
+
+    def __init__(self, url):
+        self.url = url
+        self.handlers = {}
+
+    def on(self, event, handler):
+        self.handlers[event] = handler
+
+
+class FakeSocketRoute:
+    """A routed websocket: records what the replay sends to the page."""
+
+    def __init__(self):
+        self.sent = []
+        self.message_handler = None
+
+    def on_message(self, handler):
+        self.message_handler = handler
+
+    def send(self, message):
+        self.sent.append(message)
+
+
+class TestSessionRecording:
+    """Tests for recording a run and replaying it offline"""
+
+    def test_only_the_blazor_socket_is_recorded(self, tmp_path):
+        import app
+
+        recorder = app.SessionRecorder(str(tmp_path))
+        other = FakeWebSocket('wss://example.com/livereload')
+        blazor = FakeWebSocket('wss://www.minvandforsyning.dk/_blazor?id=abc')
+        recorder.attach(other)
+        recorder.attach(blazor)
+
+        assert other.handlers == {}
+        blazor.handlers['framesent']('{"protocol":"json"}\x1e')
+        blazor.handlers['framereceived'](b'\x01\x02')
+
+        assert recorder.frames == [
+            {'socket': 0, 'dir': 'sent', 'text': '{"protocol":"json"}\x1e'},
+            {'socket': 0, 'dir': 'received', 'binary': 'AQI='},
+        ]
+
+    def test_a_successful_run_replaces_the_recording(self, tmp_path):
+        import app
+
+        recorder = app.SessionRecorder(str(tmp_path))
+        recorder.context_options()
+        open(recorder.har_path, 'w').write('{"log": {}}')
+        recorder._add(0, 'received', 'hello')
+        recorder.succeeded = True
+        recorder.finish()
+
+        assert (tmp_path / 'session.har').read_text() == '{"log": {}}'
+        assert app.load_recorded_sockets(str(tmp_path)) == [
+            [{'socket': 0, 'dir': 'received', 'text': 'hello'}]]
+
+    def test_a_failed_run_keeps_the_previous_recording(self, tmp_path):
+        import app
+
+        (tmp_path / 'session.har').write_text('previous')
+        recorder = app.SessionRecorder(str(tmp_path))
+        open(recorder.har_path, 'w').write('half a run')
+        recorder.finish()
+
+        assert (tmp_path / 'session.har').read_text() == 'previous'
+        assert not os.path.exists(recorder.har_path)
+
+    def test_replay_answers_in_the_recorded_order(self):
+        import app
+
+        replay = app.SocketReplay([[
+            {'socket': 0, 'dir': 'sent', 'text': 'handshake'},
+            {'socket': 0, 'dir': 'received', 'text': '{}'},
+            {'socket': 0, 'dir': 'received', 'binary': 'AQI='},
+            {'socket': 0, 'dir': 'sent', 'text': 'StartCircuit'},
+            {'socket': 0, 'dir': 'received', 'text': 'render'},
+        ]])
+        route = FakeSocketRoute()
+        replay(route)
+
+        # nothing is sent before the page speaks first, as in the recording
+        assert route.sent == []
+        route.message_handler('a different handshake')
+        assert route.sent == ['{}', b'\x01\x02']
+        route.message_handler('StartCircuit')
+        assert route.sent == ['{}', b'\x01\x02', 'render']
+
+    def test_each_socket_gets_its_own_recording(self):
+        import app
+
+        replay = app.SocketReplay([
+            [{'socket': 0, 'dir': 'received', 'text': 'picker'}],
+            [{'socket': 1, 'dir': 'received', 'text': 'dashboard'}],
+        ])
+        first, second = FakeSocketRoute(), FakeSocketRoute()
+        replay(first)
+        replay(second)
+
+        assert first.sent == ['picker']
+        assert second.sent == ['dashboard']
+
+    @patch('app.publish')
+    @patch('app.sleep')
+    def test_a_run_can_be_recorded_and_replayed(self, mock_sleep, mock_publish, tmp_path):
+        import app
+
+        browser = FakeBrowser(dashboard_page())
+        with patch.object(app, 'record_dir', str(tmp_path)), \
+                patch('app.sync_playwright', fake_playwright()), \
+                patch('app.open_browser', return_value=browser):
+            app.scrape_once()
+
+        assert 'websocket' in browser.context.page.handlers
+        assert (tmp_path / 'session.har').read_text() == '{"log": {}}'
+        assert (tmp_path / 'websocket.jsonl').exists()
+
+        browser = FakeBrowser(dashboard_page())
+        with patch.object(app, 'replay_dir', str(tmp_path)), \
+                patch('app.sync_playwright', fake_playwright()), \
+                patch('app.open_browser', return_value=browser):
+            app.scrape_once()
+
+        assert browser.context.har == str(tmp_path / 'session.har')
+        assert browser.context.socket_routes[0][0] is app._BLAZOR_SOCKET
+
+
+def render_batch(*strings):
+    """A Blazor render batch that only carries a string table."""
+    import struct
+
+    body = b'\0' * 8  # stands in for the frames and edits
+    positions = []
+    for value in strings:
+        encoded = value.encode('utf-8')
+        positions.append(len(body))
+        body += bytes([len(encoded)]) + encoded
+    table = len(body)
+    body += b''.join(struct.pack('<i', position) for position in positions)
+    return body + struct.pack('<5i', 0, 0, 0, 0, table)
+
+
+B2C_PAGE = (
+    "<html><script>var SETTINGS = {\"csrf\": \"token\", \"transId\": \"tx1\", "
+    "\"api\": \"CombinedSigninAndSignup\", "
+    "\"hosts\": {\"tenant\": \"/tenant.onmicrosoft.com\", \"policy\": \"B2C_1_signin\"}};"
+    "</script></html>")
+TOKEN_FORM = (
+    "<html><body onload='document.forms[0].submit()'>"
+    "<form method='post' action='https://www.minvandforsyning.dk/signin-oidc'>"
+    "<input type='hidden' name='id_token' value='jwt'>"
+    "<input type='hidden' name='state' value='s1'></form></body></html>")
+DASHBOARD = (
+    "<html><body><!--Blazor:{\"type\":\"server\",\"sequence\":0,\"descriptor\":\"d1\"}-->"
+    "<!--Blazor:{\"prerenderId\":\"p1\"}--></body></html>")
+
+
+class FakeHttpSession:
+    """Answers the browserless engine from a script of (url prefix, answer)."""
+
+    def __init__(self, script):
+        self.script = list(script)
+        self.requests = []
+
+    def request(self, url, data=None, headers=None):
+        self.requests.append((url, data, headers))
+        for prefix, answer in self.script:
+            if url.startswith(prefix):
+                if isinstance(answer, list):  # answered once per entry, in order
+                    answer = answer.pop(0) if len(answer) > 1 else answer[0]
+                return answer
+        raise OSError(f"unexpected request to {url}")
+
+
+def blazor_site(*batches):
+    """The whole conversation of a login and a circuit that renders the dashboard."""
+    hub = 'https://www.minvandforsyning.dk/_blazor'
+    polls = ['{}\x1e'] + [
+        json.dumps({'type': 1, 'target': 'JS.RenderBatch',
+                    'arguments': [index, b64encode(batch).decode()]})
+        + '\x1e' for index, batch in enumerate(batches, 2)]
+    return FakeHttpSession([
+        ('https://login.example.com/entry', ('https://b2c.example.com/tenant/authorize', B2C_PAGE)),
+        ('https://b2c.example.com/tenant.onmicrosoft.com/SelfAsserted',
+         ('', '{"status":"200"}')),
+        ('https://b2c.example.com/tenant.onmicrosoft.com/api/CombinedSigninAndSignup/confirmed',
+         ('https://b2c.example.com/confirmed', TOKEN_FORM)),
+        ('https://www.minvandforsyning.dk/signin-oidc',
+         ('https://www.minvandforsyning.dk/', DASHBOARD)),
+        (f'{hub}/negotiate', ('', json.dumps({
+            'connectionToken': 'c1',
+            'availableTransports': [{'transport': 'WebSockets'}, {'transport': 'LongPolling'}],
+        }))),
+        (f'{hub}?id=c1', [('', text) for text in polls]),
+    ])
+
+
+class TestHttpEngine:
+    """Tests for reading the meter without a browser"""
+
+    def test_render_batch_strings(self):
+        import app
+
+        batch = render_batch('Måler nr.', '23522852', '1.234,50 m³')
+
+        assert app._render_batch_strings(batch) == ['Måler nr.', '23522852', '1.234,50 m³']
+
+    def test_a_broken_render_batch_is_an_engine_error(self):
+        import app
+
+        with pytest.raises(app.HttpEngineError):
+            app._render_batch_strings(b'\x01\x02\x03' + b'\xff' * 20)
+
+    def test_the_token_form_is_posted_on(self):
+        import app
+
+        session = FakeHttpSession([
+            ('https://www.minvandforsyning.dk/signin-oidc', ('https://www.minvandforsyning.dk/',
+                                                             '<html>dashboard</html>')),
+        ])
+        url, html = app._follow_forms(session, 'https://b2c.example.com/confirmed', TOKEN_FORM)
+
+        assert url == 'https://www.minvandforsyning.dk/'
+        assert session.requests[0][1] == {'id_token': 'jwt', 'state': 's1'}
+
+    def test_a_full_run_without_a_browser(self):
+        import app
+
+        session = blazor_site(render_batch('Måler nr. 23522852', 'Forbrug 1.234,50 m³',
+                                           'Aflæst kl. 18.58, d. 07.10.2024'))
+        with patch.object(app, 'http_login_url', 'https://login.example.com/entry'), \
+                patch('app.HttpSession', return_value=session):
+            values = app.scrape_http()
+
+        assert values == {
+            'total': 1234.50,
+            'meter_id': 23522852,
+            'timestamp': '2024-10-07 18:58:00',
+            'timestamp_iso': '2024-10-07T18:58:00+02:00',
+        }
+        sent = [json.loads(data.decode().rstrip('\x1e'))
+                for url, data, _ in session.requests if '?id=c1' in url and data]
+        assert sent[0] == {'protocol': 'json', 'version': 1}
+        assert sent[1]['target'] == 'StartCircuit'
+        assert json.loads(sent[1]['arguments'][2]) == [
+            {'type': 'server', 'sequence': 0, 'descriptor': 'd1'}]
+        # every render batch is acknowledged, or the server stops sending them
+        assert sent[2] == {'type': 1, 'target': 'OnRenderCompleted', 'arguments': [2, None]}
+
+    def test_the_credentials_go_to_the_b2c_form(self):
+        import app
+
+        session = blazor_site(render_batch('Måler nr. 23522852 1,5 m³ kl. 18.58, d. 07.10.2024'))
+        with patch.object(app, 'http_login_url', 'https://login.example.com/entry'), \
+                patch('app.HttpSession', return_value=session):
+            app.scrape_http()
+
+        url, data, headers = session.requests[1]
+        assert url == ('https://b2c.example.com/tenant.onmicrosoft.com/SelfAsserted'
+                       '?tx=tx1&p=B2C_1_signin')
+        assert data['signInName'] == app.mvf_username
+        assert headers['X-CSRF-TOKEN'] == 'token'
+
+    def test_a_refused_login_is_an_engine_error(self):
+        import app
+
+        session = blazor_site()
+        session.script[1] = ('https://b2c.example.com/', ('', '{"status":"400"}'))
+        with patch.object(app, 'http_login_url', 'https://login.example.com/entry'), \
+                patch('app.HttpSession', return_value=session):
+            with pytest.raises(app.HttpEngineError):
+                app.scrape_http()
+
+    def test_it_needs_the_login_url(self):
+        import app
+
+        with patch.object(app, 'http_login_url', None):
+            with pytest.raises(app.HttpEngineError):
+                app.scrape_http()
+
+    @patch('app.publish')
+    def test_scrape_once_uses_the_http_engine(self, mock_publish):
+        import app
+
+        values = {'total': 1.5, 'meter_id': 1, 'timestamp': 'x', 'timestamp_iso': 'x'}
+        with patch.object(app, 'scrape_engine', 'http'), \
+                patch('app.scrape_http', return_value=values), \
+                patch('app.open_browser') as mock_open:
+            assert app.scrape_once() == values
+
+        mock_open.assert_not_called()
+        assert json.loads(published(mock_publish)[app.mqtt_topic][0]) == values
+
+    @patch('app.publish')
+    @patch('app.sleep')
+    def test_scrape_once_falls_back_to_the_browser(self, mock_sleep, mock_publish):
+        import app
+
+        with patch.object(app, 'scrape_engine', 'http'), \
+                patch('app.scrape_http', side_effect=app.HttpEngineError("no hub")), \
+                patch('app.sync_playwright', fake_playwright()), \
+                patch('app.open_browser', return_value=FakeBrowser(dashboard_page())):
+            assert app.scrape_once()['total'] == 234.32
+
+    @pytest.mark.parametrize('error', [IncompleteRead(b'partial'),
+                                       IndexError('list index out of range')])
+    @patch('app.publish')
+    @patch('app.sleep')
+    def test_any_error_of_the_fast_path_falls_back(self, mock_sleep, mock_publish, error):
+        import app
+
+        with patch.object(app, 'scrape_engine', 'http'), \
+                patch('app.scrape_http', side_effect=error), \
+                patch('app.sync_playwright', fake_playwright()), \
+                patch('app.open_browser', return_value=FakeBrowser(dashboard_page())):
+            assert app.scrape_once()['total'] == 234.32
+
+    def test_a_deadline_is_not_a_reason_to_start_the_browser(self):
+        import app
+
+        with patch.object(app, 'scrape_engine', 'http'), \
+                patch('app.scrape_http', side_effect=app.DeadlineExceededError("run deadline")), \
+                patch('app.open_browser') as mock_open:
+            with pytest.raises(app.DeadlineExceededError):
+                app.scrape_once()
+
+        mock_open.assert_not_called()
+
+
+class TestDataParsing:
+    """Tests for data parsing and formatting"""
+
+    def test_total_parsing(self):
+        """Test parsing of total value with comma decimal separator"""
+        from app import _parse_decimal
+
+        assert _parse_decimal("234,32") == 234.32
+
+    def test_total_parsing_with_thousand_separator(self):
+        from app import _parse_decimal
+
+        assert _parse_decimal("1.234,32") == 1234.32
+
+    def test_total_parsing_without_decimals(self):
+        from app import _parse_decimal
 
         assert _parse_decimal("234") == 234.0
 
-    def test_meter_id_parsing(self):
-        """Test parsing of meter ID"""
-        assert int("23522852") == 23522852
+    def test_meter_id_parsing(self):
+        """Test parsing of meter ID"""
+        assert int("23522852") == 23522852
+
+    def test_datetime_parsing(self):
+        """Test parsing of datetime with custom format"""
+        parsed_date = datetime.strptime("kl. 18.58, d. 07.10.2024", 'kl. %H.%M, d. %d.%m.%Y')
+
+        assert datetime.strftime(parsed_date, "%Y-%m-%d %H:%M:%S") == "2024-10-07 18:58:00"
+
+    def test_localize_uses_danish_time(self):
+        from app import _localize
+
+        assert _localize(datetime(2024, 7, 7, 18, 58)).isoformat() == '2024-07-07T18:58:00+02:00'
+        assert _localize(datetime(2024, 12, 7, 18, 58)).isoformat() == '2024-12-07T18:58:00+01:00'
+
+    def test_format_to_regex_matches_the_same_text(self):
+        import re
+        from app import _format_to_regex
+
+        pattern = _format_to_regex('kl. %H.%M, d. %d.%m.%Y')
+        match = re.search(pattern, 'Aflæst kl. 18.58, d. 07.10.2024 i alt')
+
+        assert match.group(0) == 'kl. 18.58, d. 07.10.2024'
+
+    def test_mqtt_message_structure(self):
+        """Test MQTT message JSON structure"""
+        msg_dict = {
+            "total": 234.32,
+            "meter_id": 23522852,
+            "timestamp": "2024-10-07 18:58:00",
+        }
+
+        parsed = json.loads(json.dumps(msg_dict))
+
+        assert parsed["total"] == 234.32
+        assert parsed["meter_id"] == 23522852
+        assert parsed["timestamp"] == "2024-10-07 18:58:00"
+
+
+class TestConfiguration:
+    """Tests for configuration and environment variables"""
+
+    def test_mqtt_auth_with_credentials(self):
+        """Test MQTT auth dict is created when credentials are provided"""
+        import app
+
+        assert hasattr(app, 'mqtt_auth')
+
+    def test_mqtt_client_id_format(self):
+        """Test MQTT client ID has correct format"""
+        import app
+
+        assert app.mqtt_client_id.startswith('python-mqtt-')
+        assert len(app.mqtt_client_id) > len('python-mqtt-')
+
+    def test_no_two_clients_share_an_id(self):
+        import app
+
+        with patch('paho.mqtt.client.Client') as mock_client:
+            app.mqtt_client('leader')
+            app.mqtt_client('leader')
+
+        # the node names the replica, the rest tells the clients apart
+        assert app.mqtt_client_id == f'python-mqtt-{app.node_id or app.gethostname()}'
+        ids = [call_args.kwargs['client_id'] for call_args in mock_client.call_args_list]
+        assert all(client_id.startswith(f'{app.mqtt_client_id}-leader-') for client_id in ids)
+        assert ids[0] != ids[1]
+
+    def test_environment_variable_defaults(self):
+        """Test default values for optional environment variables"""
+        import app
+
+        assert app.mqtt_port == 1883 or isinstance(app.mqtt_port, int)
+        assert hasattr(app, 'mqtt_topic')
+        assert hasattr(app, 'datetime_format')
+
+    def test_the_selenium_url_is_gone(self):
+        """The scraper runs its own browser now"""
+        import app
+
+        assert not hasattr(app, 'webdriver_remote_url')
+
+    def test_resilience_defaults(self):
+        """Test the resilience settings have sane defaults"""
+        import app
+
+        assert app._run_timer == 60 * 60
+        assert app.retry_interval < app._run_timer
+        assert app.max_attempts >= 1
+        assert app.page_load_timeout > 0
+        assert app.headless is True
+
+
+@pytest.fixture
+def restore_config():
+    """Put back every setting a reload can change."""
+    import app
+    names = [attribute for attribute, _ in app._RELOADABLE.values() if attribute]
+    names += ['SELECTORS', '_overridden_selectors', 'PROFILES', '_detected_profile']
+    saved = {name: getattr(app, name) for name in names}
+    level = app.log.level
+    yield
+    for name, value in saved.items():
+        setattr(app, name, value)
+    app.log.setLevel(level)
+
+
+@pytest.mark.usefixtures('restore_config')
+class TestConfigReload:
+    """Tests for reloading 'config-file' between runs"""
+
+    def test_a_changed_file_swaps_the_settings_in(self, tmp_path):
+        import logging
+        import app
+
+        path = tmp_path / 'scraper.env'
+        path.write_text("selector-total=#saldo||b.total\nscrape-interval=600\n"
+                        "mqtt-topic=water/total\nlog-level=debug\n"
+                        "pattern-total=saldo ([\\d,]+)\n")
+        watcher = app.ConfigWatcher(str(path))
+
+        assert watcher.check() is True
+        assert app.SELECTORS['total'] == ['#saldo', 'b.total']
+        assert 'total' in app._overridden_selectors
+        assert app.SELECTORS['submit'] == app._env_settings['selector-submit']
+        assert app._run_timer == 600
+        assert app.mqtt_topic == 'water/total'
+        assert app.log.level == logging.DEBUG
+        assert app.PROFILES['minvandforsyning'].total_re.search('saldo 12,5').group(1) == '12,5'
+        # nothing changed, nothing to do
+        assert watcher.check() is False
+
+    def test_a_variable_left_out_goes_back_to_the_environment(self, tmp_path):
+        import app
+
+        path = tmp_path / 'scraper.env'
+        path.write_text("scrape-interval=600\n")
+        watcher = app.ConfigWatcher(str(path))
+        watcher.check()
+
+        path.write_text("retry-interval=30\n")
+        watcher.requested.set()
+        watcher.check()
+
+        assert app._run_timer == app._env_settings['scrape-interval']
+        assert app.retry_interval == 30
+
+    def test_an_invalid_file_is_rejected_as_a_whole(self, tmp_path, caplog):
+        import app
+
+        path = tmp_path / 'scraper.env'
+        path.write_text("scrape-interval=600\nmax-attempts=0\nlog-level=loud\n"
+                        "pattern-total=([\nselector-submit=\n")
+        before = (app._run_timer, app.max_attempts, app.log_level, app.SELECTORS)
+
+        assert app.ConfigWatcher(str(path)).check() is False
+
+        assert (app._run_timer, app.max_attempts, app.log_level, app.SELECTORS) == before
+        message = caplog.text
+        assert 'max-attempts' in message and 'log-level' in message
+        assert 'patterns' in message and 'selector-submit' in message
+
+    def test_the_profiles_of_the_file_take_the_reloaded_patterns(self, tmp_path):
+        import app
+
+        profiles = tmp_path / 'profiles.json'
+        profiles.write_text(json.dumps({
+            'nordvand': {'domains': ['nordvand.dk'], 'total_pattern': r'(\d+,\d+) kubik'},
+        }))
+        path = tmp_path / 'scraper.env'
+        path.write_text("pattern-meter-id=måler (\\d+)\ndatetime-format=%d-%m-%Y %H:%M\n")
+
+        with patch.object(app, 'site_profiles_file', str(profiles)), \
+                patch.object(app, 'site_profile', 'nordvand'):
+            assert app.ConfigWatcher(str(path)).check() is True
+            nordvand = app.current_profile()
+
+        assert nordvand is app.PROFILES['nordvand']
+        # what it sets itself stays, what it leaves out is the reloaded setting
+        assert nordvand.total_re.search('i alt 12,5 kubik').group(1) == '12,5'
+        assert nordvand.meter_id_re.search('måler 4242').group(1) == '4242'
+        assert nordvand.datetime_format == '%d-%m-%Y %H:%M'
+
+    def test_a_configured_profile_has_to_stay(self, tmp_path, caplog):
+        import app
+
+        path = tmp_path / 'scraper.env'
+        path.write_text("max-attempts=5\n")
+        before = app.PROFILES
+
+        with patch.object(app, 'site_profile', 'nordvand'):
+            assert app.ConfigWatcher(str(path)).check() is False
+
+        assert app.PROFILES is before
+        assert "site-profile: 'nordvand'" in caplog.text
+
+    def test_settings_that_need_a_restart_are_ignored(self, tmp_path, caplog):
+        import app
+
+        path = tmp_path / 'scraper.env'
+        path.write_text("headless=false\nmqtt-broker=new-broker\nmax-attempts=5\n")
+
+        assert app.ConfigWatcher(str(path)).check() is True
+
+        assert app.headless is True
+        # the long-lived clients would keep talking to the old one
+        assert app.mqtt_broker != 'new-broker'
+        assert app.max_attempts == 5
+        assert "'headless'" in caplog.text and "'mqtt-broker'" in caplog.text
+
+    @patch('app.sleep')
+    @patch('app.scrape')
+    def test_the_loop_reloads_before_every_run(self, mock_scrape, mock_sleep, tmp_path):
+        import app
+
+        path = tmp_path / 'scraper.env'
+        path.write_text("scrape-interval=120\n")
+        mock_scrape.side_effect = [{'total': 1}, KeyboardInterrupt]
+
+        with patch.object(app, 'config_file', str(path)), \
+                patch.object(app.ConfigWatcher, 'install', lambda self: self), \
+                pytest.raises(KeyboardInterrupt):
+            app.main()
+
+        mock_sleep.assert_called_once_with(120)
+
+    def test_sighup_asks_for_a_reload(self, tmp_path):
+        import signal
+        import app
+
+        previous = signal.getsignal(signal.SIGHUP)
+        try:
+            watcher = app.ConfigWatcher(str(tmp_path / 'scraper.env')).install()
+            os.kill(os.getpid(), signal.SIGHUP)
+            assert watcher.requested.is_set()
+        finally:
+            signal.signal(signal.SIGHUP, previous)
+
+
+def command(payload='scrape'):
+    return Mock(payload=payload.encode(), topic='minvandforsyningdk/command')
+
+
+class TestCommands:
+    """Tests for reading the meter on request"""
+
+    def test_a_request_wakes_the_loop(self):
+        import app
+
+        listener = app.CommandListener()
+        listener.on_message(None, None, command())
+        with patch('app.monotonic', return_value=10_000):
+            started = time.monotonic()
+            listener.wait(60)
+
+        assert time.monotonic() - started < 1
+
+    def test_requests_during_a_run_are_answered_by_it(self):
+        import app
+
+        listener = app.CommandListener()
+        listener.run_started()
+        for _ in range(5):
+            listener.on_message(None, None, command())
+        listener.run_finished([{'total': 1}])
+
+        assert not listener.requested.is_set()
+
+    @patch('app.publish')
+    def test_a_fresh_reading_is_answered_from_the_cache(self, mock_publish):
+        import app
+
+        listener = app.CommandListener()
+        listener.run_started()
+        listener.run_finished([READING])
+        listener.on_message(None, None, command('PRESS'))
+
+        assert not listener.requested.is_set()
+        assert json.loads(published(mock_publish)[app.mqtt_topic][0]) == READING
+
+    @patch('app.publish')
+    def test_a_failed_run_does_not_freshen_the_cache(self, mock_publish):
+        import app
+
+        listener = app.CommandListener()
+        with patch('app.monotonic', return_value=1000):
+            listener.run_finished([READING])
+        with patch('app.monotonic', return_value=1000 + app.command_cache_ttl + 1):
+            listener.run_started()
+            listener.run_finished([None])
+            listener.on_message(None, None, command())
+
+        # the old reading is not passed off as a new one, a run is asked for
+        assert listener.requested.is_set()
+        mock_publish.assert_not_called()
+
+    @patch('app.publish')
+    def test_every_account_is_answered_on_its_own_topic(self, mock_publish):
+        import app
+
+        accounts = [{'username': f'user{index}', 'password': 'pw', 'name': f'n{index}'}
+                    for index in range(2)]
+        other = {**READING, 'meter_id': 4242}
+        listener = app.CommandListener()
+        listener.run_finished([READING, other], accounts)
+        listener.on_message(None, None, command())
+
+        assert not listener.requested.is_set()
+        messages = published(mock_publish)
+        assert app.mqtt_topic not in messages
+        assert json.loads(messages[f'{app.mqtt_topic}/n0'][0]) == READING
+        assert json.loads(messages[f'{app.mqtt_topic}/n1'][0]) == other
+
+    @patch('app.publish')
+    def test_an_account_without_a_fresh_reading_needs_a_run(self, mock_publish):
+        import app
+
+        accounts = [{'username': f'user{index}', 'password': 'pw', 'name': f'n{index}'}
+                    for index in range(2)]
+        listener = app.CommandListener()
+        listener.run_finished([READING, None], accounts)
+        listener.on_message(None, None, command())
+
+        assert listener.requested.is_set()
+        mock_publish.assert_not_called()
+
+    @patch('app.sleep')
+    def test_runs_keep_the_minimum_interval(self, mock_sleep):
+        import app
+
+        listener = app.CommandListener()
+        with patch('app.monotonic', return_value=1000):
+            listener.run_started()
+            listener.run_finished([None])
+            listener.on_message(None, None, command())
+            listener.wait(3600)
+
+        mock_sleep.assert_called_once_with(app.command_min_interval)
+
+    def test_unknown_commands_are_ignored(self):
+        import app
+
+        listener = app.CommandListener()
+        listener.on_message(None, None, command('reboot'))
+
+        assert not listener.requested.is_set()
+
+    def test_the_button_is_discovered(self):
+        import app
+
+        with patch.object(app, 'mqtt_commands', True):
+            configs = dict(app.discovery_config(7))
+
+        button = configs['homeassistant/button/minvandforsyning_7/read_now/config']
+        assert button['command_topic'] == app.mqtt_command_topic
+        assert button['payload_press'] == 'scrape'
+        assert 'state_topic' not in button
+
+    @patch('app.sleep')
+    @patch('app.scrape')
+    def test_the_loop_waits_for_commands(self, mock_scrape, mock_sleep):
+        import app
+
+        listener = Mock()
+        listener.wait.side_effect = KeyboardInterrupt
+        mock_scrape.return_value = READING
+        with patch.object(app, 'mqtt_commands', True), \
+                patch('app.CommandListener') as mock_listener:
+            mock_listener.return_value.start.return_value = listener
+            with pytest.raises(KeyboardInterrupt):
+                app.main()
+
+        listener.run_finished.assert_called_once_with([READING], [None])
+        listener.wait.assert_called_once_with(app._run_timer)
+        mock_sleep.assert_not_called()
+
+
+class FakeBroker:
+    """Hands every message to every node, all in the same order, like a broker."""
+
+    def __init__(self):
+        self.nodes = []
+        self.queue = []
+        self.now = 1000.0
+
+    def node(self, name, ttl=30):
+        import app
+
+        election = app.LeaderElection(topic='lease', ttl=ttl, node=name)
+        election.client = FakeMqttClient(self)
+        self.nodes.append(election)
+        return election
+
+    def deliver(self):
+        while self.queue:
+            topic, payload = self.queue.pop(0)
+            for node in self.nodes:
+                node.on_message(None, None, Mock(topic=topic, payload=payload.encode()))
+
+
+class FakeMqttClient:
+    def __init__(self, broker):
+        self.broker = broker
+        self.disconnected = False
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        self.broker.queue.append((topic, payload))
+        return Mock()
+
+    def disconnect(self):
+        self.disconnected = True
+
+    def loop_stop(self):
+        pass
+
+
+@pytest.fixture
+def broker():
+    fake = FakeBroker()
+    with patch('app.monotonic', side_effect=lambda: fake.now):
+        yield fake
+
+
+class TestLeaderElection:
+    """Tests for running replicas with one of them scraping"""
+
+    def test_a_free_lease_is_taken(self, broker):
+        a = broker.node('a')
+        a.renew()
+        broker.deliver()
+
+        assert a.is_leader()
+
+    def test_two_claims_at_once_end_with_one_leader(self, broker):
+        a, b = broker.node('a'), broker.node('b')
+        a.renew()
+        b.renew()
+        broker.deliver()
+
+        # both saw b's claim last
+        assert [a.is_leader(), b.is_leader()] == [False, True]
+
+    def test_the_standby_waits_while_the_leader_renews(self, broker):
+        a, b = broker.node('a'), broker.node('b')
+        a.renew()
+        broker.deliver()
+        for _ in range(5):
+            broker.now += 20
+            a.renew()
+            b.renew()
+            broker.deliver()
+
+        assert a.is_leader() and not b.is_leader()
+
+    def test_the_standby_takes_over_a_silent_leader(self, broker):
+        a, b = broker.node('a'), broker.node('b')
+        a.renew()
+        broker.deliver()
+        broker.now += 31  # a stopped renewing
+        b.renew()
+        broker.deliver()
+
+        assert b.is_leader() and not a.is_leader()
+
+    def test_the_last_will_hands_the_lease_over_at_once(self, broker):
+        a, b = broker.node('a'), broker.node('b')
+        a.renew()
+        broker.deliver()
+        broker.nodes.remove(a)
+        broker.queue.append(('lease/released', 'a'))  # sent by the broker for a
+        broker.deliver()
+
+        assert b.is_leader()
+
+    def test_a_stopped_leader_gives_the_lease_up(self, broker):
+        a, b = broker.node('a'), broker.node('b')
+        a.renew()
+        broker.deliver()
+        a.stop()
+        broker.deliver()
+
+        assert b.is_leader()
+        assert a.client.disconnected
+
+    def test_a_lease_of_someone_else_is_not_ours(self, broker):
+        a = broker.node('a')
+        broker.queue.append(('lease', 'not json'))
+        broker.deliver()
+
+        assert not a.is_leader()
+
+    @patch('app.sleep')
+    @patch('app.scrape')
+    def test_only_the_leader_scrapes(self, mock_scrape, mock_sleep):
+        import app
+
+        election = Mock()
+        election.is_leader.return_value = False
+        election.wait_for_leadership.side_effect = KeyboardInterrupt
+        with patch.object(app, 'leader_lease_topic', 'lease'), \
+                patch('app.LeaderElection') as mock_election:
+            mock_election.return_value.start.return_value = election
+            with pytest.raises(KeyboardInterrupt):
+                app.main()
+
+        mock_scrape.assert_not_called()
+        election.stop.assert_called_once()
+
+
+def accounts_file(tmp_path, count):
+    path = tmp_path / 'accounts.json'
+    path.write_text(json.dumps([{'username': f'user{index}@example.com', 'password': 'secret'}
+                                for index in range(count)]))
+    return str(path)
+
+
+class TestAccounts:
+    """Tests for scraping more than one account"""
+
+    def test_the_environment_is_one_account(self):
+        import app
+
+        assert app.load_accounts() == [None]
+
+    def test_accounts_from_a_file(self, tmp_path):
+        import app
+
+        with patch.object(app, 'accounts_file', accounts_file(tmp_path, 2)):
+            accounts = app.load_accounts()
+
+        assert [account['name'] for account in accounts] == [
+            'user0_example_com', 'user1_example_com']
+
+    def test_an_account_without_password_is_refused(self, tmp_path):
+        import app
+
+        path = tmp_path / 'accounts.json'
+        path.write_text('[{"username": "someone"}]')
+        with patch.object(app, 'accounts_file', str(path)):
+            with pytest.raises(ValueError):
+                app.load_accounts()
+
+    def test_an_account_gets_topics_of_its_own(self):
+        import app
+
+        account = {'username': 'a@example.com', 'password': 'secret', 'name': 'home'}
+        with app.use_account(account):
+            assert app.mvf_username == 'a@example.com'
+            assert app.mqtt_topic == 'minvandforsyningdk/total/home'
+            assert app.mqtt_status_topic == 'minvandforsyningdk/status/home'
+        assert app.mvf_username == 'test-user'
+        assert app.mqtt_topic == 'minvandforsyningdk/total'
+
+    def test_an_account_can_name_its_topic(self):
+        import app
+
+        account = {'username': 'a', 'password': 'b', 'name': 'home', 'topic': 'water/home'}
+        with app.use_account(account):
+            assert app.mqtt_topic == 'water/home'
+
+    @patch('app.publish')
+    @patch('app.sleep')
+    def test_every_account_is_scraped_with_its_credentials(self, mock_sleep, mock_publish):
+        import app
+
+        pages = [dashboard_page(), dashboard_page()]
+        accounts = [{'username': f'user{index}', 'password': 'pw', 'name': f'n{index}'}
+                    for index in range(2)]
+        with patch('app.sync_playwright', fake_playwright()), \
+                patch('app.open_browser', side_effect=[FakeBrowser(page) for page in pages]):
+            results = app.scrape_accounts(accounts)
 
-    def test_datetime_parsing(self):
-        """Test parsing of datetime with custom format"""
-        parsed_date = datetime.strptime("kl. 18.58, d. 07.10.2024", 'kl. %H.%M, d. %d.%m.%Y')
+        assert all(results)
+        assert [page.locators['#signInName'].filled for page in pages] == [['user0'], ['user1']]
+        assert set(published(mock_publish)) >= {'minvandforsyningdk/total/n0',
+                                                'minvandforsyningdk/total/n1'}
 
-        assert datetime.strftime(parsed_date, "%Y-%m-%d %H:%M:%S") == "2024-10-07 18:58:00"
+    @patch('app.sleep')
+    @patch('app.scrape')
+    def test_read_now_caches_every_account(self, mock_scrape, mock_sleep, tmp_path):
+        import app
 
-    def test_localize_uses_danish_time(self):
-        from app import _localize
+        listener = Mock()
+        listener.wait.side_effect = KeyboardInterrupt
+        mock_scrape.side_effect = [READING, None]
+        with patch.object(app, 'accounts_file', accounts_file(tmp_path, 2)), \
+                patch.object(app, 'mqtt_commands', True), \
+                patch('app.CommandListener') as mock_listener:
+            mock_listener.return_value.start.return_value = listener
+            with pytest.raises(KeyboardInterrupt):
+                app.main()
 
-        assert _localize(datetime(2024, 7, 7, 18, 58)).isoformat() == '2024-07-07T18:58:00+02:00'
-        assert _localize(datetime(2024, 12, 7, 18, 58)).isoformat() == '2024-12-07T18:58:00+01:00'
+        results, accounts = listener.run_finished.call_args.args
+        assert results == [READING, None]
+        assert [account['name'] for account in accounts] == [
+            'user0_example_com', 'user1_example_com']
 
-    def test_format_to_regex_matches_the_same_text(self):
-        import re
-        from app import _format_to_regex
 
-        pattern = _format_to_regex('kl. %H.%M, d. %d.%m.%Y')
-        match = re.search(pattern, 'Aflæst kl. 18.58, d. 07.10.2024 i alt')
+class TestSharding:
+    """Tests for sharing the accounts between nodes"""
 
-        assert match.group(0) == 'kl. 18.58, d. 07.10.2024'
+    KEYS = [f'user{index}@example.com' for index in range(1000)]
 
-    def test_mqtt_message_structure(self):
-        """Test MQTT message JSON structure"""
-        msg_dict = {
-            "total": 234.32,
-            "meter_id": 23522852,
-            "timestamp": "2024-10-07 18:58:00",
-        }
+    def test_every_account_has_one_owner(self):
+        import app
 
-        parsed = json.loads(json.dumps(msg_dict))
+        ring = app.HashRing(['a', 'b', 'c'])
+        owners = [ring.owner(key) for key in self.KEYS]
 
-        assert parsed["total"] == 234.32
-        assert parsed["meter_id"] == 23522852
-        assert parsed["timestamp"] == "2024-10-07 18:58:00"
+        # spread about evenly
+        assert all(250 < owners.count(node) < 420 for node in 'abc')
 
+    def test_a_node_joining_moves_few_accounts(self):
+        import app
 
-class TestConfiguration:
-    """Tests for configuration and environment variables"""
+        before = app.HashRing(['a', 'b', 'c'])
+        after = app.HashRing(['a', 'b', 'c', 'd'])
+        moved = [key for key in self.KEYS if before.owner(key) != after.owner(key)]
 
-    def test_mqtt_auth_with_credentials(self):
-        """Test MQTT auth dict is created when credentials are provided"""
+        # only what the new node takes over, about a quarter
+        assert all(after.owner(key) == 'd' for key in moved)
+        assert len(moved) < 350
+
+    def test_a_node_leaving_only_moves_its_own_accounts(self):
         import app
 
-        assert hasattr(app, 'mqtt_auth')
+        before = app.HashRing(['a', 'b', 'c'])
+        after = app.HashRing(['a', 'c'])
 
-    def test_mqtt_client_id_format(self):
-        """Test MQTT client ID has correct format"""
+        for key in self.KEYS:
+            if before.owner(key) != 'b':
+                assert after.owner(key) == before.owner(key)
+
+    def test_the_nodes_agree_on_the_shards(self, tmp_path):
         import app
 
-        assert app.mqtt_client_id.startswith('python-mqtt-')
-        assert len(app.mqtt_client_id) > len('python-mqtt-')
+        with patch.object(app, 'accounts_file', accounts_file(tmp_path, 50)):
+            accounts = app.load_accounts()
+        shards = []
+        for node in ('a', 'b', 'c'):
+            cluster = app.Cluster(topic='cluster', node=node)
+            cluster.nodes = {'a', 'b', 'c'}
+            shards.append([account['username'] for account in cluster.shard(accounts)])
 
-    def test_environment_variable_defaults(self):
-        """Test default values for optional environment variables"""
+        assert sorted(sum(shards, [])) == sorted(account['username'] for account in accounts)
+
+    def test_presence_messages_keep_the_membership(self):
         import app
 
-        assert app.mqtt_port == 1883 or isinstance(app.mqtt_port, int)
-        assert hasattr(app, 'mqtt_topic')
-        assert hasattr(app, 'datetime_format')
+        cluster = app.Cluster(topic='cluster', node='a')
+        cluster.on_message(None, None, Mock(topic='cluster/nodes/b', payload=b'online'))
+        cluster.on_message(None, None, Mock(topic='cluster/nodes/c', payload=b'online'))
+        # the last will of c clears its presence
+        cluster.on_message(None, None, Mock(topic='cluster/nodes/c', payload=b''))
 
-    def test_the_selenium_url_is_gone(self):
-        """The scraper runs its own browser now"""
+        assert cluster.nodes == {'a', 'b'}
+
+    def test_a_dead_node_hands_its_accounts_over(self, tmp_path):
         import app
 
-        assert not hasattr(app, 'webdriver_remote_url')
+        with patch.object(app, 'accounts_file', accounts_file(tmp_path, 20)):
+            accounts = app.load_accounts()
+        cluster = app.Cluster(topic='cluster', node='a')
+        cluster.on_message(None, None, Mock(topic='cluster/nodes/b', payload=b'online'))
+        shared = len(cluster.shard(accounts))
+        cluster.on_message(None, None, Mock(topic='cluster/nodes/b', payload=b''))
 
-    def test_resilience_defaults(self):
-        """Test the resilience settings have sane defaults"""
+        assert shared < 20
+        assert len(cluster.shard(accounts)) == 20
+
+    @patch('app.sleep')
+    @patch('app.scrape_accounts')
+    def test_the_loop_scrapes_only_its_shard(self, mock_scrape, mock_sleep, tmp_path):
         import app
 
-        assert app._run_timer == 60 * 60
-        assert app.retry_interval < app._run_timer
-        assert app.max_attempts >= 1
-        assert app.page_load_timeout > 0
-        assert app.headless is True
+        cluster = Mock()
+        cluster.shard.return_value = ['mine']
+        mock_scrape.side_effect = [[READING], KeyboardInterrupt]
+        mock_sleep.side_effect = [None]
+        with patch.object(app, 'cluster_topic', 'cluster'), \
+                patch('app.Cluster') as mock_cluster:
+            mock_cluster.return_value.start.return_value = cluster
+            with pytest.raises(KeyboardInterrupt):
+                app.main()
+
+        mock_scrape.assert_called_with(['mine'], spread=True)
+        mock_sleep.assert_called_once_with(app._run_timer)
+        cluster.stop.assert_called_once()
+        # the ring is only taken once the other nodes had their say
+        assert [name for name, *_ in cluster.method_calls][:2] == ['wait_for_nodes', 'shard']
+
+    def test_the_retained_presence_is_waited_for(self):
+        import app
+
+        cluster = app.Cluster(topic='cluster', node='a')
+        cluster.SETTLE = 0.1
+        cluster.on_subscribe(None, None, 1, [1], None)
+        Timer(0.05, cluster.on_message,
+              (None, None, Mock(topic='cluster/nodes/b', payload=b'online'))).start()
+
+        assert cluster.wait_for_nodes(timeout=5) is True
+        assert cluster.nodes == {'a', 'b'}
+
+    def test_a_broker_that_does_not_answer_is_not_waited_for_long(self):
+        import app
+
+        cluster = app.Cluster(topic='cluster', node='a')
+        started = time.monotonic()
+
+        assert cluster.wait_for_nodes(timeout=0.2) is False
+        assert time.monotonic() - started < 1
+
+
+class TestPoliteness:
+    """Tests for the rate limit towards the site and the login provider"""
+
+    def test_the_burst_goes_at_once_then_the_rate(self):
+        import app
+
+        bucket = app.TokenBucket(rate=6, burst=2)
+        with patch('time.time', return_value=1000.0):
+            waits = [bucket.take() for _ in range(3)]
+
+        assert waits[:2] == [0, 0]
+        assert waits[2] == pytest.approx(10)
+
+    def test_tokens_come_back_with_time(self):
+        import app
+
+        bucket = app.TokenBucket(rate=6, burst=2)
+        with patch('time.time', return_value=1000.0):
+            bucket.take(), bucket.take()
+        with patch('time.time', return_value=1010.0):
+            assert bucket.take() == 0
+
+    def test_processes_share_the_bucket_in_a_file(self, tmp_path):
+        import app
+
+        path = str(tmp_path / 'rate')
+        with patch('time.time', return_value=1000.0):
+            assert app.TokenBucket(6, 2, path).take() == 0
+            # another process, with a bucket of its own on the same file
+            assert app.TokenBucket(6, 2, path).take() == 0
+            assert app.TokenBucket(6, 2, path).take() == pytest.approx(10)
+
+    def test_the_bucket_is_shared_by_forked_runs(self, tmp_path):
+        import app
+
+        bucket = app.TokenBucket(1, 1, str(tmp_path / 'rate'))
+        assert app.run_supervised(bucket.take) == 0
+        assert bucket.take() > 0
+
+    @patch('app.sleep')
+    def test_acquire_waits_for_a_token(self, mock_sleep):
+        import app
+
+        bucket = app.TokenBucket(rate=6, burst=1)
+        with patch.object(bucket, 'take', side_effect=[10.0, 0]):
+            bucket.acquire('login')
+
+        mock_sleep.assert_called_once_with(10.0)
+
+    @patch('app.sleep')
+    def test_acquire_keeps_to_the_deadline(self, mock_sleep):
+        import app
+
+        bucket = app.TokenBucket(rate=6, burst=1)
+        with patch('app.monotonic', return_value=1000):
+            deadline = app.Deadline(3)
+            with patch.object(bucket, 'take', side_effect=[10.0, 0]):
+                bucket.acquire('login', deadline)
+
+        mock_sleep.assert_called_once_with(3)
+
+    @patch('app.publish')
+    @patch('app.sleep')
+    def test_logins_and_page_loads_wait_their_turn(self, mock_sleep, mock_publish):
+        import app
+
+        with patch.object(app, 'rate_limit', 6), patch.object(app, '_bucket', None), \
+                patch('app.polite', wraps=app.polite) as mock_polite, \
+                patch('app.sync_playwright', fake_playwright()), \
+                patch('app.open_browser', return_value=FakeBrowser(dashboard_page())):
+            app.scrape_once()
+
+        assert [call_args[0][0] for call_args in mock_polite.call_args_list] == [
+            'login page', 'login']
+
+    def test_the_start_offset_is_spread_and_stable(self):
+        import app
+
+        offsets = {app._start_offset(f'node{index}') for index in range(100)}
+
+        assert app._start_offset('node1') == app._start_offset('node1')
+        assert len(offsets) > 90
+        assert all(0 <= offset < app._run_timer for offset in offsets)
+
+    @patch('app.sleep')
+    @patch('app.scrape')
+    def test_accounts_get_a_slot_each(self, mock_scrape, mock_sleep):
+        import app
+
+        accounts = [{'username': f'u{index}', 'password': 'p', 'name': f'u{index}'}
+                    for index in range(4)]
+        with patch.object(app, 'schedule_spread', True), \
+                patch('app.monotonic', return_value=1000):
+            app.scrape_accounts(accounts)
+
+        assert [call_args[0][0] for call_args in mock_sleep.call_args_list] == [
+            app._run_timer / 4, app._run_timer / 2, app._run_timer * 3 / 4]
+
+    @patch('app.sleep')
+    @patch('app.scrape')
+    def test_a_retry_is_not_spread(self, mock_scrape, mock_sleep):
+        import app
+
+        accounts = [{'username': f'u{index}', 'password': 'p', 'name': f'u{index}'}
+                    for index in range(2)]
+        with patch.object(app, 'schedule_spread', True), \
+                patch('app.monotonic', return_value=1000):
+            app.scrape_accounts(accounts, spread=False)
+
+        assert mock_scrape.call_count == 2
+        mock_sleep.assert_not_called()
+
+
+B2C_FORM = 'https://login.example.b2clogin.com/authorize?p=B2C_1_signin'
+
+
+def picker_page():
+    """A dashboard page where the provider button leads to the login form."""
+    import app
+    page = dashboard_page()
+    provider = page.locator(app.SELECTORS['login-provider'][0])
+    provider.click = lambda timeout=None: setattr(page, 'url', B2C_FORM)
+    return page
+
+
+@pytest.fixture
+def login_entry(tmp_path):
+    import app
+    with patch.object(app, 'login_entry_ttl', 3600), patch.object(app, 'state_dir', str(tmp_path)):
+        yield
+
+
+@pytest.mark.usefixtures('login_entry')
+class TestLoginEntry:
+    """Tests for going straight to the login form the picker led to before"""
+
+    @patch('app.publish')
+    @patch('app.sleep')
+    def test_the_next_run_skips_the_picker(self, mock_sleep, mock_publish):
+        import app
+
+        first, second = picker_page(), picker_page()
+        with patch('app.sync_playwright', fake_playwright()), \
+                patch('app.open_browser', side_effect=[FakeBrowser(first), FakeBrowser(second)]):
+            app.scrape_once()
+            app.scrape_once()
+
+        assert first.goto_calls == [app.login_url]
+        assert app.cached_login_entry() == B2C_FORM
+        assert second.goto_calls == [B2C_FORM]
+        assert second.locator(app.SELECTORS['login-provider'][0]).clicks == 0
+        assert second.locator('#signInName').filled == ['test-user']
+
+    def test_falls_back_to_the_picker_when_the_form_is_not_there(self):
+        import app
+
+        app.remember_login_entry(B2C_FORM)
+        page = dashboard_page()
+        with patch('app.find', side_effect=[app.ElementNotFoundError('gone'), Mock(), Mock()]), \
+                patch('app.click'):
+            assert app.open_login_form(page) is False
+
+        assert page.goto_calls == [B2C_FORM, app.login_url]
+        assert app.cached_login_entry() is None
+
+    def test_an_expired_entry_is_not_used(self):
+        import app
+
+        app.remember_login_entry(B2C_FORM)
+        with patch('time.time', return_value=time.time() + 3601):
+            assert app.cached_login_entry() is None
+
+    def test_is_off_by_default(self):
+        import app
+
+        with patch.object(app, 'login_entry_ttl', 0):
+            app.remember_login_entry(B2C_FORM)
+            assert app.cached_login_entry() is None
+
+    @patch('app.publish')
+    @patch('app.sleep')
+    def test_a_shortcut_that_does_not_log_in_goes_through_the_picker(self, mock_sleep,
+                                                                      mock_publish):
+        import app
+
+        app.remember_login_entry(B2C_FORM)
+        page = picker_page()
+        read_values = app.read_values
+        with patch('app.sync_playwright', fake_playwright()), \
+                patch('app.open_browser', return_value=FakeBrowser(page)), \
+                patch('app.read_values', side_effect=[app.ElementNotFoundError('no total'),
+                                                      read_values(page)]):
+            values = app.scrape_once()
+
+        assert values['total'] == 234.32
+        # the form was there, the dashboard was not: the picker in the same attempt
+        assert page.goto_calls == [B2C_FORM, app.login_url]
+        assert page.url == B2C_FORM  # where the provider button led
+        assert page.locator('#signInName').filled == ['test-user', 'test-user']
+        # and the picker's page is not taken as a shortcut again for a while
+        assert app.cached_login_entry() is None
+        app.remember_login_entry(B2C_FORM)
+        assert app.cached_login_entry() is None
+
+    @patch('app.publish')
+    @patch('app.sleep')
+    def test_a_run_that_fails_both_ways_forgets_the_shortcut(self, mock_sleep, mock_publish):
+        import app
+
+        app.remember_login_entry(B2C_FORM)
+        page = dashboard_page()
+        with patch('app.sync_playwright', fake_playwright()), \
+                patch('app.open_browser', return_value=FakeBrowser(page)), \
+                patch('app.read_values', side_effect=app.ElementNotFoundError('no total')), \
+                pytest.raises(app.ElementNotFoundError):
+            app.scrape_once()
+
+        assert page.goto_calls == [B2C_FORM, app.login_url]
+        assert app.cached_login_entry() is None
+
+
+class WatchedPage(FakePage):
+    """A dashboard that runs one of `ticks` every time playwright waits."""
+
+    def __init__(self, ticks):
+        super().__init__(dashboard_page().elements)
+        self.ticks = list(ticks)
+        self.exposed = {}
+        self.reloads = 0
+        self.evaluated = []
+
+    def expose_function(self, name, callback):
+        self.exposed[name] = callback
+
+    def evaluate(self, script):
+        self.evaluated.append(script)
+
+    def reload(self, timeout=None):
+        self.reloads += 1
+
+    def wait_for_timeout(self, timeout):
+        self.ticks.pop(0)(self)
+
+    def change_total(self, text):
+        self.locator('xpath=//span[2]/b[2]').text = text
+        self.exposed['minvandforsyningChanged']()
+
+
+class FakeSocket:
+    def __init__(self, url):
+        self.url = url
+        self.handlers = {}
+
+    def on(self, event, handler):
+        self.handlers[event] = handler
+
+
+def nothing(page):
+    pass
+
+
+class TestWatchMode:
+    """Tests for keeping the dashboard open and publishing its changes"""
+
+    def watch(self, page):
+        import app
+        with patch('app.sync_playwright', fake_playwright()), \
+                patch('app.open_browser', return_value=FakeBrowser(page)), \
+                patch('app.record_reading') as mock_record:
+            last = app.watch(keep_going=lambda: bool(page.ticks))
+        return last, mock_record
+
+    @patch('app.publish')
+    @patch('app.sleep')
+    def test_publishes_when_the_dashboard_changes(self, mock_sleep, mock_publish):
+        import app
+
+        page = WatchedPage([nothing, lambda page: page.change_total('235,01'), nothing])
+        last, mock_record = self.watch(page)
+
+        totals = [json.loads(payload)['total'] for payload in published(mock_publish)[app.mqtt_topic]]
+        assert totals == [234.32, 235.01]
+        assert last['total'] == 235.01
+        assert mock_record.call_count == 2
+        assert page.goto_calls == [app.login_url]  # logged in once
+        assert page.evaluated and 'MutationObserver' in page.evaluated[0]
+
+    @patch('app.publish')
+    @patch('app.sleep')
+    def test_an_unchanged_reading_is_not_published_again(self, mock_sleep, mock_publish):
+        import app
+
+        page = WatchedPage([lambda page: page.exposed['minvandforsyningChanged'](), nothing])
+        self.watch(page)
+
+        assert len(published(mock_publish)[app.mqtt_topic]) == 1
+
+    @patch('app.publish')
+    @patch('app.sleep')
+    def test_reloads_when_the_circuit_drops(self, mock_sleep, mock_publish):
+        socket = FakeSocket('wss://www.minvandforsyning.dk/_blazor?id=1')
+
+        def drop(page):
+            page.handlers['websocket'][0](socket)
+            socket.handlers['close'](socket)
+
+        page = WatchedPage([drop, nothing])
+        self.watch(page)
+
+        assert page.reloads == 1
+        assert len(page.evaluated) == 2  # the observer is installed again
+
+    @patch('app.publish')
+    @patch('app.sleep')
+    def test_reloads_every_interval(self, mock_sleep, mock_publish):
+        import app
+
+        page = WatchedPage([nothing, nothing])
+        with patch.object(app, 'watch_reload_interval', 0):
+            self.watch(page)
+
+        assert page.reloads == 2
+
+    @patch('app.publish')
+    @patch('app.sleep')
+    def test_a_lost_session_ends_the_watch_with_the_last_reading(self, mock_sleep, mock_publish):
+        import app
+
+        def logged_out(page):
+            page.elements.clear()
+            page.locators.clear()
+            page.exposed['minvandforsyningChanged']()
+
+        page = WatchedPage([logged_out, nothing])
+        browser = FakeBrowser(page)
+        with patch('app.sync_playwright', fake_playwright()), \
+                patch('app.open_browser', return_value=browser), patch('app.record_reading'):
+            last = app.watch(keep_going=lambda: bool(page.ticks))
+
+        assert last['total'] == 234.32
+        assert page.ticks == [nothing]
+        assert browser.closed and browser.context.closed
+
+    @patch('app.publish')
+    @patch('app.sleep')
+    def test_the_config_is_checked_on_every_reload(self, mock_sleep, mock_publish):
+        import app
+
+        page = WatchedPage([nothing, nothing])
+        check = Mock(return_value=False)
+        with patch.object(app, 'watch_reload_interval', 0), \
+                patch('app.sync_playwright', fake_playwright()), \
+                patch('app.open_browser', return_value=FakeBrowser(page)), \
+                patch('app.record_reading'):
+            app.watch(keep_going=lambda: bool(page.ticks), on_reload=check)
+
+        assert check.call_count == page.reloads == 2
+
+    @patch('app.publish')
+    @patch('app.sleep')
+    def test_an_isolated_session_is_published_from_here(self, mock_sleep, mock_publish):
+        import app
+
+        # the ticks run out in the run process, which ends the session there
+        page = WatchedPage([nothing, lambda page: page.change_total('235,01'), nothing])
+        with patch.object(app, 'run_isolation', True), \
+                patch('app.sync_playwright', fake_playwright()), \
+                patch('app.open_browser', return_value=FakeBrowser(page)), \
+                patch('app.record_reading') as mock_record:
+            last = app.watch()
+
+        totals = [json.loads(payload)['total'] for payload in published(mock_publish)[app.mqtt_topic]]
+        assert totals == [234.32, 235.01]
+        assert mock_record.call_count == 2
+        assert last['total'] == 235.01
+
+    @patch('app.publish')
+    @patch('app.sleep')
+    def test_a_wedged_session_is_killed(self, mock_sleep, mock_publish):
+        import app
+
+        page = WatchedPage([lambda page: time.sleep(60)])
+        started = time.monotonic()
+        with patch.object(app, 'run_isolation', True), patch.object(app, 'run_timeout', 1), \
+                patch('app.sync_playwright', fake_playwright()), \
+                patch('app.open_browser', return_value=FakeBrowser(page)), \
+                patch('app.record_reading'):
+            last = app.watch()
+
+        assert time.monotonic() - started < 10
+        assert last['total'] == 234.32
+
+    @patch('app.publish')
+    @patch('app.sleep')
+    def test_a_new_config_ends_an_isolated_session(self, mock_sleep, mock_publish):
+        import app
+
+        page = WatchedPage([lambda page: time.sleep(0.5)] * 20)
+        check = Mock(return_value=True)
+        started = time.monotonic()
+        with patch.object(app, 'run_isolation', True), \
+                patch.object(app, 'watch_reload_interval', 0), \
+                patch('app.sync_playwright', fake_playwright()), \
+                patch('app.open_browser', return_value=FakeBrowser(page)), \
+                patch('app.record_reading'):
+            app.watch(on_reload=check)
+
+        check.assert_called_once()
+        assert time.monotonic() - started < 5
+
+    @patch('app.sleep')
+    def test_the_loop_watches_a_single_account(self, mock_sleep):
+        import app
+
+        with patch.object(app, 'watch_mode', True), \
+                patch('app.watch', side_effect=[{'total': 1}, KeyboardInterrupt]) as mock_watch, \
+                patch('app.scrape') as mock_scrape, pytest.raises(KeyboardInterrupt):
+            app.main()
+
+        assert mock_watch.call_count == 2
+        mock_scrape.assert_not_called()
+        mock_sleep.assert_called_once_with(app._WATCH_RESTART)
 
 
 class TestMainLoop:
     """Tests for the run loop"""
 
+    @patch('app.sleep')
+    @patch('app.scrape_accounts')
+    def test_only_the_accounts_that_failed_are_tried_again(self, mock_scrape, mock_sleep,
+                                                           tmp_path):
+        import app
+
+        mock_scrape.side_effect = [[READING, None, READING], [None], [READING],
+                                   [READING, READING, READING], KeyboardInterrupt]
+        with patch.object(app, 'accounts_file', accounts_file(tmp_path, 3)), \
+                patch.object(app, 'retry_interval', 60), patch.object(app, '_run_timer', 600), \
+                patch('app.monotonic', side_effect=itertools.count(1000, 10)):
+            with pytest.raises(KeyboardInterrupt):
+                app.main()
+
+        batches = [[account['username'] for account in call.args[0]]
+                   for call in mock_scrape.call_args_list]
+        assert batches[1:3] == [['user1@example.com'], ['user1@example.com']]
+        assert len(batches[3]) == 3
+        # only the full runs are spread over the interval
+        assert [call.kwargs['spread'] for call in mock_scrape.call_args_list[:4]] == [
+            True, False, False, True]
+        delays = [call.args[0] for call in mock_sleep.call_args_list]
+        # two retries, then the rest of the interval of the full run
+        assert delays[:2] == [60, 60]
+        assert 500 < delays[2] < 600
+
     @patch('app.sleep')
     @patch('app.scrape')
     def test_loop_uses_the_short_interval_after_a_failure(self, mock_scrape, mock_sleep):
@@ -0,0 +1,192 @@
+"""
+Retries and timeouts against a site that misbehaves on purpose.
+
+Every scenario is a stand-in site with faults injected: slow pages, error
+responses, a dashboard that renders late, a websocket that never answers,
+changed ids. A full scrape() runs against each, with its retries and backoff,
+and the report at the end has per scenario whether there was a reading, the
+attempts it took, the time to the reading and the backoff between attempts in
+it. The backoff is counted but not waited for, so the report shows what a run
+would take without the suite taking that long.
+
+Every scenario runs twice: with every attempt in a run process, the way the
+scraper runs in production, and in this process. The timeouts are the ones of
+the environment, so settings can be compared:
+
+    element-timeout=10 dashboard-timeout=20 python -m pytest tests/test_faults.py -s
+"""
+import json
+import os
+import socket
+import sys
+import time
+from urllib.error import HTTPError
+from urllib.request import urlopen
+from unittest.mock import patch
+
+import pytest
+
+os.environ.setdefault('mqtt-broker', 'localhost')
+os.environ.setdefault('username', 'test-user')
+os.environ.setdefault('password', 'test-pass')
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from tests.standin import SELECTORS, StandInBroker, StandInSite  # noqa: E402
+from tests.test_integration import requires_browser  # noqa: E402
+
+SCENARIOS = {
+    'healthy': {},
+    'slow-pages': {'slow': {'index.html': 2, 'login.html': 2, 'dashboard.html': 2}},
+    'picker-5xx-twice': {'errors': {'index.html': [503, 502]}},
+    'late-render': {'late_render': 8},
+    'hung-websocket': {'hang_websockets': 1},
+    'changed-ids': {'changed_ids': True},
+    'down': {'errors': {'index.html': [503] * 10}},
+}
+
+REPORT = []
+
+
+@pytest.fixture
+def site_dir(tmp_path):
+    directory = tmp_path / 'site'
+    directory.mkdir()
+    return directory
+
+
+def fetch(url):
+    try:
+        with urlopen(url, timeout=5) as response:
+            return response.status, response.read().decode('utf-8')
+    except HTTPError as error:
+        return error.code, ''
+
+
+class TestStandInSite:
+    """Tests for the faults the stand-in site injects"""
+
+    def test_errors_are_served_once_each(self, site_dir):
+        site = StandInSite(site_dir, errors={'index.html': [503, 502]}).start()
+        try:
+            statuses = [fetch(site.url)[0] for _ in range(3)]
+        finally:
+            site.stop()
+
+        assert statuses == [503, 502, 200]
+        assert site.requests == [('index.html', 503), ('index.html', 502), ('index.html', 200)]
+
+    def test_a_slow_page_takes_its_time(self, site_dir):
+        site = StandInSite(site_dir, slow={'login.html': 0.3}).start()
+        try:
+            started = time.monotonic()
+            fetch(site.url.replace('index.html', 'login.html'))
+        finally:
+            site.stop()
+
+        assert time.monotonic() - started >= 0.3
+
+    def test_changed_ids_and_a_late_dashboard(self, site_dir):
+        site = StandInSite(site_dir, changed_ids=True, late_render=2, websocket=True).start()
+        try:
+            _, login = fetch(site.url.replace('index.html', 'login.html'))
+            _, dashboard = fetch(site.url.replace('index.html', 'dashboard.html'))
+        finally:
+            site.stop()
+
+        assert "id='email'" in login and 'signInName' not in login
+        assert 'setTimeout(render, 2000)' in dashboard
+        assert "new WebSocket" in dashboard
+
+    @pytest.mark.parametrize('hang', [0, 1])
+    def test_the_websocket_answers_unless_it_hangs(self, site_dir, hang):
+        site = StandInSite(site_dir, hang_websockets=hang).start()
+        port = site.server.server_port
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=2) as connection:
+                connection.sendall(b'GET /_blazor HTTP/1.1\r\nHost: x\r\nUpgrade: websocket\r\n'
+                                   b'Connection: Upgrade\r\nSec-WebSocket-Key: '
+                                   b'dGhlIHNhbXBsZSBub25jZQ==\r\nSec-WebSocket-Version: 13\r\n\r\n')
+                connection.settimeout(1)
+                received = b''
+                try:
+                    while b'render' not in received:
+                        chunk = connection.recv(1024)
+                        if not chunk:
+                            break
+                        received += chunk
+                except socket.timeout:
+                    pass
+        finally:
+            site.stop()
+
+        assert b'101' in received.split(b'\r\n')[0]
+        assert b's3pPLMBiTxaQ9kYGzzhZRbK+xOo=' in received
+        assert (b'render' in received) is not bool(hang)
+
+
+@pytest.fixture(scope='module')
+def report():
+    yield REPORT
+    if REPORT:
+        print("\n\nscenario            mode        reading  attempts  time to reading  "
+              "of which backoff")
+        for row in REPORT:
+            print(f"{row['scenario']:<19} {row['mode']:<11} {'yes' if row['reading'] else 'no':<8} "
+                  f"{row['attempts']:>8}  {row['seconds']:>14.1f}s  {row['backoff']:>15.1f}s")
+
+
+@pytest.mark.integration
+@requires_browser
+class TestFaultScenarios:
+    """How long a reading takes, and how many attempts, when the site misbehaves"""
+
+    @pytest.mark.parametrize('isolated', [True, False], ids=['isolated', 'in-process'])
+    @pytest.mark.parametrize('scenario', SCENARIOS)
+    def test_scenario(self, scenario, isolated, site_dir, report):
+        import app
+
+        site = StandInSite(site_dir, **SCENARIOS[scenario]).start()
+        broker = StandInBroker().start()
+        slept = []
+        backoff = []
+        parent = os.getpid()
+
+        def skip(seconds):
+            if os.getpid() != parent:
+                # a run process has no way to report it, its time is measured anyway
+                return time.sleep(seconds)
+            slept.append(seconds)
+
+        # an attempt is what scrape() hands to its run process, or calls itself
+        if isolated:
+            attempt = 'run_hedged' if app.hedge_attempts else 'run_supervised'
+        else:
+            attempt = 'scrape_once'
+        try:
+            with patch.object(app, 'run_isolation', isolated), \
+                    patch.object(app, 'login_url', site.url), \
+                    patch.object(app, 'SELECTORS', {**app.SELECTORS, **SELECTORS}), \
+                    patch.object(app, 'mqtt_broker', '127.0.0.1'), \
+                    patch.object(app, 'mqtt_port', broker.port), \
+                    patch('app.sleep', skip), \
+                    patch('app.back_off', side_effect=backoff.append), \
+                    patch.object(app, attempt, wraps=getattr(app, attempt)) as attempts:
+                started = time.monotonic()
+                values = app.scrape()
+                seconds = time.monotonic() - started + sum(slept) + sum(backoff)
+        finally:
+            site.stop()
+            broker.stop()
+
+        report.append({'scenario': scenario, 'mode': 'isolated' if isolated else 'in-process',
+                       'reading': values is not None, 'attempts': attempts.call_count,
+                       'seconds': seconds, 'backoff': sum(backoff)})
+        if scenario == 'down':
+            assert values is None
+            assert attempts.call_count == app.max_attempts
+        else:
+            assert values['total'] == 1234.50
+            published = [json.loads(payload) for topic, payload in broker.messages
+                         if topic == app.mqtt_topic]
+            assert published[-1]['total'] == 1234.50
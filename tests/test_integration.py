@@ -320,6 +320,30 @@ class TestDiscoveryIntegration:
             mqtt_client.publish(topic, '', retain=True)
         time.sleep(SUBSCRIPTION_WAIT)
 
+    def test_verify_finds_the_retained_configs(self, mqtt_client):
+        """After a restart with verify on, nothing is published again."""
+        import app
+
+        app._announced_meters.clear()
+        with_prefix = 'test/verify/homeassistant'
+        with patch.object(app, 'discovery_prefix', with_prefix), \
+                patch.object(app, 'mqtt_broker', os.environ.get('mqtt-broker', 'localhost')):
+            app.publish_discovery(23522852)
+            topics = [topic for topic, _ in app.discovery_config(23522852)]
+            retained = app.retained_messages(topics)
+
+            app._announced_meters.clear()
+            with patch('app.publish') as mock_publish, \
+                    patch.object(app, 'mqtt_discovery_verify', True):
+                app.publish_discovery(23522852)
+
+        assert sorted(retained) == sorted(topics)
+        mock_publish.assert_not_called()
+
+        for topic in topics:
+            mqtt_client.publish(topic, '', retain=True)
+        time.sleep(SUBSCRIPTION_WAIT)
+
     def test_a_published_reading_matches_the_discovery_templates(self, mqtt_client):
         """The value_templates must line up with the payload we publish."""
         import app
@@ -357,39 +381,11 @@ class TestDiscoveryIntegration:
 @pytest.fixture
 def fake_site(tmp_path):
     """Serve a small copy of the site: picker -> login form -> dashboard."""
-    from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
-    import threading
-
-    (tmp_path / 'index.html').write_text(
-        "<html><head><meta charset='utf-8'></head><body><div><div>"
-        "<div>a</div><div><div>x</div><div>y</div><div>"
-        "<button onclick=\"location.href='login.html'\"><span><p>"
-        "Log ind med Rambøll konto</p></span></button>"
-        "</div></div></div></div></body></html>", encoding='utf-8')
-    (tmp_path / 'login.html').write_text(
-        "<html><head><meta charset='utf-8'></head><body>"
-        "<form action='dashboard.html'>"
-        "<input id='signInName' name='signInName'>"
-        "<input type='password' name='password'>"
-        "<button id='next' type='submit'>Log ind</button>"
-        "</form></body></html>", encoding='utf-8')
-    (tmp_path / 'dashboard.html').write_text(
-        "<html><head><meta charset='utf-8'></head><body><div>"
-        "<span><b>23522852</b></span>"
-        "<span><b>kl. 18.58, d. 07.10.2024</b><b>1.234,50</b></span>"
-        "</div></body></html>", encoding='utf-8')
-
-    class Handler(SimpleHTTPRequestHandler):
-        def __init__(self, *args, **kwargs):
-            super().__init__(*args, directory=str(tmp_path), **kwargs)
-
-        def log_message(self, *args):
-            pass
-
-    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
-    threading.Thread(target=server.serve_forever, daemon=True).start()
-    yield f'http://127.0.0.1:{server.server_port}/index.html'
-    server.shutdown()
+    from tests.standin import StandInSite
+
+    site = StandInSite(tmp_path).start()
+    yield site.url
+    site.stop()
 
 
 @integration
@@ -454,7 +450,8 @@ class TestEndToEndIntegration:
                 patch.object(app, 'element_timeout', 2):
             with pytest.raises(app.ElementNotFoundError):
                 app.scrape_once()
+            app._diagnostics.flush()
 
-        assert len(list(debug_dir.glob('*-failure.html'))) == 1
+        assert len(list(debug_dir.glob('*-failure.html.gz'))) == 1
         assert len(list(debug_dir.glob('*-failure.png'))) == 1
         assert len(list(debug_dir.glob('*-failure-trace.zip'))) == 1
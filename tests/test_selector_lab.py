@@ -0,0 +1,141 @@
+# Tests for the offline selector lab
+import gzip
+import io
+import os
+import sys
+from unittest.mock import Mock, patch
+
+from playwright.sync_api import Error as PlaywrightError
+
+os.environ.setdefault('mqtt-broker', 'test-broker')
+os.environ.setdefault('username', 'test-user')
+os.environ.setdefault('password', 'test-pass')
+os.environ.setdefault('run-isolation', 'false')
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+
+class FakeLocator:
+    def __init__(self, text):
+        self.text = text
+
+    @property
+    def first(self):
+        return self
+
+    def is_visible(self):
+        if self.text == 'invalid':
+            raise PlaywrightError("Unexpected token")
+        return self.text is not None
+
+    def inner_text(self):
+        return self.text
+
+
+class FakePage:
+    """Every snapshot is a dict of selector -> text, looked up by its html."""
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.elements = {}
+        self.loaded = []
+
+    def set_content(self, html, wait_until=None):
+        self.loaded.append(html)
+        self.elements = self.pages[html]
+
+    def locator(self, selector):
+        if selector == 'body':
+            return FakeLocator(self.elements.get('body', ''))
+        return FakeLocator(self.elements.get(selector))
+
+
+def fake_playwright(page):
+    playwright = Mock()
+    context = playwright.chromium.launch.return_value.new_context.return_value
+    context.new_page.return_value = page
+    manager = Mock()
+    manager.__enter__ = Mock(return_value=playwright)
+    manager.__exit__ = Mock(return_value=False)
+    return playwright, Mock(return_value=manager)
+
+
+class TestSnapshots:
+    """Tests for finding and reading saved pages"""
+
+    def test_collects_html_and_gzipped_html_from_directories(self, tmp_path):
+        import selector_lab
+
+        (tmp_path / 'a').mkdir()
+        (tmp_path / 'a' / '20241007-185800-dashboard.html.gz').write_bytes(
+            gzip.compress('<b>gz</b>'.encode('utf-8')))
+        (tmp_path / 'a' / '20241007-185800-dashboard.png').write_bytes(b'png')
+        (tmp_path / 'saved.html').write_text('<b>plain</b>', encoding='utf-8')
+
+        paths = selector_lab.snapshots([str(tmp_path)])
+
+        assert [os.path.basename(path) for path in paths] == [
+            '20241007-185800-dashboard.html.gz', 'saved.html']
+        assert [selector_lab.read_snapshot(path) for path in paths] == [
+            '<b>gz</b>', '<b>plain</b>']
+
+
+class TestEvaluate:
+    """Tests for the match matrix"""
+
+    def test_every_candidate_and_pattern_is_tried_on_every_snapshot(self):
+        import app
+        import selector_lab
+
+        profile = app.PROFILES['minvandforsyning']
+        page = FakePage({
+            'old': {'xpath=//span[2]/b[2]': '234,32', 'xpath=//b': '23522852',
+                    'xpath=//span[2]/b': 'kl. 18.58, d. 07.10.2024'},
+            'new': {'[class*=total] b >> nth=-1': 'soon',
+                    'body': 'Måler 23522852 står på 234,32 m³ kl. 18.58, d. 07.10.2024'},
+        })
+        playwright, factory = fake_playwright(page)
+        with patch.object(selector_lab, 'read_snapshot', side_effect=lambda path: path):
+            table, rows = selector_lab.run(['old', 'new'], profile, playwright_factory=factory)
+
+        playwright.chromium.launch.return_value.new_context.assert_called_once_with(
+            java_script_enabled=False)
+        assert page.loaded == ['old', 'new']
+        outcomes = {path: {(kind, target, getattr(candidate, 'pattern', candidate)): outcome
+                           for (kind, target, candidate), (outcome, _) in zip(table, results)}
+                    for path, results in rows}
+        assert outcomes['old'][('selector', 'total', 'xpath=//span[2]/b[2]')] == 'match'
+        assert outcomes['old'][('selector', 'timestamp', 'xpath=//span[2]/b')] == 'match'
+        assert outcomes['old'][('pattern', 'total', profile.total_re.pattern)] is None
+        assert outcomes['new'][('selector', 'total', 'xpath=//span[2]/b[2]')] is None
+        assert outcomes['new'][('selector', 'total', '[class*=total] b >> nth=-1')] == 'unparsable'
+        assert outcomes['new'][('pattern', 'total', profile.total_re.pattern)] == 'match'
+        assert outcomes['new'][('pattern', 'meter-id', profile.meter_id_re.pattern)] == 'match'
+        assert outcomes['new'][('pattern', 'timestamp', profile.timestamp_re.pattern)] == 'match'
+
+    def test_a_selector_playwright_rejects_is_marked(self):
+        import app
+        import selector_lab
+
+        profile = app.PROFILES['minvandforsyning']
+        page = FakePage({'page': {'#next': 'invalid'}})
+        page.set_content('page')
+        table = [('selector', 'submit', '#next')]
+
+        assert [outcome for outcome, _ in selector_lab.evaluate(page, table, profile)] == ['error']
+
+    def test_report_counts_hits_per_candidate(self):
+        import re
+        import selector_lab
+
+        table = [('selector', 'total', '#total'), ('pattern', 'total', re.compile(r'(\d+)'))]
+        rows = [('a.html', [('match', 0.001), (None, 0.0)]),
+                ('b.html', [('match', 0.003), ('match', 0.0)])]
+        out = io.StringIO()
+
+        selector_lab.report(table, rows, out=out)
+
+        lines = out.getvalue().splitlines()
+        assert '2/2' in lines[0] and '2.00 ms' in lines[0] and '#total' in lines[0]
+        assert '1/2' in lines[1] and r'(\d+)' in lines[1]
+        assert lines[-2:] == ['+. a.html', '++ b.html']
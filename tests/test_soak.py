@@ -0,0 +1,194 @@
+"""
+Soak test: thousands of scrape cycles, watching for anything that grows.
+
+The scraper runs for months, so a few kB or one file descriptor per run adds
+up. This runs full cycles against the stand-in site and broker with every wait
+taken out, and after each cycle samples the RSS of this process, the browser
+processes left anywhere on the host, the child processes not reaped, its open
+file descriptors, the entries in its temp dir and the connections still open
+on the broker. Only the browsers of this test count: those below this process,
+and those in the sessions of the run processes it started. Once the warm-up is over, any of them growing past its
+threshold fails the test.
+
+SOAK_MODE picks what a cycle is. 'scrape' (the default) is app.scrape() with
+run-isolation on, the way the scraper runs in production: a forked run
+process, its pipe, the kill of its process tree. 'scrape_once' is one attempt
+in this process, which isolates leaks of the scrape itself.
+
+It needs a playwright browser and takes a while, so it only runs when asked:
+
+    SOAK_CYCLES=2000 python -m pytest tests/test_soak.py -s
+
+SOAK_WARMUP (cycles before the baseline is taken, 10), SOAK_MAX_RSS_GROWTH
+(MB, 64), SOAK_MAX_FD_GROWTH (8) and SOAK_MAX_TEMP_GROWTH (2) tune it.
+"""
+import os
+import sys
+import tempfile
+import time
+from unittest.mock import patch
+
+import pytest
+
+os.environ.setdefault('mqtt-broker', 'localhost')
+os.environ.setdefault('username', 'test-user')
+os.environ.setdefault('password', 'test-pass')
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from tests.standin import SELECTORS, StandInBroker, StandInSite  # noqa: E402
+
+CYCLES = int(os.environ.get('SOAK_CYCLES', 0))
+MODE = os.environ.get('SOAK_MODE', 'scrape')
+WARMUP = int(os.environ.get('SOAK_WARMUP', 10))
+THRESHOLDS = {
+    'rss_mb': float(os.environ.get('SOAK_MAX_RSS_GROWTH', 64)),
+    'fds': int(os.environ.get('SOAK_MAX_FD_GROWTH', 8)),
+    'temp': int(os.environ.get('SOAK_MAX_TEMP_GROWTH', 2)),
+    # nothing of a run may outlive it
+    'browsers': 0,
+    'children': 0,
+    'connections': 0,
+}
+# counted as they are, not against the warm-up
+LEFT_BEHIND = ('browsers', 'children', 'connections')
+REPORT_EVERY = 100
+
+
+@pytest.fixture
+def broker():
+    broker = StandInBroker().start()
+    yield broker
+    broker.stop()
+
+
+@pytest.fixture
+def site(tmp_path):
+    (tmp_path / 'site').mkdir()
+    site = StandInSite(tmp_path / 'site').start()
+    yield site
+    site.stop()
+
+
+def session(pid):
+    """The session a process is in, None when it is gone."""
+    try:
+        with open(f'/proc/{pid}/stat', encoding='utf-8', errors='replace') as handle:
+            stat = handle.read()
+    except OSError:
+        return None
+    return int(stat[stat.rindex(')') + 2:].split()[3])
+
+
+def browsers(runs):
+    """Chromium and playwright driver processes of this test.
+
+    Those below this process, and those in the sessions of `runs`, the run
+    processes started: a browser orphaned by a killed run process is no longer
+    below this one, but it is still in the session of its run.
+    """
+    import app
+    ours = set(app.browser_processes())
+    return {pid for pid, (_, name) in app._process_table().items()
+            if (app._is_chromium(name) or name == 'node')
+            and (pid in ours or session(pid) in runs)}
+
+
+def sample(broker, temp_dir, runs):
+    """What one process of the scraper holds on to right now."""
+    import app
+    with open('/proc/self/statm') as handle:
+        resident = int(handle.read().split()[1])
+    return {
+        'rss_mb': resident * app._PAGE_SIZE / 1024 / 1024,
+        'fds': len(os.listdir('/proc/self/fd')),
+        'temp': len(os.listdir(temp_dir)),
+        'browsers': len(browsers(runs)),
+        # run processes that were never joined stay as zombies
+        'children': sum(1 for parent, _ in app._process_table().values()
+                        if parent == os.getpid()),
+        'connections': broker.connections,
+    }
+
+
+def settled(broker, temp_dir, runs, wait=5):
+    """A sample once the processes and connections of the last cycle had time to go."""
+    end = time.monotonic() + wait
+    while True:
+        now = sample(broker, temp_dir, runs)
+        if not any(now[key] for key in LEFT_BEHIND) or time.monotonic() > end:
+            return now
+        time.sleep(0.1)
+
+
+class TestStandInBroker:
+    """Tests for the broker the soak test publishes to"""
+
+    def test_paho_can_publish_to_it(self, broker):
+        from paho.mqtt.publish import single
+
+        single('soak/total', '{"total": 1}', hostname='127.0.0.1', port=broker.port, qos=1)
+
+        assert broker.messages == [('soak/total', '{"total": 1}')]
+        for _ in range(50):
+            if not broker.connections:
+                break
+            time.sleep(0.1)
+        assert broker.connections == 0
+
+
+@pytest.mark.integration
+@pytest.mark.skipif(not CYCLES, reason="Set SOAK_CYCLES to run the soak test")
+class TestSoak:
+    """Many runs in a row, and nothing may pile up"""
+
+    def test_scraping_does_not_leak(self, site, broker, tmp_path, monkeypatch):
+        import app
+
+        run_cycle = {'scrape': app.scrape, 'scrape_once': app.scrape_once}[MODE]
+
+        # a temp dir of its own, for chromium and the playwright driver as well
+        temp_dir = tmp_path / 'tmp'
+        temp_dir.mkdir()
+        monkeypatch.setenv('TMPDIR', str(temp_dir))
+        monkeypatch.setattr(tempfile, 'tempdir', None)
+
+        # a run process leads a session of its own, its browsers stay in it
+        runs = set()
+        start_run = app.RunProcess.__init__
+
+        def recorded(run, *args):
+            start_run(run, *args)
+            runs.add(run.child.pid)
+
+        history = []
+        with patch.object(app, 'run_isolation', MODE == 'scrape'), \
+                patch.object(app.RunProcess, '__init__', recorded), \
+                patch.object(app, 'login_url', site.url), \
+                patch.object(app, 'SELECTORS', {**app.SELECTORS, **SELECTORS}), \
+                patch.object(app, 'mqtt_broker', '127.0.0.1'), \
+                patch.object(app, 'mqtt_port', broker.port), \
+                patch.object(app, 'form_settle_delay', 0), \
+                patch('app.sleep'):
+            for cycle in range(1, CYCLES + 1):
+                values = run_cycle()
+                assert values and values['total'] == 1234.50, f"cycle {cycle} got no reading"
+                now = settled(broker, temp_dir, runs)
+                history.append(now)
+                if cycle % REPORT_EVERY == 0:
+                    print(f"cycle {cycle}: " + ', '.join(f'{key} {value:g}'
+                                                         for key, value in now.items()))
+                over = {}
+                for key, limit in THRESHOLDS.items():
+                    if key in LEFT_BEHIND:
+                        growth = now[key]
+                    elif cycle > WARMUP:
+                        growth = now[key] - history[WARMUP - 1][key]
+                    else:
+                        continue
+                    if growth > limit:
+                        over[key] = growth
+                assert not over, (f"Grew after {cycle} cycles: {over}, first {history[0]}, "
+                                  f"now {now}")
+
+        assert len(broker.messages) >= CYCLES